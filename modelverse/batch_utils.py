@@ -0,0 +1,389 @@
+"""
+批量推理任务
+读取JSONL格式的对话请求，以有界并发异步发送到推理任务，保持vLLM的批次饱满；
+结果逐条追加写入输出JSONL，中断后可跳过已成功的请求继续执行，进度和吞吐通过WebSocket推送
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Set, Tuple
+
+from fastapi import WebSocket
+
+from models import BatchJobStatus, InferenceStatus
+from database import get_batch_job, get_all_batch_jobs, update_batch_job, get_inference_task
+import gateway_utils
+import lifecycle_utils
+import scheduler_utils
+import usage_utils
+
+logger = logging.getLogger(__name__)
+
+BATCH_DIR = Path("batches")
+MAX_BATCH_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "256"))
+BATCH_MAX_RETRIES = int(os.environ.get("BATCH_MAX_RETRIES", "2"))
+# 引擎繁忙被拒绝后，两次尝试排队之间的最长等待秒数
+BATCH_BUSY_MAX_WAIT = float(os.environ.get("BATCH_BUSY_MAX_WAIT", "30"))
+PROGRESS_INTERVAL = 1.0
+# 校验上传文件时最多报告的错误行数
+MAX_REPORTED_ERRORS = 5
+
+# 任务ID -> 正在运行的批量任务
+running_jobs: Dict[int, asyncio.Task] = {}
+# 任务ID -> 运行时进度
+job_progress: Dict[int, Dict[str, Any]] = {}
+# 任务ID -> 订阅进度的WebSocket连接
+batch_ws_connections: Dict[int, Set[WebSocket]] = {}
+
+class BatchQuotaExceeded(Exception):
+    """提交用户超出每日用量配额，批量任务暂停"""
+
+def new_job_dir() -> Path:
+    """为新的批量任务创建存放输入输出文件的目录"""
+    path = BATCH_DIR / uuid.uuid4().hex
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+def parse_request_line(line: str, line_no: int) -> Tuple[str, Dict[str, Any]]:
+    """解析一行批量请求
+
+    支持两种格式：OpenAI批量格式 {"custom_id": ..., "body": {"messages": [...], ...}}，
+    或直接写请求体 {"messages": [...], ...}。没有custom_id时使用行号。
+    """
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError("每行必须是JSON对象")
+    body = record.get("body", record)
+    if not isinstance(body, dict) or not isinstance(body.get("messages"), list) or not body["messages"]:
+        raise ValueError("缺少messages列表")
+    body = {key: value for key, value in body.items() if key not in ("custom_id", "model", "stream")}
+    custom_id = str(record.get("custom_id") or f"line-{line_no}")
+    return custom_id, body
+
+def inspect_input(input_path: Path) -> Dict[str, Any]:
+    """校验输入文件，统计请求数并检查custom_id是否重复"""
+    total = 0
+    errors: List[str] = []
+    seen: Set[str] = set()
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                custom_id, _ = parse_request_line(line, line_no)
+            except (ValueError, json.JSONDecodeError) as e:
+                errors.append(f"第{line_no}行: {str(e)}")
+            else:
+                if custom_id in seen:
+                    errors.append(f"第{line_no}行: custom_id重复: {custom_id}")
+                seen.add(custom_id)
+                total += 1
+            if len(errors) >= MAX_REPORTED_ERRORS:
+                break
+    return {"total": total, "errors": errors}
+
+def default_concurrency(task: Any) -> int:
+    """默认并发数：填满推理任务所有副本的批次（引擎配置的max_num_seqs × 副本数）"""
+    import inference_utils
+
+    engine_task = get_inference_task(task_id=task.base_task_id) if task.base_task_id else task
+    profile = inference_utils.get_engine_profile(engine_task.engine_profile if engine_task else None)
+    replicas = (engine_task.replicas if engine_task else 1) or 1
+    return max(1, min(profile["max_num_seqs"] * replicas, MAX_BATCH_CONCURRENCY))
+
+def load_finished(output_path: Path) -> Tuple[Set[str], int, int]:
+    """读取已有输出，返回已成功的custom_id和累计token数
+
+    失败记录和中断时写了一半的行会被移除，恢复执行时重新请求。
+    """
+    finished: Set[str] = set()
+    prompt_tokens = completion_tokens = 0
+    if not output_path.exists():
+        return finished, 0, 0
+
+    kept: List[str] = []
+    dropped = 0
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                dropped += 1
+                continue
+            if record.get("error") or record.get("custom_id") in finished:
+                dropped += 1
+                continue
+            finished.add(record["custom_id"])
+            usage = ((record.get("response") or {}).get("body") or {}).get("usage") or {}
+            prompt_tokens += usage.get("prompt_tokens", 0)
+            completion_tokens += usage.get("completion_tokens", 0)
+            kept.append(line if line.endswith("\n") else line + "\n")
+
+    if dropped:
+        tmp_path = output_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(kept)
+        os.replace(tmp_path, output_path)
+        logger.info(f"整理批量输出文件: {output_path}, 保留 {len(kept)} 条, 移除 {dropped} 条待重试记录")
+    return finished, prompt_tokens, completion_tokens
+
+async def _send_request(task: Any, body: Dict[str, Any], user_id: Optional[int] = None) -> Dict[str, Any]:
+    """发送一条请求，上游5xx或连接失败时重试，返回输出记录中的response/error部分"""
+    payload = dict(body)
+    payload.setdefault("max_tokens", task.max_tokens)
+    payload.setdefault("temperature", task.temperature)
+    payload.setdefault("top_p", task.top_p)
+
+    # 与在线请求共用准入控制，按提交用户公平排队；引擎繁忙时等待而不是让请求失败
+    scheduler = scheduler_utils.get_scheduler(task)
+    client_key = f"user:{user_id}" if user_id else "batch"
+    error = None
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        while True:
+            try:
+                await scheduler.acquire(client_key)
+                break
+            except scheduler_utils.SchedulerBusy as e:
+                await asyncio.sleep(min(max(e.retry_after, 1.0), BATCH_BUSY_MAX_WAIT))
+        generation_start = time.monotonic()
+        try:
+            status_code, response = await gateway_utils.forward_json(task, "chat/completions", payload,
+                                                                          user_id=user_id)
+        except gateway_utils.GatewayError as e:
+            error = {"message": e.message, "code": e.code}
+        else:
+            if status_code == 200:
+                return {"response": {"status_code": status_code, "body": response}, "error": None}
+            error = {"message": json.dumps(response, ensure_ascii=False)[:500], "code": str(status_code)}
+            if status_code < 500:
+                break
+        finally:
+            scheduler.release(time.monotonic() - generation_start)
+        if attempt < BATCH_MAX_RETRIES:
+            await asyncio.sleep(2 ** attempt)
+    return {"response": None, "error": error}
+
+async def _broadcast(job_id: int, message: Dict[str, Any]) -> None:
+    """把进度推送给订阅该批量任务的WebSocket连接"""
+    text = json.dumps(message, ensure_ascii=False, default=str)
+    for websocket in list(batch_ws_connections.get(job_id, ())):
+        try:
+            await websocket.send_text(text)
+        except Exception as e:
+            logger.debug(f"批量任务WebSocket发送失败: 任务={job_id}, 错误={str(e)}")
+            remove_websocket(job_id, websocket)
+
+def _progress_message(job_id: int) -> Dict[str, Any]:
+    progress = job_progress[job_id]
+    elapsed = max(time.time() - progress["run_started"], 1e-6)
+    done = progress["completed"] + progress["failed"]
+    requests_per_second = progress["run_done"] / elapsed
+    remaining = max(progress["total"] - done, 0)
+    return {
+        "type": "progress",
+        "job_id": job_id,
+        "total": progress["total"],
+        "completed": progress["completed"],
+        "failed": progress["failed"],
+        "in_flight": progress["in_flight"],
+        "prompt_tokens": progress["prompt_tokens"],
+        "completion_tokens": progress["completion_tokens"],
+        "elapsed": round(elapsed, 1),
+        "requests_per_second": round(requests_per_second, 2),
+        "tokens_per_second": round(progress["run_completion_tokens"] / elapsed, 1),
+        "eta_seconds": round(remaining / requests_per_second, 1) if requests_per_second > 0 else None
+    }
+
+def _save_progress(job_id: int) -> None:
+    progress = job_progress[job_id]
+    update_batch_job(
+        job_id,
+        completed=progress["completed"],
+        failed=progress["failed"],
+        prompt_tokens=progress["prompt_tokens"],
+        completion_tokens=progress["completion_tokens"]
+    )
+
+async def _report_progress(job_id: int) -> None:
+    """定期把进度写入数据库并推送给客户端"""
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        _save_progress(job_id)
+        await _broadcast(job_id, _progress_message(job_id))
+
+async def _run_job(job_id: int) -> None:
+    job = get_batch_job(job_id)
+    task = get_inference_task(task_id=job.task_id)
+    if not task or not lifecycle_utils.is_available(task):
+        raise RuntimeError("目标推理任务不存在或未运行")
+    if task.status != InferenceStatus.RUNNING:
+        task = await lifecycle_utils.ensure_running(task.id)
+
+    input_path = Path(job.input_path)
+    output_path = Path(job.output_path)
+    finished, prompt_tokens, completion_tokens = load_finished(output_path)
+    job_progress[job_id] = progress = {
+        "total": job.total,
+        "completed": len(finished),
+        "failed": 0,
+        "in_flight": 0,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "run_started": time.time(),
+        "run_done": 0,
+        "run_completion_tokens": 0
+    }
+    update_batch_job(job_id, status=BatchJobStatus.RUNNING, started_at=datetime.now(), failed=0, completed=len(finished))
+    if finished:
+        logger.info(f"批量任务 {job_id} 恢复执行，跳过已完成的 {len(finished)} 条请求")
+
+    # 输入按需读取，队列长度有限，大文件不会一次性载入内存
+    queue: asyncio.Queue = asyncio.Queue(maxsize=job.concurrency * 2)
+
+    async def produce():
+        try:
+            with open(input_path, "r", encoding="utf-8") as f:
+                for line_no, line in enumerate(f, start=1):
+                    if not line.strip():
+                        continue
+                    custom_id, body = parse_request_line(line, line_no)
+                    if progress.get("quota_exceeded"):
+                        break
+                    if custom_id not in finished:
+                        await queue.put((custom_id, body))
+        finally:
+            for _ in range(job.concurrency):
+                await queue.put(None)
+
+    with open(output_path, "a", encoding="utf-8") as out_fp:
+        async def consume():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                custom_id, body = item
+                # 超出配额后剩余的请求不再发送也不写入输出，恢复任务时重新执行
+                if not progress.get("quota_exceeded"):
+                    exceeded = usage_utils.usage_meter.check_quota(job.user_id)
+                    if exceeded:
+                        progress["quota_exceeded"] = exceeded["message"]
+                        logger.warning(f"批量任务 {job_id} 的用户超出用量配额，暂停执行: {exceeded['message']}")
+                if progress.get("quota_exceeded"):
+                    continue
+                progress["in_flight"] += 1
+                try:
+                    result = await _send_request(task, body, job.user_id)
+                except Exception as e:
+                    logger.error(f"批量请求失败: 任务={job_id}, custom_id={custom_id}, 错误={str(e)}")
+                    result = {"response": None, "error": {"message": str(e), "code": None}}
+                finally:
+                    progress["in_flight"] -= 1
+                # 每条结果立即写入并刷新，中断时最多丢失正在进行的请求
+                out_fp.write(json.dumps({"custom_id": custom_id, **result}, ensure_ascii=False) + "\n")
+                out_fp.flush()
+                progress["run_done"] += 1
+                if result["error"]:
+                    progress["failed"] += 1
+                    continue
+                progress["completed"] += 1
+                usage = result["response"]["body"].get("usage") or {}
+                progress["prompt_tokens"] += usage.get("prompt_tokens", 0)
+                progress["completion_tokens"] += usage.get("completion_tokens", 0)
+                progress["run_completion_tokens"] += usage.get("completion_tokens", 0)
+
+        reporter = asyncio.create_task(_report_progress(job_id))
+        try:
+            # 等所有协程结束后再关闭输出文件
+            results = await asyncio.gather(produce(), *(consume() for _ in range(job.concurrency)), return_exceptions=True)
+            errors = [r for r in results if isinstance(r, BaseException)]
+            if errors:
+                raise errors[0]
+            if progress.get("quota_exceeded"):
+                raise BatchQuotaExceeded(progress["quota_exceeded"])
+        finally:
+            reporter.cancel()
+            _save_progress(job_id)
+
+async def _job_main(job_id: int) -> None:
+    """批量任务入口：处理完成、停止和失败的状态更新"""
+    try:
+        await _run_job(job_id)
+        progress = job_progress.get(job_id, {})
+        failed = progress.get("failed", 0)
+        update_batch_job(
+            job_id,
+            status=BatchJobStatus.COMPLETED,
+            completed_at=datetime.now(),
+            error_message=f"{failed} 条请求失败，恢复任务可重试失败的请求" if failed else ""
+        )
+        logger.info(f"批量任务完成: {job_id}, 成功={progress.get('completed', 0)}, 失败={failed}")
+    except asyncio.CancelledError:
+        update_batch_job(job_id, status=BatchJobStatus.STOPPED)
+        logger.info(f"批量任务已停止: {job_id}")
+    except BatchQuotaExceeded as e:
+        update_batch_job(job_id, status=BatchJobStatus.STOPPED, error_message=f"{str(e)}，配额重置后可恢复任务")
+        logger.info(f"批量任务因用量配额暂停: {job_id}")
+    except Exception as e:
+        logger.exception(f"批量任务失败: {job_id}, 错误: {str(e)}")
+        update_batch_job(job_id, status=BatchJobStatus.FAILED, error_message=str(e))
+    finally:
+        running_jobs.pop(job_id, None)
+        job = get_batch_job(job_id)
+        message = _progress_message(job_id) if job_id in job_progress else {"type": "progress", "job_id": job_id}
+        message.update({"type": "status", "status": job.status if job else None,
+                        "error_message": job.error_message if job else None})
+        await _broadcast(job_id, message)
+        job_progress.pop(job_id, None)
+
+def start_job(job_id: int) -> bool:
+    """在后台启动或恢复批量任务，已在运行时返回False"""
+    if job_id in running_jobs:
+        return False
+    update_batch_job(job_id, status=BatchJobStatus.PENDING, error_message="")
+    running_jobs[job_id] = asyncio.create_task(_job_main(job_id))
+    return True
+
+async def stop_job(job_id: int) -> bool:
+    """停止正在运行的批量任务，已写入的结果保留，之后可以恢复"""
+    job_task = running_jobs.get(job_id)
+    if not job_task:
+        return False
+    job_task.cancel()
+    try:
+        await job_task
+    except asyncio.CancelledError:
+        pass
+    return True
+
+def get_job_progress(job_id: int) -> Optional[Dict[str, Any]]:
+    """正在运行的批量任务的实时进度"""
+    if job_id not in job_progress:
+        return None
+    return _progress_message(job_id)
+
+def mark_interrupted_jobs() -> List[int]:
+    """服务启动时把上次未结束的批量任务标记为已停止，等待用户恢复"""
+    interrupted = []
+    for job in get_all_batch_jobs():
+        if job.status in (BatchJobStatus.PENDING, BatchJobStatus.RUNNING) and job.id not in running_jobs:
+            update_batch_job(job.id, status=BatchJobStatus.STOPPED, error_message="服务重启时中断，恢复任务可继续执行")
+            interrupted.append(job.id)
+    if interrupted:
+        logger.info(f"已标记中断的批量任务: {interrupted}")
+    return interrupted
+
+def register_websocket(job_id: int, websocket: WebSocket) -> None:
+    batch_ws_connections.setdefault(job_id, set()).add(websocket)
+
+def remove_websocket(job_id: int, websocket: WebSocket) -> None:
+    connections = batch_ws_connections.get(job_id)
+    if connections is not None:
+        connections.discard(websocket)
+        if not connections:
+            batch_ws_connections.pop(job_id, None)
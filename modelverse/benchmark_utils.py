@@ -0,0 +1,392 @@
+"""
+推理引擎基准测试工具
+在不同的引擎配置下启动推理任务，回放录制的提示集，统计吞吐和延迟；
+以及对比多轮对话在有/无会话粘滞路由时的首token延迟（TTFT）
+"""
+
+import sys
+import json
+import time
+import asyncio
+import uuid
+import logging
+import requests
+from pathlib import Path
+from typing import Dict, Any, Optional, List
+from datetime import datetime
+
+from models import InferenceStatus
+from database import get_inference_task, update_inference_task
+import inference_utils
+import routing_utils
+
+logger = logging.getLogger(__name__)
+
+# 每个任务最近一次扫描的状态和结果：任务ID -> 扫描记录
+sweep_runs: Dict[int, Dict[str, Any]] = {}
+
+# 正在提供服务的任务不能扫描（扫描会反复重启引擎，IDLE任务收到请求也会被冷启动）
+SWEEP_BLOCKED_STATUSES = (InferenceStatus.RUNNING, InferenceStatus.IDLE, InferenceStatus.CREATING)
+
+# 每个任务最近一次会话粘滞基准测试的状态和结果
+affinity_runs: Dict[int, Dict[str, Any]] = {}
+
+# 多轮对话基准测试的默认问题
+DEFAULT_CHAT_TURNS = [
+    "请介绍一下你自己。",
+    "能再详细解释一下刚才提到的内容吗？",
+    "请举一个具体的例子。",
+    "这个例子里最关键的步骤是什么？",
+    "如果换一种方法，会有什么不同？",
+    "请总结一下我们目前讨论的要点。"
+]
+
+def load_prompt_set(path: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """读取录制的提示集
+
+    支持JSONL文件或包含JSONL文件的目录，每行为 {"messages": [...]} 或 {"prompt": "..."}，
+    可选字段max_tokens覆盖默认输出长度。
+    """
+    file_path = Path(path)
+    if file_path.is_dir():
+        candidates = sorted(file_path.rglob("*.jsonl"))
+        if not candidates:
+            raise FileNotFoundError(f"目录中没有JSONL提示文件: {path}")
+        file_path = candidates[0]
+
+    prompts = []
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            prompt = normalize_prompt(record)
+            if prompt:
+                prompts.append(prompt)
+            if limit and len(prompts) >= limit:
+                break
+    logger.info(f"从 {file_path} 读取了 {len(prompts)} 条提示")
+    return prompts
+
+def normalize_prompt(record: Any) -> Optional[Dict[str, Any]]:
+    """把一条提示记录转换为 {"messages": [...], "max_tokens": ...} 格式"""
+    if isinstance(record, str):
+        return {"messages": [{"role": "user", "content": record}]}
+    if not isinstance(record, dict):
+        return None
+    if record.get("messages"):
+        messages = record["messages"]
+    elif record.get("prompt"):
+        messages = [{"role": "user", "content": record["prompt"]}]
+    else:
+        return None
+    prompt = {"messages": messages}
+    if record.get("max_tokens"):
+        prompt["max_tokens"] = int(record["max_tokens"])
+    return prompt
+
+def _percentile(values: List[float], percent: float) -> Optional[float]:
+    """计算百分位数（线性插值）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * percent / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+def _send_prompt(api_url: str, model_name: str, prompt: Dict[str, Any], max_tokens: int) -> Dict[str, Any]:
+    """发送单条提示并记录延迟和生成的token数"""
+    payload = {
+        "model": model_name,
+        "messages": prompt["messages"],
+        "max_tokens": prompt.get("max_tokens", max_tokens),
+        "temperature": 0.0
+    }
+    start_time = time.perf_counter()
+    try:
+        response = requests.post(api_url, json=payload, timeout=300)
+        latency = time.perf_counter() - start_time
+        if response.status_code != 200:
+            return {"ok": False, "latency": latency, "error": f"HTTP {response.status_code}"}
+        usage = response.json().get("usage", {})
+        return {
+            "ok": True,
+            "latency": latency,
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0)
+        }
+    except Exception as e:
+        return {"ok": False, "latency": time.perf_counter() - start_time, "error": str(e)}
+
+async def replay_prompts(port: int, model_name: str, prompts: List[Dict[str, Any]],
+                         concurrency: int = 8, max_tokens: int = 256) -> Dict[str, Any]:
+    """以固定并发回放提示集，返回吞吐和延迟统计"""
+    api_url = f"http://localhost:{port}/v1/chat/completions"
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run_one(prompt):
+        async with semaphore:
+            return await asyncio.to_thread(_send_prompt, api_url, model_name, prompt, max_tokens)
+
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*(run_one(p) for p in prompts))
+    duration = time.perf_counter() - start_time
+
+    succeeded = [r for r in results if r["ok"]]
+    latencies = [r["latency"] for r in succeeded]
+    output_tokens = sum(r["completion_tokens"] for r in succeeded)
+    errors = [r["error"] for r in results if not r["ok"]]
+    return {
+        "requests": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(errors),
+        "errors": errors[:5],
+        "duration": round(duration, 3),
+        "prompt_tokens": sum(r["prompt_tokens"] for r in succeeded),
+        "output_tokens": output_tokens,
+        "tokens_per_second": round(output_tokens / duration, 2) if duration > 0 else 0.0,
+        "requests_per_second": round(len(succeeded) / duration, 3) if duration > 0 else 0.0,
+        "latency_p50": round(_percentile(latencies, 50), 3) if latencies else None,
+        "latency_p99": round(_percentile(latencies, 99), 3) if latencies else None
+    }
+
+async def run_profile_sweep(task_id: int, prompts: List[Dict[str, Any]], profiles: Optional[List[str]] = None,
+                            concurrency: int = 8, max_tokens: int = 256) -> Dict[str, Any]:
+    """依次用每个引擎配置启动推理任务并回放提示集
+
+    只能在已停止的任务上进行；扫描结束后停止任务并恢复原来的引擎配置。
+    """
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise ValueError(f"推理任务不存在: {task_id}")
+    if task.status in SWEEP_BLOCKED_STATUSES:
+        raise ValueError(f"推理任务正在提供服务（{task.status}），请先停止再扫描")
+
+    profiles = profiles or list(inference_utils.ENGINE_PROFILES.keys())
+    original_profile = task.engine_profile
+    run = {
+        "task_id": task_id,
+        "status": "running",
+        "profiles": profiles,
+        "current_profile": None,
+        "prompt_count": len(prompts),
+        "concurrency": concurrency,
+        "results": [],
+        "started_at": datetime.now().isoformat(),
+        "finished_at": None,
+        "error": None
+    }
+    sweep_runs[task_id] = run
+    logger.info(f"开始引擎配置扫描: 任务={task_id}, 配置={profiles}, 提示数={len(prompts)}")
+
+    try:
+        for profile in profiles:
+            run["current_profile"] = profile
+            await inference_utils.stop_inference_service(task_id)
+            update_inference_task(task_id=task_id, engine_profile=profile)
+
+            launch_start = time.perf_counter()
+            started = await inference_utils.start_inference_service(task_id)
+            startup_time = round(time.perf_counter() - launch_start, 1)
+            if not started:
+                failed_task = get_inference_task(task_id=task_id)
+                error_msg = failed_task.error_message if failed_task else "启动失败"
+                logger.error(f"引擎配置 {profile} 启动失败: {error_msg}")
+                run["results"].append({"profile": profile, "started": False, "startup_time": startup_time,
+                                       "error": (error_msg or "")[:500]})
+                continue
+
+            running_task = get_inference_task(task_id=task_id)
+            # 预热一次，避免把首次编译和缓存分配计入统计
+            await replay_prompts(running_task.port, running_task.name, prompts[:1], 1, max_tokens)
+            stats = await replay_prompts(running_task.port, running_task.name, prompts, concurrency, max_tokens)
+            result = {"profile": profile, "started": True, "startup_time": startup_time}
+            result.update(stats)
+            run["results"].append(result)
+            logger.info(f"引擎配置 {profile}: {stats['tokens_per_second']} tokens/s, "
+                        f"p50={stats['latency_p50']}s, p99={stats['latency_p99']}s")
+        run["status"] = "completed"
+    except Exception as e:
+        logger.exception(f"引擎配置扫描失败: {str(e)}")
+        run["status"] = "failed"
+        run["error"] = str(e)
+    finally:
+        run["current_profile"] = None
+        await inference_utils.stop_inference_service(task_id)
+        update_inference_task(task_id=task_id, engine_profile=original_profile)
+        run["finished_at"] = datetime.now().isoformat()
+
+    return run
+
+def get_sweep_status(task_id: int) -> Optional[Dict[str, Any]]:
+    """获取任务最近一次扫描的状态和结果"""
+    return sweep_runs.get(task_id)
+
+def _stream_turn(api_url: str, model_name: str, messages: List[Dict[str, Any]], max_tokens: int) -> Dict[str, Any]:
+    """以流式方式发送一轮对话，记录首token延迟和完整回复"""
+    payload = {
+        "model": model_name,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": 0.0,
+        "stream": True
+    }
+    start_time = time.perf_counter()
+    ttft = None
+    parts = []
+    try:
+        with requests.post(api_url, json=payload, stream=True, timeout=300) as response:
+            if response.status_code != 200:
+                return {"ok": False, "error": f"HTTP {response.status_code}"}
+            for line in response.iter_lines():
+                if not line or not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or [{}]
+                content = choices[0].get("delta", {}).get("content")
+                if content:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start_time
+                    parts.append(content)
+        return {"ok": True, "ttft": ttft, "latency": time.perf_counter() - start_time, "content": "".join(parts)}
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+async def _run_conversation(task, index: int, turns: int, max_tokens: int, affinity: bool,
+                            questions: List[str], nonce: str) -> List[Dict[str, Any]]:
+    """执行一段多轮对话，每轮都重发完整历史（与网页端聊天的行为一致）"""
+    # 每段对话使用不同的系统提示，避免不同对话之间共享前缀
+    history = [{"role": "system", "content": f"你是一个乐于助人的助手。会话编号：{nonce}-{index}。请用简洁的中文回答。"}]
+    session_key = f"bench:{nonce}:{index}" if affinity else None
+    records = []
+    for turn in range(turns):
+        history.append({"role": "user", "content": questions[(index + turn) % len(questions)]})
+        handle = routing_utils.replica_router.acquire(task.id, session_key)
+        port = handle["port"] if handle else task.port
+        api_url = f"http://localhost:{port}/v1/chat/completions"
+        try:
+            result = await asyncio.to_thread(_stream_turn, api_url, task.name, list(history), max_tokens)
+        finally:
+            routing_utils.replica_router.release(handle, success=True)
+        result.update({"turn": turn, "replica": handle["replica"] if handle else None})
+        records.append(result)
+        if not result["ok"]:
+            break
+        history.append({"role": "assistant", "content": result["content"]})
+    return records
+
+def _summarize_ttft(records: List[Dict[str, Any]], turns: int) -> Dict[str, Any]:
+    """汇总TTFT统计：整体、逐轮中位数以及对话后半程"""
+    ok = [r for r in records if r["ok"] and r.get("ttft") is not None]
+    ttfts = [r["ttft"] for r in ok]
+    late = [r["ttft"] for r in ok if r["turn"] >= turns // 2]
+    per_turn = []
+    for turn in range(turns):
+        values = [r["ttft"] for r in ok if r["turn"] == turn]
+        per_turn.append(round(_percentile(values, 50), 4) if values else None)
+    return {
+        "turns_completed": len(ok),
+        "turns_failed": len([r for r in records if not r["ok"]]),
+        "ttft_p50": round(_percentile(ttfts, 50), 4) if ttfts else None,
+        "ttft_p99": round(_percentile(ttfts, 99), 4) if ttfts else None,
+        "late_turns_ttft_p50": round(_percentile(late, 50), 4) if late else None,
+        "per_turn_ttft_p50": per_turn
+    }
+
+def _count_replica_switches(records: List[Dict[str, Any]]) -> int:
+    """统计一段对话中相邻两轮落在不同副本上的次数"""
+    return sum(
+        1 for prev, curr in zip(records, records[1:])
+        if prev["replica"] is not None and prev["replica"] != curr["replica"]
+    )
+
+async def run_affinity_benchmark(task_id: int, conversations: int = 8, turns: int = 20, max_tokens: int = 64,
+                                 questions: Optional[List[str]] = None) -> Dict[str, Any]:
+    """对比有/无会话粘滞路由时多轮对话的首token延迟
+
+    两种模式各并发运行conversations段、每段turns轮的对话，每段对话使用不同的系统提示，
+    两种模式之间也不共享前缀，结果只反映路由方式对前缀缓存命中的影响。
+    """
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise ValueError(f"推理任务不存在: {task_id}")
+
+    questions = questions or DEFAULT_CHAT_TURNS
+    run = {
+        "task_id": task_id,
+        "status": "running",
+        "conversations": conversations,
+        "turns": turns,
+        "replicas": len(routing_utils.replica_router.list(task_id)),
+        "results": {},
+        "started_at": datetime.now().isoformat(),
+        "finished_at": None,
+        "error": None
+    }
+    affinity_runs[task_id] = run
+    logger.info(f"开始会话粘滞基准测试: 任务={task_id}, 对话数={conversations}, 轮数={turns}, 副本数={run['replicas']}")
+
+    try:
+        if task.status != InferenceStatus.RUNNING:
+            raise ValueError("推理任务未运行")
+        for mode, affinity in (("without_affinity", False), ("with_affinity", True)):
+            nonce = uuid.uuid4().hex[:8]
+            start_time = time.perf_counter()
+            conversation_records = await asyncio.gather(*(
+                _run_conversation(task, index, turns, max_tokens, affinity, questions, nonce)
+                for index in range(conversations)
+            ))
+            records = [r for conversation in conversation_records for r in conversation]
+            summary = _summarize_ttft(records, turns)
+            summary["duration"] = round(time.perf_counter() - start_time, 2)
+            summary["replica_switches"] = sum(_count_replica_switches(c) for c in conversation_records)
+            run["results"][mode] = summary
+            logger.info(f"会话粘滞基准测试 {mode}: TTFT p50={summary['ttft_p50']}s, p99={summary['ttft_p99']}s")
+        run["status"] = "completed"
+    except Exception as e:
+        logger.exception(f"会话粘滞基准测试失败: {str(e)}")
+        run["status"] = "failed"
+        run["error"] = str(e)
+    finally:
+        run["finished_at"] = datetime.now().isoformat()
+    return run
+
+def get_affinity_benchmark_status(task_id: int) -> Optional[Dict[str, Any]]:
+    """获取任务最近一次会话粘滞基准测试的状态和结果"""
+    return affinity_runs.get(task_id)
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+
+    parser = argparse.ArgumentParser(description="在各个引擎配置下对推理任务做基准测试")
+    parser.add_argument("--task-id", type=int, required=True, help="推理任务ID")
+    parser.add_argument("--prompts", default=None, help="录制的提示集（JSONL文件或目录）")
+    parser.add_argument("--affinity", action="store_true", help="改为运行多轮对话的会话粘滞TTFT基准测试")
+    parser.add_argument("--conversations", type=int, default=8, help="会话粘滞测试的并发对话数")
+    parser.add_argument("--turns", type=int, default=20, help="会话粘滞测试每段对话的轮数")
+    parser.add_argument("--profiles", default=None, help="逗号分隔的引擎配置名，默认全部")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发请求数")
+    parser.add_argument("--max-tokens", type=int, default=256, help="每条请求的默认输出长度")
+    parser.add_argument("--limit", type=int, default=None, help="最多回放的提示数")
+    args = parser.parse_args()
+
+    if args.affinity:
+        # 命令行独立运行时路由表为空，按任务端口直连
+        report = asyncio.run(run_affinity_benchmark(args.task_id, args.conversations, args.turns, args.max_tokens))
+    else:
+        if not args.prompts:
+            parser.error("引擎配置扫描需要 --prompts")
+        prompt_set = load_prompt_set(args.prompts, limit=args.limit)
+        profile_names = args.profiles.split(",") if args.profiles else None
+        report = asyncio.run(run_profile_sweep(args.task_id, prompt_set, profile_names, args.concurrency, args.max_tokens))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
@@ -0,0 +1,178 @@
+"""
+推理响应缓存
+对开启缓存的推理任务，采样确定（温度接近0或top_k为1）的请求按
+（任务模型、规范化后的消息、采样参数）缓存响应，按LRU和TTL淘汰并限制总字节数；
+任务参数修改时失效，统计命中率和节省的GPU时间
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List
+
+logger = logging.getLogger(__name__)
+
+# 缓存配置
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+# 温度不超过该值时视为贪心解码
+DETERMINISTIC_TEMPERATURE = float(os.environ.get("RESPONSE_CACHE_MAX_TEMPERATURE", "1e-5"))
+
+# 不影响生成结果的请求字段
+_VOLATILE_FIELDS = {"stream", "stream_options", "user", "model"}
+# 影响生成结果的任务级引擎参数
+_ENGINE_FIELDS = ("model_id", "name", "quantization", "dtype", "max_model_len", "base_task_id", "adapter_path")
+
+def is_deterministic(params: Dict[str, Any]) -> bool:
+    """采样参数是否确定：只生成一个候选，且温度接近0或top_k为1"""
+    if (params.get("n") or 1) != 1 or params.get("logprobs") or params.get("best_of"):
+        return False
+    temperature = params.get("temperature")
+    if temperature is not None and temperature <= DETERMINISTIC_TEMPERATURE:
+        return True
+    return params.get("top_k") == 1
+
+def _normalize_messages(messages: Any) -> Any:
+    """规范化消息：只保留角色和内容，去掉内容首尾空白"""
+    if not isinstance(messages, list):
+        return messages
+    normalized = []
+    for message in messages:
+        if not isinstance(message, dict):
+            normalized.append(message)
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            content = content.strip()
+        normalized.append({"role": (message.get("role") or "").lower(), "content": content})
+    return normalized
+
+def make_key(task: Any, path: str, params: Dict[str, Any]) -> str:
+    """由任务模型、接口路径、规范化消息和采样参数生成缓存键"""
+    request = {key: value for key, value in params.items() if key not in _VOLATILE_FIELDS and value is not None}
+    if "messages" in request:
+        request["messages"] = _normalize_messages(request["messages"])
+    material = {
+        "task_id": task.id,
+        "engine": {field: getattr(task, field, None) for field in _ENGINE_FIELDS},
+        "path": path,
+        "request": request
+    }
+    encoded = json.dumps(material, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """按字节预算限制的LRU + TTL响应缓存"""
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES, ttl: float = RESPONSE_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # 缓存键 -> {task_id, value, size, expires_at, generation_seconds}
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._stats: Dict[int, Dict[str, float]] = {}
+
+    def _task_stats(self, task_id: int) -> Dict[str, float]:
+        return self._stats.setdefault(task_id, {
+            "hits": 0, "misses": 0, "stores": 0, "evictions": 0, "gpu_seconds_saved": 0.0
+        })
+
+    def _remove(self, key: str) -> Dict[str, Any]:
+        entry = self._entries.pop(key)
+        self._bytes -= entry["size"]
+        return entry
+
+    def get(self, task_id: int, key: str) -> Optional[Any]:
+        """查找缓存，命中时返回缓存的响应并记入节省的GPU时间"""
+        now = time.time()
+        with self._lock:
+            stats = self._task_stats(task_id)
+            entry = self._entries.get(key)
+            if entry and entry["expires_at"] <= now:
+                self._remove(key)
+                stats["evictions"] += 1
+                entry = None
+            if entry is None:
+                stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            stats["hits"] += 1
+            stats["gpu_seconds_saved"] += entry["generation_seconds"]
+            return json.loads(entry["value"])
+
+    def put(self, task_id: int, key: str, value: Any, generation_seconds: float) -> bool:
+        """写入缓存，超出字节预算时淘汰最久未使用的条目"""
+        encoded = json.dumps(value, ensure_ascii=False)
+        size = len(encoded.encode("utf-8")) + len(key)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                "task_id": task_id,
+                "value": encoded,
+                "size": size,
+                "expires_at": time.time() + self.ttl,
+                "generation_seconds": generation_seconds
+            }
+            self._bytes += size
+            self._task_stats(task_id)["stores"] += 1
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted["size"]
+                self._task_stats(evicted["task_id"])["evictions"] += 1
+        return True
+
+    def invalidate_task(self, task_id: int) -> int:
+        """删除某个推理任务的全部缓存条目"""
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry["task_id"] == task_id]
+            for key in keys:
+                self._remove(key)
+        if keys:
+            logger.info(f"已清除推理任务 {task_id} 的 {len(keys)} 条响应缓存")
+        return len(keys)
+
+    def stats(self, task_ids: Optional[List[int]] = None) -> Dict[str, Any]:
+        """缓存统计：总体占用，以及各任务的命中率和节省的GPU时间"""
+        with self._lock:
+            per_task_entries: Dict[int, Dict[str, int]] = {}
+            for entry in self._entries.values():
+                usage = per_task_entries.setdefault(entry["task_id"], {"entries": 0, "bytes": 0})
+                usage["entries"] += 1
+                usage["bytes"] += entry["size"]
+            tasks = {}
+            for task_id, stats in self._stats.items():
+                if task_ids is not None and task_id not in task_ids:
+                    continue
+                lookups = stats["hits"] + stats["misses"]
+                tasks[task_id] = dict(
+                    stats,
+                    gpu_seconds_saved=round(stats["gpu_seconds_saved"], 2),
+                    hit_rate=round(stats["hits"] / lookups, 4) if lookups else 0.0,
+                    **per_task_entries.get(task_id, {"entries": 0, "bytes": 0})
+                )
+            result = {"tasks": tasks}
+            if task_ids is None:
+                result.update({
+                    "entries": len(self._entries),
+                    "bytes": self._bytes,
+                    "max_bytes": self.max_bytes,
+                    "ttl": self.ttl
+                })
+            return result
+
+# 全局响应缓存
+response_cache = ResponseCache()
+
+def cache_key_for(task: Any, path: str, params: Dict[str, Any]) -> Optional[str]:
+    """返回可缓存请求的缓存键；任务未开启缓存或采样不确定时返回None"""
+    if not getattr(task, "response_cache", False) or not is_deterministic(params):
+        return None
+    return make_key(task, path, params)
@@ -0,0 +1,196 @@
+"""
+多模型对比
+把同一个对话请求并发发送给多个推理任务，各模型的增量内容按到达顺序交错输出并标记任务ID，
+同时统计每个模型的排队、首token、生成耗时和token数。每个模型有独立的截止时间，
+慢的模型超时后单独结束，不会拖住整个对比
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Dict, Any, Optional, List, AsyncIterator
+
+from models import InferenceTask, InferenceStatus
+import gateway_utils
+import lifecycle_utils
+import scheduler_utils
+
+logger = logging.getLogger(__name__)
+
+# 对比配置
+COMPARE_MAX_TASKS = int(os.environ.get("COMPARE_MAX_TASKS", "8"))
+COMPARE_DEADLINE = float(os.environ.get("COMPARE_DEADLINE", "120"))
+COMPARE_MAX_DEADLINE = float(os.environ.get("COMPARE_MAX_DEADLINE", "600"))
+
+# 每个模型的结束事件类型
+TERMINAL_EVENTS = ("done", "error", "timeout")
+
+def build_payload(task: InferenceTask, messages: List[Dict[str, Any]], params: Dict[str, Any]) -> Dict[str, Any]:
+    """按任务生成流式请求，未指定的采样参数使用各任务自己的默认值"""
+    def pick(name: str) -> Any:
+        return params[name] if params.get(name) is not None else getattr(task, name)
+
+    return {
+        "model": task.name,
+        "messages": messages,
+        "temperature": pick("temperature"),
+        "top_p": pick("top_p"),
+        "max_tokens": pick("max_tokens"),
+        "repetition_penalty": pick("repetition_penalty"),
+        "stream": True,
+        "stream_options": {"include_usage": True}
+    }
+
+class _ModelRun:
+    """一个模型的对比请求：输出事件并记录统计"""
+
+    def __init__(self, task: InferenceTask, payload: Dict[str, Any], client_key: str,
+                 events: asyncio.Queue, user_id: Optional[int] = None):
+        self.task = task
+        self.payload = payload
+        self.client_key = client_key
+        self.user_id = user_id
+        self.events = events
+        self.started = time.monotonic()
+        self.chunks: List[str] = []
+        self.usage: Dict[str, Any] = {}
+        self.stats: Dict[str, Any] = {
+            "task_id": task.id,
+            "model_name": task.display_name or task.name,
+            "status": None,
+            "queue_wait": None,
+            "first_token_latency": None,
+            "generation_time": None,
+            "total_time": None,
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "tokens_per_second": None,
+            "finish_reason": None,
+            "error": None
+        }
+        self._generation_started: Optional[float] = None
+
+    def _emit(self, event: Dict[str, Any]) -> None:
+        self.events.put_nowait(dict(event, task_id=self.task.id))
+
+    def _feed(self, line: bytes) -> None:
+        if not line.startswith(b"data:"):
+            return
+        data = line[5:].strip()
+        if not data or data == b"[DONE]":
+            return
+        chunk = json.loads(data)
+        if chunk.get("error"):
+            error = chunk["error"]
+            raise RuntimeError(error.get("message") if isinstance(error, dict) else str(error))
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        for choice in chunk.get("choices") or []:
+            delta = (choice.get("delta") or {}).get("content")
+            if delta:
+                if self.stats["first_token_latency"] is None:
+                    self.stats["first_token_latency"] = round(time.monotonic() - self._generation_started, 3)
+                self.chunks.append(delta)
+                self._emit({"type": "delta", "content": delta})
+            if choice.get("finish_reason"):
+                self.stats["finish_reason"] = choice["finish_reason"]
+
+    async def _stream(self) -> None:
+        task = self.task
+        if task.status != InferenceStatus.RUNNING:
+            self._emit({"type": "status", "content": "模型正在启动"})
+            task = await lifecycle_utils.ensure_running(task.id)
+        scheduler = scheduler_utils.get_scheduler(task)
+        self.stats["queue_wait"] = round(await scheduler.acquire(self.client_key), 3)
+        self._generation_started = time.monotonic()
+        try:
+            upstream, handle, timer = await gateway_utils.open_stream(task, "chat/completions", self.payload,
+                                                                 user_id=self.user_id)
+            stream = gateway_utils.iter_stream(upstream, handle, timer)
+            pending = b""
+            try:
+                async for data in stream:
+                    *lines, pending = (pending + data).split(b"\n")
+                    for line in lines:
+                        self._feed(line)
+                self._feed(pending)
+            finally:
+                # 超时取消时也要关闭上游连接、归还副本名额
+                await stream.aclose()
+        finally:
+            scheduler.release(time.monotonic() - self._generation_started)
+
+    def _finish(self, status: str, error: Optional[str] = None) -> None:
+        now = time.monotonic()
+        stats = self.stats
+        stats["status"] = status
+        stats["error"] = error
+        stats["total_time"] = round(now - self.started, 3)
+        if self._generation_started is not None:
+            stats["generation_time"] = round(now - self._generation_started, 3)
+        stats["prompt_tokens"] = self.usage.get("prompt_tokens")
+        # 没有usage时（例如超时中断）按收到的内容块数估算
+        stats["completion_tokens"] = self.usage.get("completion_tokens", len(self.chunks))
+        decode_time = (stats["generation_time"] or 0) - (stats["first_token_latency"] or 0)
+        if stats["completion_tokens"] and decode_time > 0:
+            stats["tokens_per_second"] = round(stats["completion_tokens"] / decode_time, 2)
+        event = {"type": status, "content": "".join(self.chunks), "stats": stats}
+        if error:
+            event["error"] = error
+        self._emit(event)
+
+    async def run(self, deadline: float) -> None:
+        """执行请求，无论结果如何都输出且只输出一个结束事件"""
+        try:
+            await asyncio.wait_for(self._stream(), timeout=deadline)
+            self._finish("done")
+        except asyncio.TimeoutError:
+            logger.warning(f"对比请求超时: 任务={self.task.id}, 截止时间={deadline}秒")
+            self._finish("timeout", f"超过截止时间 {deadline:g} 秒")
+        except scheduler_utils.SchedulerBusy as e:
+            self._finish("error", e.message)
+        except gateway_utils.GatewayError as e:
+            self._finish("error", e.message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"对比请求失败: 任务={self.task.id}, 错误={str(e)}")
+            self._finish("error", str(e))
+
+async def compare(tasks: List[InferenceTask], messages: List[Dict[str, Any]], params: Dict[str, Any],
+                  client_key: str, deadline: float = COMPARE_DEADLINE,
+                  user_id: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+    """并发请求多个模型，按到达顺序产出事件，最后产出汇总
+
+    事件类型：start、status、delta（增量内容）、done / error / timeout（每个模型一个，附带统计）、summary。
+    调用方停止迭代（例如客户端断开）时取消所有未完成的请求。
+    """
+    events: asyncio.Queue = asyncio.Queue()
+    runs = [_ModelRun(task, build_payload(task, messages, params), client_key, events, user_id) for task in tasks]
+    started = time.monotonic()
+    yield {
+        "type": "start",
+        "deadline": deadline,
+        "tasks": [{"task_id": run.task.id, "model_name": run.stats["model_name"]} for run in runs]
+    }
+    workers = [asyncio.create_task(run.run(deadline)) for run in runs]
+    try:
+        remaining = len(runs)
+        while remaining:
+            event = await events.get()
+            if event["type"] in TERMINAL_EVENTS:
+                remaining -= 1
+            yield event
+        results = [run.stats for run in runs]
+        finished = [r["total_time"] for r in results if r["total_time"] is not None]
+        yield {
+            "type": "summary",
+            "wall_time": round(time.monotonic() - started, 3),
+            "sequential_time": round(sum(finished), 3),
+            "results": results
+        }
+    finally:
+        for worker in workers:
+            worker.cancel()
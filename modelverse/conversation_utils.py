@@ -0,0 +1,187 @@
+"""
+服务端会话存储
+会话的完整消息列表压缩后存入数据库，客户端只需提交新消息，断线重连后凭会话ID恢复历史。
+发送给模型的上下文由按会话缓存的ChatHistory维护（按token预算裁剪或摘要），
+每轮只统计新消息的token数；缓存失效时从存储的消息重建
+"""
+
+import os
+import json
+import zlib
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, List, Tuple
+
+from database import (
+    create_conversation, get_conversation, update_conversation_messages,
+    delete_conversation, delete_stale_conversations
+)
+import history_utils
+
+logger = logging.getLogger(__name__)
+
+# 会话配置
+CONVERSATION_MAX_MESSAGES = int(os.environ.get("CONVERSATION_MAX_MESSAGES", "1000"))
+CONVERSATION_CACHE_SIZE = int(os.environ.get("CONVERSATION_CACHE_SIZE", "256"))
+# 匿名会话（访问共享任务）的保留天数
+ANONYMOUS_CONVERSATION_DAYS = int(os.environ.get("ANONYMOUS_CONVERSATION_DAYS", "7"))
+CONVERSATION_CLEANUP_INTERVAL = float(os.environ.get("CONVERSATION_CLEANUP_INTERVAL", "3600"))
+TITLE_LENGTH = 40
+
+def pack_messages(messages: List[Dict[str, Any]]) -> bytes:
+    """紧凑JSON + zlib压缩"""
+    encoded = json.dumps(messages, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return zlib.compress(encoded, 6)
+
+def unpack_messages(blob: Optional[bytes]) -> List[Dict[str, Any]]:
+    if not blob:
+        return []
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+def _title_from(messages: List[Dict[str, Any]]) -> Optional[str]:
+    first = next((m.get("content") or "" for m in messages if m.get("role") == "user"), "")
+    first = first.strip().replace("\n", " ")
+    return first[:TITLE_LENGTH] or None
+
+def session_key(conversation_id: str) -> str:
+    """会话的路由粘滞标识，重连后仍路由到持有该会话前缀缓存的副本"""
+    return f"conv:{conversation_id}"
+
+def can_access(conversation: Dict[str, Any], user: Any) -> bool:
+    """登录用户的会话只有本人和管理员可访问；匿名会话凭会话ID访问"""
+    if conversation.get("user_id") is None:
+        return True
+    return user is not None and (user.is_admin or user.id == conversation["user_id"])
+
+class ConversationStore:
+    """会话存储：数据库中的压缩消息列表 + 内存中按LRU缓存的上下文"""
+
+    def __init__(self, cache_size: int = CONVERSATION_CACHE_SIZE):
+        self.cache_size = cache_size
+        # 会话ID -> (预算参数, ChatHistory)
+        self._histories: "OrderedDict[str, Tuple[Tuple[int, int], history_utils.ChatHistory]]" = OrderedDict()
+        # 会话ID -> {"lock": 锁, "users": 持有和等待的数量}，没有使用者时移除
+        self._locks: Dict[str, Dict[str, Any]] = {}
+
+    def create(self, task: Any, user_id: Optional[int], messages: Optional[List[Dict[str, Any]]] = None,
+               title: Optional[str] = None) -> Dict[str, Any]:
+        messages = list(messages or [])
+        conversation_id = uuid.uuid4().hex
+        conversation = create_conversation(
+            conversation_id, task.id, user_id, title or _title_from(messages),
+            pack_messages(messages), len(messages)
+        )
+        logger.info(f"已创建会话: {conversation_id}, 任务={task.id}, 用户={user_id}")
+        return conversation
+
+    def get(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """获取会话，消息已解压"""
+        conversation = get_conversation(conversation_id)
+        if conversation:
+            conversation["messages"] = unpack_messages(conversation["messages"])
+        return conversation
+
+    async def acquire(self, conversation_id: str) -> None:
+        """获取会话锁，同一会话的各轮对话依次处理；必须与release配对"""
+        entry = self._locks.get(conversation_id)
+        if entry is None:
+            entry = self._locks[conversation_id] = {"lock": asyncio.Lock(), "users": 0}
+        entry["users"] += 1
+        try:
+            await entry["lock"].acquire()
+        except BaseException:
+            self._leave(conversation_id, entry)
+            raise
+
+    def release(self, conversation_id: str) -> None:
+        """释放会话锁，没有其他持有者和等待者时移除锁"""
+        entry = self._locks.get(conversation_id)
+        if entry is None:
+            return
+        entry["lock"].release()
+        self._leave(conversation_id, entry)
+
+    def _leave(self, conversation_id: str, entry: Dict[str, Any]) -> None:
+        entry["users"] -= 1
+        if entry["users"] <= 0 and self._locks.get(conversation_id) is entry:
+            del self._locks[conversation_id]
+
+    @asynccontextmanager
+    async def lock(self, conversation_id: str):
+        """async with形式的会话锁"""
+        await self.acquire(conversation_id)
+        try:
+            yield
+        finally:
+            self.release(conversation_id)
+
+    async def history(self, conversation_id: str, task: Any) -> history_utils.ChatHistory:
+        """获取会话发送给模型的上下文；缓存未命中或任务的长度设置变化时从存储的消息重建"""
+        from inference_utils import get_model_path
+
+        budget_key = (task.max_model_len, task.max_tokens)
+        cached = self._histories.get(conversation_id)
+        if cached and cached[0] == budget_key:
+            self._histories.move_to_end(conversation_id)
+            return cached[1]
+        conversation = self.get(conversation_id)
+        history = await history_utils.create_chat_history(task, get_model_path(task.model_id))
+        for message in (conversation or {}).get("messages", []):
+            history.append(message)
+        history.fit()
+        self._histories[conversation_id] = (budget_key, history)
+        while len(self._histories) > self.cache_size:
+            self._histories.popitem(last=False)
+        return history
+
+    def evict(self, conversation_id: str) -> None:
+        """丢弃缓存的上下文（例如推理失败后上下文与存储不一致），下次使用时从存储重建"""
+        self._histories.pop(conversation_id, None)
+
+    def append(self, conversation_id: str, new_messages: List[Dict[str, Any]]) -> int:
+        """把一轮对话的新消息追加到存储，超出上限时丢弃最早的非系统消息；返回存储的消息数"""
+        conversation = self.get(conversation_id)
+        if not conversation:
+            return 0
+        messages = conversation["messages"] + [{"role": m["role"], "content": m["content"]} for m in new_messages]
+        overflow = len(messages) - CONVERSATION_MAX_MESSAGES
+        if overflow > 0:
+            system = [m for m in messages if m.get("role") == "system"]
+            others = [m for m in messages if m.get("role") != "system"]
+            messages = system + others[overflow:]
+        update_conversation_messages(conversation_id, pack_messages(messages), len(messages), _title_from(messages))
+        return len(messages)
+
+    def clear(self, conversation_id: str) -> None:
+        """清空会话中的非系统消息"""
+        conversation = self.get(conversation_id)
+        if conversation:
+            messages = [m for m in conversation["messages"] if m.get("role") == "system"]
+            update_conversation_messages(conversation_id, pack_messages(messages), len(messages))
+        self.evict(conversation_id)
+
+    def delete(self, conversation_id: str) -> bool:
+        self.evict(conversation_id)
+        return delete_conversation(conversation_id)
+
+    def cleanup(self, days: int = ANONYMOUS_CONVERSATION_DAYS) -> int:
+        """删除过期的匿名会话"""
+        deleted = delete_stale_conversations(days)
+        if deleted:
+            logger.info(f"已删除 {deleted} 个超过 {days} 天未使用的匿名会话")
+        return deleted
+
+    async def run_cleanup(self, interval: float = CONVERSATION_CLEANUP_INTERVAL) -> None:
+        """后台定期清理过期的匿名会话"""
+        while True:
+            try:
+                await asyncio.to_thread(self.cleanup)
+            except Exception as e:
+                logger.error(f"清理过期会话失败: {str(e)}")
+            await asyncio.sleep(interval)
+
+# 全局会话存储
+conversation_store = ConversationStore()
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+CPU推理引擎
+在没有GPU的节点上用transformers运行小模型，提供与vLLM相同的OpenAI兼容接口
+（/v1/models、/v1/chat/completions、/v1/completions），管理服务按相同的方式启动、健康检查、路由和监督。
+
+- 线性层使用int8动态量化，降低内存占用并加快CPU上的矩阵乘
+- 每个会话（请求头 X-Session-ID）保留一份KV缓存，下一轮只需计算新增的token；
+  没有会话标识时按最长公共前缀复用其他请求留下的KV缓存
+- 并发请求各自完成预填充后合并为一个批次逐token解码（KV缓存左侧填充，用attention mask屏蔽填充位置）
+
+用法：
+    python -m cpu_engine --model <模型目录> --port 8000 --served-model-name <名称> --max-model-len 2048
+"""
+
+import json
+import time
+import uuid
+import queue
+import asyncio
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple
+
+import torch
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+logger = logging.getLogger("cpu_engine")
+
+SESSION_HEADER = "x-session-id"
+# 复用其他会话留下的KV缓存所需的最短公共前缀（token）
+MIN_SHARED_PREFIX = 16
+
+# ========== KV缓存 ==========
+# 引擎内部统一使用 ((key, value), ...) 形式的缓存，每层张量形状为 [batch, heads, seq_len, head_dim]
+
+def _to_legacy(cache: Any) -> Optional[Tuple]:
+    if cache is None or isinstance(cache, tuple):
+        return cache
+    if hasattr(cache, "to_legacy_cache"):
+        return cache.to_legacy_cache()
+    if hasattr(cache, "layers"):
+        return tuple((layer.keys, layer.values) for layer in cache.layers)
+    return tuple(zip(cache.key_cache, cache.value_cache))
+
+def _to_model_cache(legacy: Optional[Tuple]) -> Any:
+    if legacy is None:
+        return None
+    if DynamicCache is not None and hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(legacy)
+    return legacy
+
+def _crop(legacy: Tuple, length: int) -> Tuple:
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in legacy)
+
+def _common_prefix(a: List[int], b: List[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+class Sequence:
+    """一个生成请求的状态，由引擎线程推进，输出通过asyncio队列交给HTTP处理协程"""
+
+    def __init__(self, prompt_ids: List[int], params: Dict[str, Any], session_key: str,
+                 loop: asyncio.AbstractEventLoop):
+        self.prompt_ids = prompt_ids
+        self.params = params
+        self.session_key = session_key
+        self.loop = loop
+        self.output: asyncio.Queue = asyncio.Queue()
+        self.generated: List[int] = []
+        self.cache: Optional[Tuple] = None
+        self.cache_ids: List[int] = []  # 已写入KV缓存的token
+        self.next_token: Optional[int] = None
+        self.text = ""
+        self.cached_tokens = 0
+        self.finish_reason: Optional[str] = None
+        self.cancelled = False
+
+    def emit(self, kind: str, data: Any) -> None:
+        self.loop.call_soon_threadsafe(self.output.put_nowait, (kind, data))
+
+    def usage(self) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": len(self.prompt_ids),
+            "completion_tokens": len(self.generated),
+            "total_tokens": len(self.prompt_ids) + len(self.generated),
+            "prompt_tokens_details": {"cached_tokens": self.cached_tokens}
+        }
+
+class CPUEngine:
+    """在后台线程中运行的批量生成循环"""
+
+    def __init__(self, model_path: str, max_model_len: int, max_batch_size: int = 8,
+                 session_cache_size: int = 32, quantize: bool = True, threads: int = 0):
+        if threads > 0:
+            torch.set_num_threads(threads)
+        logger.info(f"开始加载模型权重: {model_path}")
+        started = time.time()
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path, torch_dtype=torch.float32, trust_remote_code=True, low_cpu_mem_usage=True
+        )
+        model.eval()
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+        logger.info(f"模型权重加载完成，耗时 {time.time() - started:.1f} 秒，int8动态量化={'开启' if quantize else '关闭'}")
+
+        limit = getattr(model.config, "max_position_embeddings", None)
+        self.max_model_len = min(max_model_len, limit) if limit else max_model_len
+        self.max_batch_size = max(1, max_batch_size)
+        self.session_cache_size = max(0, session_cache_size)
+
+        eos = getattr(getattr(model, "generation_config", None), "eos_token_id", None)
+        eos = eos if isinstance(eos, list) else [eos]
+        self.eos_ids = {i for i in eos + [self.tokenizer.eos_token_id] if i is not None}
+
+        self._pending: "queue.Queue[Sequence]" = queue.Queue()
+        self._active: List[Sequence] = []
+        # 会话标识 -> (缓存中的token, KV缓存)
+        self._sessions: "OrderedDict[str, Tuple[List[int], Tuple]]" = OrderedDict()
+        self._thread = threading.Thread(target=self._run, name="cpu-engine", daemon=True)
+        self._thread.start()
+
+    # ---------- 请求 ----------
+
+    def chat_prompt(self, messages: List[Dict[str, Any]]) -> List[int]:
+        if getattr(self.tokenizer, "chat_template", None):
+            text = self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            return self.tokenizer.encode(text, add_special_tokens=False)
+        text = "".join(f"{m['role']}: {m.get('content') or ''}\n" for m in messages) + "assistant: "
+        return self.tokenizer.encode(text)
+
+    def completion_prompt(self, prompt: str) -> List[int]:
+        return self.tokenizer.encode(prompt)
+
+    def sampling_params(self, body: Dict[str, Any], prompt_len: int) -> Dict[str, Any]:
+        room = self.max_model_len - prompt_len
+        max_tokens = body.get("max_tokens") or body.get("max_completion_tokens") or room
+        stop = body.get("stop") or []
+        temperature = body.get("temperature")
+        return {
+            "max_tokens": max(1, min(int(max_tokens), room)),
+            "temperature": 1.0 if temperature is None else float(temperature),
+            "top_p": float(body.get("top_p") or 1.0),
+            "top_k": int(body.get("top_k") or 0),
+            "repetition_penalty": float(body.get("repetition_penalty") or 1.0),
+            "stop": [stop] if isinstance(stop, str) else list(stop)
+        }
+
+    def submit(self, prompt_ids: List[int], params: Dict[str, Any], session_key: str) -> Sequence:
+        sequence = Sequence(prompt_ids, params, session_key, asyncio.get_running_loop())
+        self._pending.put(sequence)
+        return sequence
+
+    # ---------- 引擎线程 ----------
+
+    def _run(self) -> None:
+        while True:
+            if not self._active:
+                self._admit(self._pending.get())
+            while len(self._active) < self.max_batch_size:
+                try:
+                    self._admit(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            if not self._active:
+                continue
+            try:
+                self._decode_step()
+            except Exception as e:
+                logger.exception(f"批量解码出错: {str(e)}")
+                for sequence in self._active:
+                    sequence.emit("error", f"生成失败: {str(e)}")
+                self._active = []
+
+    def _admit(self, sequence: Sequence) -> None:
+        if sequence.cancelled:
+            return
+        try:
+            self._prefill(sequence)
+        except Exception as e:
+            logger.exception(f"预填充出错: {str(e)}")
+            sequence.emit("error", f"生成失败: {str(e)}")
+            return
+        if sequence.finish_reason is None:
+            self._active.append(sequence)
+
+    def _lookup(self, sequence: Sequence) -> Tuple[int, Optional[Tuple]]:
+        """查找可以复用的KV缓存：同一会话的缓存任意长度的公共前缀都可复用，其他会话要求足够长的公共前缀"""
+        best_key, best_len = None, 0
+        for key, (ids, _) in self._sessions.items():
+            length = _common_prefix(ids, sequence.prompt_ids)
+            if key != sequence.session_key and length < MIN_SHARED_PREFIX:
+                continue
+            if length > best_len:
+                best_key, best_len = key, length
+        # 至少留一个token参与计算，以得到下一个token的logits
+        best_len = min(best_len, len(sequence.prompt_ids) - 1)
+        if best_key is None or best_len <= 0:
+            return 0, None
+        _, cache = self._sessions[best_key]
+        return best_len, _crop(cache, best_len)
+
+    def _store_session(self, sequence: Sequence) -> None:
+        if self.session_cache_size <= 0 or sequence.cache is None:
+            return
+        # 复制出独立的张量，不再引用批次解码时的整块缓存
+        cache = tuple((k.clone(), v.clone()) for k, v in sequence.cache)
+        self._sessions[sequence.session_key] = (sequence.cache_ids, cache)
+        self._sessions.move_to_end(sequence.session_key)
+        while len(self._sessions) > self.session_cache_size:
+            self._sessions.popitem(last=False)
+
+    @torch.inference_mode()
+    def _prefill(self, sequence: Sequence) -> None:
+        prefix_len, cache = self._lookup(sequence)
+        total = len(sequence.prompt_ids)
+        outputs = self.model(
+            input_ids=torch.tensor([sequence.prompt_ids[prefix_len:]]),
+            attention_mask=torch.ones(1, total, dtype=torch.long),
+            position_ids=torch.arange(prefix_len, total).unsqueeze(0),
+            past_key_values=_to_model_cache(cache),
+            use_cache=True
+        )
+        sequence.cache = _to_legacy(outputs.past_key_values)
+        sequence.cache_ids = list(sequence.prompt_ids)
+        sequence.cached_tokens = prefix_len
+        self._accept(sequence, self._sample(outputs.logits[0, -1], sequence))
+
+    @torch.inference_mode()
+    def _decode_step(self) -> None:
+        """所有活跃请求合并为一个批次前进一个token"""
+        batch = self._active
+        lengths = [len(s.cache_ids) for s in batch]
+        max_len = max(lengths)
+        layers = []
+        for layer in range(len(batch[0].cache)):
+            keys, values = [], []
+            for sequence, length in zip(batch, lengths):
+                k, v = sequence.cache[layer]
+                if length < max_len:
+                    k = torch.nn.functional.pad(k, (0, 0, max_len - length, 0))
+                    v = torch.nn.functional.pad(v, (0, 0, max_len - length, 0))
+                keys.append(k)
+                values.append(v)
+            layers.append((torch.cat(keys), torch.cat(values)))
+
+        attention_mask = torch.zeros(len(batch), max_len + 1, dtype=torch.long)
+        for i, length in enumerate(lengths):
+            attention_mask[i, max_len - length:] = 1
+        outputs = self.model(
+            input_ids=torch.tensor([[s.next_token] for s in batch]),
+            attention_mask=attention_mask,
+            position_ids=torch.tensor([[length] for length in lengths]),
+            past_key_values=_to_model_cache(tuple(layers)),
+            use_cache=True
+        )
+        cache = _to_legacy(outputs.past_key_values)
+        for i, (sequence, length) in enumerate(zip(batch, lengths)):
+            start = max_len - length
+            sequence.cache = tuple((k[i:i + 1, :, start:], v[i:i + 1, :, start:]) for k, v in cache)
+            sequence.cache_ids.append(sequence.next_token)
+            self._accept(sequence, self._sample(outputs.logits[i, -1], sequence))
+        self._active = [s for s in batch if s.finish_reason is None]
+
+    def _sample(self, logits: torch.Tensor, sequence: Sequence) -> int:
+        params = sequence.params
+        logits = logits.float().clone()
+        penalty = params["repetition_penalty"]
+        if penalty != 1.0:
+            ids = torch.tensor(sorted(set(sequence.prompt_ids) | set(sequence.generated)))
+            scores = logits[ids]
+            logits[ids] = torch.where(scores > 0, scores / penalty, scores * penalty)
+        if params["temperature"] <= 0:
+            return int(torch.argmax(logits))
+        logits = logits / params["temperature"]
+        if params["top_k"] > 0:
+            kth = torch.topk(logits, min(params["top_k"], logits.size(-1))).values[-1]
+            logits[logits < kth] = float("-inf")
+        if params["top_p"] < 1.0:
+            sorted_logits, indices = torch.sort(logits, descending=True)
+            probs = torch.softmax(sorted_logits, dim=-1)
+            sorted_logits[torch.cumsum(probs, dim=-1) - probs > params["top_p"]] = float("-inf")
+            logits = torch.full_like(logits, float("-inf")).scatter(0, indices, sorted_logits)
+        return int(torch.multinomial(torch.softmax(logits, dim=-1), 1))
+
+    def _accept(self, sequence: Sequence, token: int) -> None:
+        """接收新生成的token，输出新增文本并判断是否结束"""
+        sequence.generated.append(token)
+        sequence.next_token = token
+        reason = None
+        if token in self.eos_ids:
+            reason = "stop"
+        else:
+            text = self.tokenizer.decode(sequence.generated, skip_special_tokens=True)
+            for stop in sequence.params["stop"]:
+                index = text.find(stop)
+                if stop and index != -1:
+                    text, reason = text[:index], "stop"
+                    break
+            # 多字节字符未生成完整时暂不输出
+            if reason or not text.endswith("\ufffd"):
+                delta = text[len(sequence.text):]
+                if delta:
+                    sequence.text = text
+                    sequence.emit("delta", delta)
+        if reason is None:
+            if len(sequence.generated) >= sequence.params["max_tokens"] or len(sequence.cache_ids) + 1 >= self.max_model_len:
+                reason = "length"
+            elif sequence.cancelled:
+                reason = "abort"
+        if reason:
+            sequence.finish_reason = reason
+            self._store_session(sequence)
+            sequence.emit("done", reason)
+
+# ========== OpenAI兼容接口 ==========
+
+def _error(status: int, message: str, error_type: str = "invalid_request_error") -> JSONResponse:
+    return JSONResponse(status_code=status, content={
+        "object": "error", "message": message, "type": error_type, "code": status
+    })
+
+def create_app(engine: CPUEngine, served_model_name: str) -> FastAPI:
+    app = FastAPI(title="ModelVerse CPU Engine")
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{
+            "id": served_model_name,
+            "object": "model",
+            "created": int(time.time()),
+            "owned_by": "modelverse",
+            "max_model_len": engine.max_model_len
+        }]}
+
+    async def generate(request: Request, chat: bool):
+        try:
+            body = await request.json()
+            prompt_ids = engine.chat_prompt(body["messages"]) if chat else engine.completion_prompt(body["prompt"])
+        except (KeyError, TypeError, ValueError) as e:
+            return _error(400, f"请求格式错误: {str(e)}")
+        if len(prompt_ids) >= engine.max_model_len:
+            return _error(400, f"输入长度 {len(prompt_ids)} 超过模型上下文长度 {engine.max_model_len}")
+
+        request_id = f"{'chatcmpl' if chat else 'cmpl'}-{uuid.uuid4().hex}"
+        created = int(time.time())
+        session_key = request.headers.get(SESSION_HEADER) or f"request:{request_id}"
+        sequence = engine.submit(prompt_ids, engine.sampling_params(body, len(prompt_ids)), session_key)
+
+        def chunk(delta: Optional[str], finish_reason: Optional[str] = None, first: bool = False) -> Dict[str, Any]:
+            if chat:
+                content = {"role": "assistant", "content": delta or ""} if first else ({"content": delta} if delta else {})
+                choice = {"index": 0, "delta": content, "finish_reason": finish_reason}
+            else:
+                choice = {"index": 0, "text": delta or "", "finish_reason": finish_reason}
+            return {"id": request_id, "object": "chat.completion.chunk" if chat else "text_completion",
+                    "created": created, "model": served_model_name, "choices": [choice]}
+
+        if body.get("stream"):
+            include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+            async def events():
+                try:
+                    if chat:
+                        yield f"data: {json.dumps(chunk(None, first=True), ensure_ascii=False)}\n\n"
+                    while True:
+                        kind, data = await sequence.output.get()
+                        if kind == "delta":
+                            yield f"data: {json.dumps(chunk(data), ensure_ascii=False)}\n\n"
+                        elif kind == "error":
+                            error = {"error": {"message": data, "type": "server_error", "code": 500}}
+                            yield f"data: {json.dumps(error, ensure_ascii=False)}\n\n"
+                            break
+                        else:
+                            yield f"data: {json.dumps(chunk(None, data), ensure_ascii=False)}\n\n"
+                            if include_usage:
+                                usage = {"id": request_id, "object": "chat.completion.chunk" if chat else "text_completion",
+                                         "created": created, "model": served_model_name, "choices": [],
+                                         "usage": sequence.usage()}
+                                yield f"data: {json.dumps(usage, ensure_ascii=False)}\n\n"
+                            break
+                    yield "data: [DONE]\n\n"
+                finally:
+                    # 客户端断开时停止生成
+                    sequence.cancelled = True
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        try:
+            while True:
+                kind, data = await sequence.output.get()
+                if kind == "error":
+                    return _error(500, data, "server_error")
+                if kind == "done":
+                    break
+        finally:
+            sequence.cancelled = True
+        if chat:
+            choice = {"index": 0, "message": {"role": "assistant", "content": sequence.text}, "finish_reason": data}
+        else:
+            choice = {"index": 0, "text": sequence.text, "finish_reason": data}
+        return {"id": request_id, "object": "chat.completion" if chat else "text_completion", "created": created,
+                "model": served_model_name, "choices": [choice], "usage": sequence.usage()}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        return await generate(request, chat=True)
+
+    @app.post("/v1/completions")
+    async def completions(request: Request):
+        return await generate(request, chat=False)
+
+    return app
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="ModelVerse CPU推理引擎（OpenAI兼容接口）")
+    parser.add_argument("--model", required=True, help="模型目录")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--served-model-name", default=None)
+    parser.add_argument("--max-model-len", type=int, default=2048)
+    parser.add_argument("--max-batch-size", type=int, default=8, help="同时解码的请求数上限")
+    parser.add_argument("--session-cache", type=int, default=32, help="保留KV缓存的会话数")
+    parser.add_argument("--threads", type=int, default=0, help="PyTorch计算线程数，0表示使用默认值")
+    parser.add_argument("--no-quantize", action="store_true", help="不使用int8动态量化")
+    return parser.parse_args(argv)
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    args = parse_args()
+    engine = CPUEngine(
+        args.model,
+        max_model_len=args.max_model_len,
+        max_batch_size=args.max_batch_size,
+        session_cache_size=args.session_cache,
+        quantize=not args.no_quantize,
+        threads=args.threads
+    )
+    app = create_app(engine, args.served_model_name or args.model)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
+
+if __name__ == "__main__":
+    main()
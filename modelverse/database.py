@@ -12,7 +12,7 @@ from models import (
     User, UserCreate, UserInDB, ProfileUpdate, 
     Resource, ResourceCreate, ResourceType, DownloadStatus, 
     TrainingTask, TrainingTaskCreate, TrainingStatus, TrainingLogEntry,
-    InferenceTask, InferenceStatus,
+    InferenceTask, InferenceStatus, BatchJob, BatchJobStatus,
     EvaluationTask, EvaluationTaskCreate, EvaluationStatus, EvaluationMetrics, EvaluationLogEntry
 )
 
@@ -119,6 +119,18 @@ def init_db():
         max_model_len INTEGER DEFAULT 4096,
         quantization TEXT,
         dtype TEXT DEFAULT 'auto',
+        gpu_memory_utilization REAL DEFAULT 0.85,
+        engine_profile TEXT DEFAULT 'throughput',
+        engine TEXT DEFAULT 'vllm',
+        replicas INTEGER DEFAULT 1,
+        idle_timeout INTEGER DEFAULT 0,
+        enable_lora BOOLEAN DEFAULT 0,
+        max_loras INTEGER DEFAULT 10,
+        max_lora_rank INTEGER DEFAULT 16,
+        base_task_id INTEGER,
+        adapter_path TEXT,
+        response_cache BOOLEAN DEFAULT 0,
+        max_in_flight INTEGER DEFAULT 0,
         max_tokens INTEGER DEFAULT 2048,
         temperature REAL DEFAULT 0.7,
         top_p REAL DEFAULT 0.9,
@@ -170,6 +182,111 @@ def init_db():
     )
     ''')
     
+    # 创建批量推理任务表
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS batch_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        task_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        concurrency INTEGER DEFAULT 32,
+        input_path TEXT NOT NULL,
+        output_path TEXT NOT NULL,
+        total INTEGER DEFAULT 0,
+        completed INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        prompt_tokens INTEGER DEFAULT 0,
+        completion_tokens INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        completed_at TIMESTAMP,
+        error_message TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (id),
+        FOREIGN KEY (task_id) REFERENCES inference_tasks (id)
+    )
+    ''')
+    
+    # 创建推理进程表（记录引擎进程，服务重启后据此重新接管）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS inference_processes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id INTEGER NOT NULL,
+        replica INTEGER NOT NULL DEFAULT 0,
+        pid INTEGER NOT NULL,
+        port INTEGER NOT NULL,
+        gpu_devices TEXT,
+        gpu_memory REAL DEFAULT 0,
+        gpu_memory_per_device REAL DEFAULT 0,
+        command TEXT,
+        process_created_at REAL,
+        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (task_id, replica),
+        FOREIGN KEY (task_id) REFERENCES inference_tasks (id)
+    )
+    ''')
+    
+    # 创建推理服务启动记录表（每次副本启动的阶段耗时）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS inference_startups (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id INTEGER NOT NULL,
+        model_id INTEGER,
+        replica INTEGER DEFAULT 0,
+        success BOOLEAN DEFAULT 0,
+        prewarmed BOOLEAN DEFAULT 0,
+        total_seconds REAL,
+        phases TEXT,
+        engine TEXT,
+        error_message TEXT,
+        started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (task_id) REFERENCES inference_tasks (id)
+    )
+    ''')
+    
+    # 创建会话表（消息列表压缩后存储）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS conversations (
+        id TEXT PRIMARY KEY,
+        task_id INTEGER NOT NULL,
+        user_id INTEGER,
+        title TEXT,
+        message_count INTEGER DEFAULT 0,
+        messages BLOB,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (task_id) REFERENCES inference_tasks (id),
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+    
+    # 创建token用量表（按用户、任务、时间桶聚合；user_id为0表示匿名访问）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS inference_usage (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL DEFAULT 0,
+        task_id INTEGER NOT NULL,
+        bucket_start INTEGER NOT NULL,
+        requests INTEGER DEFAULT 0,
+        errors INTEGER DEFAULT 0,
+        prompt_tokens INTEGER DEFAULT 0,
+        completion_tokens INTEGER DEFAULT 0,
+        gpu_seconds REAL DEFAULT 0,
+        UNIQUE(user_id, task_id, bucket_start)
+    )
+    ''')
+    
+    # 创建用量配额表（未配置的用户使用默认配额）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS usage_quotas (
+        user_id INTEGER PRIMARY KEY,
+        daily_tokens INTEGER,
+        daily_requests INTEGER,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+    
     # 创建活跃下载任务表
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS active_downloads (
@@ -181,6 +298,27 @@ def init_db():
     )
     ''')
     
+    # 为已有数据库补充新增的列
+    _ensure_columns(cursor, "inference_tasks", {
+        "gpu_devices": "TEXT",
+        "gpu_memory_utilization": "REAL DEFAULT 0.85",
+        "engine_profile": "TEXT DEFAULT 'throughput'",
+        "engine": "TEXT DEFAULT 'vllm'",
+        "replicas": "INTEGER DEFAULT 1",
+        "idle_timeout": "INTEGER DEFAULT 0",
+        "enable_lora": "BOOLEAN DEFAULT 0",
+        "max_loras": "INTEGER DEFAULT 10",
+        "max_lora_rank": "INTEGER DEFAULT 16",
+        "base_task_id": "INTEGER",
+        "adapter_path": "TEXT",
+        "response_cache": "BOOLEAN DEFAULT 0",
+        "max_in_flight": "INTEGER DEFAULT 0",
+    })
+    
+    # API网关每个请求都按模型名查找任务
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inference_tasks_name ON inference_tasks (name)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inference_tasks_display_name ON inference_tasks (display_name)')
+    
     conn.commit()
     
     # 创建默认管理员用户（如果不存在）
@@ -195,6 +333,14 @@ def init_db():
     
     conn.close()
 
+def _ensure_columns(cursor, table: str, columns: Dict[str, str]):
+    """为已存在的表补充缺失的列（SQLite不支持ADD COLUMN IF NOT EXISTS）"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row["name"] for row in cursor.fetchall()}
+    for name, ddl in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+
 # 密码相关函数
 def verify_password(plain_password, hashed_password):
     """验证密码"""
@@ -674,6 +820,17 @@ def create_inference_task(
     max_model_len: int = 4096,
     quantization: Optional[str] = None,
     dtype: str = "auto",
+    engine_profile: str = "throughput",
+    engine: str = "vllm",
+    replicas: int = 1,
+    idle_timeout: int = 0,
+    enable_lora: bool = False,
+    max_loras: int = 10,
+    max_lora_rank: int = 16,
+    base_task_id: Optional[int] = None,
+    adapter_path: Optional[str] = None,
+    response_cache: bool = False,
+    max_in_flight: int = 0,
     max_tokens: int = 2048,
     temperature: float = 0.7,
     top_p: float = 0.9,
@@ -689,14 +846,16 @@ def create_inference_task(
     cursor.execute('''
     INSERT INTO inference_tasks (
         name, model_id, user_id, status, share_enabled, display_name,
-        tensor_parallel_size, max_model_len, quantization, dtype,
-        max_tokens, temperature, top_p, top_k, repetition_penalty,
+        tensor_parallel_size, max_model_len, quantization, dtype, engine_profile, engine, replicas,
+        idle_timeout, enable_lora, max_loras, max_lora_rank, base_task_id, adapter_path,
+        response_cache, max_in_flight, max_tokens, temperature, top_p, top_k, repetition_penalty,
         presence_penalty, frequency_penalty
-    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     ''', (
         name, model_id, user_id, InferenceStatus.CREATING, share_enabled, display_name,
-        tensor_parallel_size, max_model_len, quantization, dtype,
-        max_tokens, temperature, top_p, top_k, repetition_penalty,
+        tensor_parallel_size, max_model_len, quantization, dtype, engine_profile, engine, replicas,
+        idle_timeout, enable_lora, max_loras, max_lora_rank, base_task_id, adapter_path,
+        response_cache, max_in_flight, max_tokens, temperature, top_p, top_k, repetition_penalty,
         presence_penalty, frequency_penalty
     ))
     
@@ -736,22 +895,33 @@ def get_all_inference_tasks() -> List[InferenceTask]:
     
     return [InferenceTask(**dict(task)) for task in tasks_data]
 
-def get_user_inference_tasks(user_id: int) -> List[InferenceTask]:
-    """获取用户推理任务"""
+def get_inference_tasks_by_name(name: str) -> List[InferenceTask]:
+    """获取任务名或显示名称等于name的推理任务"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('SELECT * FROM inference_tasks WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
+    cursor.execute('SELECT * FROM inference_tasks WHERE name = ? OR display_name = ?', (name, name))
     tasks_data = cursor.fetchall()
     conn.close()
     
     return [InferenceTask(**dict(task)) for task in tasks_data]
 
-def update_inference_task(task_id: int, **kwargs) -> Optional[InferenceTask]:
-    """更新推理任务"""
+def get_user_inference_tasks(user_id: int) -> List[InferenceTask]:
+    """获取用户推理任务"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
+    cursor.execute('SELECT * FROM inference_tasks WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
+    tasks_data = cursor.fetchall()
+    conn.close()
+    
+    return [InferenceTask(**dict(task)) for task in tasks_data]
+
+def update_inference_task(task_id: int, clear: Optional[List[str]] = None, **kwargs) -> Optional[InferenceTask]:
+    """更新推理任务
+
+    值为None的字段不会更新；需要置空的字段（例如恢复后清除error_message）通过clear传入字段名。
+    """
     # 构建更新字段
     update_fields = []
     params = []
@@ -760,10 +930,15 @@ def update_inference_task(task_id: int, **kwargs) -> Optional[InferenceTask]:
         if value is not None:
             update_fields.append(f"{key} = ?")
             params.append(value)
+    for key in clear or []:
+        update_fields.append(f"{key} = NULL")
     
     if not update_fields:
         return get_inference_task(task_id)
     
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
     params.append(task_id)
     query = f"UPDATE inference_tasks SET {', '.join(update_fields)} WHERE id = ?"
     
@@ -780,6 +955,98 @@ def delete_inference_task(task_id: int) -> bool:
     
     cursor.execute('DELETE FROM inference_tasks WHERE id = ?', (task_id,))
     deleted = cursor.rowcount > 0
+    cursor.execute('DELETE FROM conversations WHERE task_id = ?', (task_id,))
+    
+    conn.commit()
+    conn.close()
+    
+    return deleted
+
+# 批量推理任务管理函数
+def create_batch_job(name: str, task_id: int, user_id: int, input_path: str, output_path: str,
+                     total: int, concurrency: int = 32) -> BatchJob:
+    """创建批量推理任务"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    INSERT INTO batch_jobs (name, task_id, user_id, status, concurrency, input_path, output_path, total)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (name, task_id, user_id, BatchJobStatus.PENDING, concurrency, input_path, output_path, total))
+    
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    
+    return get_batch_job(job_id)
+
+def get_batch_job(job_id: int) -> Optional[BatchJob]:
+    """获取批量推理任务"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT * FROM batch_jobs WHERE id = ?', (job_id,))
+    job_data = cursor.fetchone()
+    conn.close()
+    
+    if job_data:
+        return BatchJob(**dict(job_data))
+    return None
+
+def get_all_batch_jobs() -> List[BatchJob]:
+    """获取所有批量推理任务"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT * FROM batch_jobs ORDER BY created_at DESC')
+    jobs_data = cursor.fetchall()
+    conn.close()
+    
+    return [BatchJob(**dict(job)) for job in jobs_data]
+
+def get_user_batch_jobs(user_id: int) -> List[BatchJob]:
+    """获取用户的批量推理任务"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT * FROM batch_jobs WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
+    jobs_data = cursor.fetchall()
+    conn.close()
+    
+    return [BatchJob(**dict(job)) for job in jobs_data]
+
+def update_batch_job(job_id: int, **kwargs) -> Optional[BatchJob]:
+    """更新批量推理任务"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    update_fields = []
+    params = []
+    
+    for key, value in kwargs.items():
+        if value is not None:
+            update_fields.append(f"{key} = ?")
+            params.append(value)
+    
+    if not update_fields:
+        return get_batch_job(job_id)
+    
+    params.append(job_id)
+    query = f"UPDATE batch_jobs SET {', '.join(update_fields)} WHERE id = ?"
+    
+    cursor.execute(query, params)
+    conn.commit()
+    conn.close()
+    
+    return get_batch_job(job_id)
+
+def delete_batch_job(job_id: int) -> bool:
+    """删除批量推理任务"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('DELETE FROM batch_jobs WHERE id = ?', (job_id,))
+    deleted = cursor.rowcount > 0
     
     conn.commit()
     conn.close()
@@ -1006,6 +1273,281 @@ def clear_evaluation_logs(task_id: int) -> bool:
     
     return deleted
 
+# 推理进程管理函数
+def register_inference_process(task_id: int, replica: int, pid: int, port: int, gpu_devices: List[int],
+                               gpu_memory: float, gpu_memory_per_device: float, command: str,
+                               process_created_at: Optional[float]) -> None:
+    """记录推理引擎进程（同一任务的同一副本只保留最新记录）"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    INSERT OR REPLACE INTO inference_processes
+    (task_id, replica, pid, port, gpu_devices, gpu_memory, gpu_memory_per_device, command, process_created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (task_id, replica, pid, port, ",".join(str(d) for d in gpu_devices),
+          gpu_memory, gpu_memory_per_device, command, process_created_at))
+    
+    conn.commit()
+    conn.close()
+
+def remove_inference_process(task_id: int, replica: int) -> None:
+    """移除推理引擎进程记录"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('DELETE FROM inference_processes WHERE task_id = ? AND replica = ?', (task_id, replica))
+    conn.commit()
+    conn.close()
+
+def get_inference_processes() -> List[Dict[str, Any]]:
+    """获取所有推理引擎进程记录"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT * FROM inference_processes ORDER BY task_id, replica')
+    processes = cursor.fetchall()
+    conn.close()
+    
+    return [dict(process) for process in processes]
+
+# 推理服务启动记录管理函数
+def create_inference_startup(task_id: int, model_id: Optional[int], replica: int, success: bool, prewarmed: bool,
+                             total_seconds: float, phases: List[Dict[str, Any]], engine: Dict[str, Any],
+                             error_message: Optional[str] = None) -> int:
+    """记录一次推理副本启动的阶段耗时"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    INSERT INTO inference_startups
+    (task_id, model_id, replica, success, prewarmed, total_seconds, phases, engine, error_message)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (task_id, model_id, replica, success, prewarmed, total_seconds,
+          json.dumps(phases, ensure_ascii=False), json.dumps(engine, ensure_ascii=False), error_message))
+    
+    startup_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    
+    return startup_id
+
+def _process_startup_data(startup_data) -> Dict[str, Any]:
+    startup = dict(startup_data)
+    for field in ("phases", "engine"):
+        try:
+            startup[field] = json.loads(startup[field]) if startup.get(field) else ([] if field == "phases" else {})
+        except (json.JSONDecodeError, TypeError):
+            startup[field] = [] if field == "phases" else {}
+    startup["success"] = bool(startup.get("success"))
+    startup["prewarmed"] = bool(startup.get("prewarmed"))
+    return startup
+
+def get_inference_startups(task_id: Optional[int] = None, model_id: Optional[int] = None,
+                           limit: int = 100) -> List[Dict[str, Any]]:
+    """获取推理服务启动记录（按时间倒序）"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    conditions = []
+    params: List[Any] = []
+    if task_id is not None:
+        conditions.append("task_id = ?")
+        params.append(task_id)
+    if model_id is not None:
+        conditions.append("model_id = ?")
+        params.append(model_id)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    params.append(limit)
+    
+    cursor.execute(f'SELECT * FROM inference_startups {where} ORDER BY id DESC LIMIT ?', params)
+    startups = cursor.fetchall()
+    conn.close()
+    
+    return [_process_startup_data(startup) for startup in startups]
+
+# 会话管理函数
+def create_conversation(conversation_id: str, task_id: int, user_id: Optional[int], title: Optional[str],
+                        messages: bytes, message_count: int) -> Dict[str, Any]:
+    """创建会话"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    INSERT INTO conversations (id, task_id, user_id, title, message_count, messages)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ''', (conversation_id, task_id, user_id, title, message_count, messages))
+    
+    conn.commit()
+    conn.close()
+    
+    return get_conversation(conversation_id)
+
+def get_conversation(conversation_id: str) -> Optional[Dict[str, Any]]:
+    """获取会话（包括压缩的消息列表）"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT * FROM conversations WHERE id = ?', (conversation_id,))
+    conversation = cursor.fetchone()
+    conn.close()
+    
+    return dict(conversation) if conversation else None
+
+def get_user_conversations(user_id: int, task_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """获取用户的会话列表（不含消息内容）"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    query = '''
+    SELECT id, task_id, user_id, title, message_count, created_at, updated_at
+    FROM conversations WHERE user_id = ?
+    '''
+    params: List[Any] = [user_id]
+    if task_id is not None:
+        query += ' AND task_id = ?'
+        params.append(task_id)
+    query += ' ORDER BY updated_at DESC'
+    
+    cursor.execute(query, params)
+    conversations = cursor.fetchall()
+    conn.close()
+    
+    return [dict(conversation) for conversation in conversations]
+
+def update_conversation_messages(conversation_id: str, messages: bytes, message_count: int,
+                                 title: Optional[str] = None) -> bool:
+    """保存会话的消息列表"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    UPDATE conversations
+    SET messages = ?, message_count = ?, title = COALESCE(title, ?), updated_at = CURRENT_TIMESTAMP
+    WHERE id = ?
+    ''', (messages, message_count, title, conversation_id))
+    updated = cursor.rowcount > 0
+    
+    conn.commit()
+    conn.close()
+    
+    return updated
+
+def delete_conversation(conversation_id: str) -> bool:
+    """删除会话"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,))
+    deleted = cursor.rowcount > 0
+    
+    conn.commit()
+    conn.close()
+    
+    return deleted
+
+def delete_stale_conversations(days: int, anonymous_only: bool = True) -> int:
+    """删除超过指定天数未更新的会话"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    query = "DELETE FROM conversations WHERE updated_at < datetime('now', ?)"
+    if anonymous_only:
+        query += ' AND user_id IS NULL'
+    cursor.execute(query, (f"-{int(days)} days",))
+    deleted = cursor.rowcount
+    
+    conn.commit()
+    conn.close()
+    
+    return deleted
+
+# token用量管理函数
+def add_inference_usage(rows: List[Tuple[int, int, int, int, int, int, int, float]]) -> None:
+    """批量累加用量：(user_id, task_id, bucket_start, requests, errors, prompt_tokens, completion_tokens, gpu_seconds)"""
+    if not rows:
+        return
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.executemany('''
+    INSERT INTO inference_usage (
+        user_id, task_id, bucket_start, requests, errors, prompt_tokens, completion_tokens, gpu_seconds
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, task_id, bucket_start) DO UPDATE SET
+        requests = requests + excluded.requests,
+        errors = errors + excluded.errors,
+        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+        completion_tokens = completion_tokens + excluded.completion_tokens,
+        gpu_seconds = gpu_seconds + excluded.gpu_seconds
+    ''', rows)
+    
+    conn.commit()
+    conn.close()
+
+def get_inference_usage(start: Optional[int] = None, end: Optional[int] = None,
+                        user_id: Optional[int] = None, task_id: Optional[int] = None,
+                        group_by: str = "bucket") -> List[Dict[str, Any]]:
+    """查询用量，按时间桶、用户或任务汇总；start/end为Unix时间戳（按时间桶起点过滤）"""
+    group_columns = {
+        "bucket": "bucket_start, user_id, task_id",
+        "user": "user_id",
+        "task": "task_id",
+        "user_task": "user_id, task_id",
+    }[group_by]
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    query = f'''
+    SELECT {group_columns}, SUM(requests) AS requests, SUM(errors) AS errors,
+        SUM(prompt_tokens) AS prompt_tokens, SUM(completion_tokens) AS completion_tokens,
+        SUM(gpu_seconds) AS gpu_seconds
+    FROM inference_usage WHERE 1 = 1
+    '''
+    params: List[Any] = []
+    for column, op, value in (("bucket_start", ">=", start), ("bucket_start", "<", end),
+                              ("user_id", "=", user_id), ("task_id", "=", task_id)):
+        if value is not None:
+            query += f' AND {column} {op} ?'
+            params.append(value)
+    query += f' GROUP BY {group_columns} ORDER BY {group_columns}'
+    
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    conn.close()
+    
+    return [dict(row) for row in rows]
+
+def get_usage_quotas() -> Dict[int, Dict[str, Any]]:
+    """获取所有用户的用量配额"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT user_id, daily_tokens, daily_requests, updated_at FROM usage_quotas')
+    quotas = cursor.fetchall()
+    conn.close()
+    
+    return {quota["user_id"]: dict(quota) for quota in quotas}
+
+def set_usage_quota(user_id: int, daily_tokens: Optional[int], daily_requests: Optional[int]) -> None:
+    """设置用户的用量配额，两项都为空时删除配置（恢复默认配额）"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    if daily_tokens is None and daily_requests is None:
+        cursor.execute('DELETE FROM usage_quotas WHERE user_id = ?', (user_id,))
+    else:
+        cursor.execute('''
+        INSERT INTO usage_quotas (user_id, daily_tokens, daily_requests) VALUES (?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            daily_tokens = excluded.daily_tokens,
+            daily_requests = excluded.daily_requests,
+            updated_at = CURRENT_TIMESTAMP
+        ''', (user_id, daily_tokens, daily_requests))
+    
+    conn.commit()
+    conn.close()
+
 # 下载任务管理函数
 def register_download_task(resource_id: int, pid: int) -> int:
     """记录活跃下载任务"""
@@ -19,6 +19,7 @@ import traceback
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from datasets import load_dataset
+import gpu_utils
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -340,8 +341,12 @@ def select_evaluation_method(task: EvaluationTask) -> str:
         # 默认使用MMLU
         return "mmlu"
 
-def run_huggingface_evaluation(task_id: int, model_path: str, output_dir: str, evaluation_method: str = "mmlu", config: dict = None, max_retries=3, retry_delay=2) -> Tuple[bool, str]:
-    """执行HuggingFace评估，包含重试机制和更好的错误处理"""
+def run_huggingface_evaluation(task_id: int, model_path: str, output_dir: str, evaluation_method: str = "mmlu", config: dict = None, max_retries=3, retry_delay=2,
+                               devices: Optional[List[int]] = None) -> Tuple[bool, str]:
+    """执行HuggingFace评估，包含重试机制和更好的错误处理
+
+    devices为显存账本中预留的GPU编号，模型只加载到这些GPU上；空列表表示使用CPU。
+    """
     logger.info(f"开始HuggingFace评估: 任务ID={task_id}, 模型路径={model_path}")
     
     # 导入必要的库
@@ -381,7 +386,7 @@ def run_huggingface_evaluation(task_id: int, model_path: str, output_dir: str, e
         if evaluation_method == "mmlu":
             add_evaluation_log(task_id, f"开始使用HuggingFace数据集进行MMLU评估...")
             # 传递配置参数
-            success, result_path = run_mmlu_evaluation(task_id, model_path, output_dir, cache_dir, config)
+            success, result_path = run_mmlu_evaluation(task_id, model_path, output_dir, cache_dir, config, devices)
             return success, result_path
         else:
             error_msg = f"不支持的评估方法: {evaluation_method}"
@@ -409,8 +414,12 @@ def run_huggingface_evaluation(task_id: int, model_path: str, output_dir: str, e
         
         return False, error_msg
 
-def run_mmlu_evaluation(task_id: int, model_path: str, output_dir: str, cache_dir: str, config: dict = None) -> Tuple[bool, str]:
-    """直接在代码中运行MMLU评估，不创建单独的脚本"""
+def run_mmlu_evaluation(task_id: int, model_path: str, output_dir: str, cache_dir: str, config: dict = None,
+                        devices: Optional[List[int]] = None) -> Tuple[bool, str]:
+    """直接在代码中运行MMLU评估，不创建单独的脚本
+
+    devices见run_huggingface_evaluation；为None时沿用旧行为，使用第一张GPU。
+    """
     try:
         # 导入所需模块
         import random as random_module  # 避免命名冲突
@@ -444,10 +453,13 @@ def run_mmlu_evaluation(task_id: int, model_path: str, output_dir: str, cache_di
         
         # 检查GPU内存并选择合适的配置
         import torch
+        # 模型固定在显存账本预留的GPU上，避免占用账本之外的GPU
+        gpu_index = devices[0] if devices else 0
+        gpu_device_map = {"": f"cuda:{gpu_index}"}
         try:
-            if torch.cuda.is_available():
-                gpu_memory = torch.cuda.get_device_properties(0).total_memory / (1024**3)  # GB
-                add_evaluation_log(task_id, f"检测到GPU内存: {gpu_memory:.1f} GB")
+            if torch.cuda.is_available() and devices != []:
+                gpu_memory = torch.cuda.get_device_properties(gpu_index).total_memory / (1024**3)  # GB
+                add_evaluation_log(task_id, f"使用GPU {gpu_index}，检测到GPU内存: {gpu_memory:.1f} GB")
                 
                 # 根据GPU内存选择加载策略
                 model_kwargs = {
@@ -461,20 +473,20 @@ def run_mmlu_evaluation(task_id: int, model_path: str, output_dir: str, cache_di
                         "torch_dtype": torch.float16,
                         "device_map": "auto",
                         "load_in_8bit": True,  # 8位量化
-                        "max_memory": {0: f"{int(gpu_memory * 0.8)}GB", "cpu": "16GB"}
+                        "max_memory": {gpu_index: f"{int(gpu_memory * 0.8)}GB", "cpu": "16GB"}
                     })
                 elif gpu_memory < 16:  # 8-16GB使用中等优化
                     add_evaluation_log(task_id, "GPU内存中等，使用半精度优化")
                     model_kwargs.update({
                         "torch_dtype": torch.bfloat16,
                         "device_map": "auto",
-                        "max_memory": {0: f"{int(gpu_memory * 0.9)}GB", "cpu": "8GB"}
+                        "max_memory": {gpu_index: f"{int(gpu_memory * 0.9)}GB", "cpu": "8GB"}
                     })
                 else:  # 大于16GB使用标准配置
                     add_evaluation_log(task_id, "GPU内存充足，使用标准配置")
                     model_kwargs.update({
                         "torch_dtype": torch.bfloat16,
-                        "device_map": "auto"
+                        "device_map": gpu_device_map
                     })
             else:
                 add_evaluation_log(task_id, "未检测到GPU，使用CPU模式")
@@ -488,7 +500,7 @@ def run_mmlu_evaluation(task_id: int, model_path: str, output_dir: str, cache_di
             add_evaluation_log(task_id, f"GPU检测失败，使用默认配置: {str(e)}", "WARNING")
             model_kwargs = {
                 "torch_dtype": torch.bfloat16,
-                "device_map": "auto",
+                "device_map": gpu_device_map if devices != [] else "cpu",
                 "trust_remote_code": True
             }
         
@@ -501,7 +513,8 @@ def run_mmlu_evaluation(task_id: int, model_path: str, output_dir: str, cache_di
             
             # 显示GPU内存使用情况
             if torch.cuda.is_available():
-                for i in range(torch.cuda.device_count()):
+                # 只查看预留的GPU，避免在其他GPU上创建CUDA上下文
+                for i in (devices if devices is not None else range(torch.cuda.device_count())):
                     memory_allocated = torch.cuda.memory_allocated(i) / (1024**3)
                     memory_reserved = torch.cuda.memory_reserved(i) / (1024**3)
                     memory_total = torch.cuda.get_device_properties(i).total_memory / (1024**3)
@@ -1219,6 +1232,30 @@ def run_mmlu_evaluation(task_id: int, model_path: str, output_dir: str, cache_di
         add_evaluation_log(task_id, f"错误详情:\n{traceback.format_exc()}", "ERROR")
         return False, error_msg
 
+def reserve_evaluation_memory(task: EvaluationTask) -> List[int]:
+    """按模型权重估算值在显存账本中预留评估所需显存，返回评估应使用的GPU
+
+    没有可用GPU时返回空列表（在CPU上评估）；有GPU但扣除已有预留后放不下时抛出RuntimeError。
+    """
+    import inference_utils
+    
+    snapshot = gpu_utils.get_gpu_snapshot()
+    if not snapshot["available"] or not snapshot["gpus"]:
+        add_evaluation_log(task.id, "未检测到可用GPU，将在CPU上评估", "WARNING")
+        return []
+    estimate = inference_utils.estimate_model_memory_detail(model_id=task.model_id, max_model_len=2048)
+    if not estimate.get("total_gb"):
+        raise RuntimeError("无法估算模型显存占用，未能预留评估所需显存")
+    # 评估在本进程内加载模型，关联本进程PID以便按实测显存对账
+    devices = gpu_utils.gpu_ledger.reserve_placement(
+        f"evaluation:{task.id}", "evaluation", estimate["total_gb"], 1, snapshot["gpus"],
+        pid=os.getpid(), include_children=False
+    )
+    if devices is None:
+        raise RuntimeError(f"GPU显存不足：评估约需 {estimate['total_gb']:.1f}GB，扣除其他任务的占用和预留后没有GPU放得下，请稍后重试")
+    add_evaluation_log(task.id, f"已预留显存: GPU {devices}, 约 {estimate['total_gb']:.1f}GB")
+    return devices
+
 def run_evaluation(task_id: int):
     """
     运行评估任务 - 使用Hugging Face评估
@@ -1291,6 +1328,9 @@ def run_evaluation(task_id: int):
             add_evaluation_log(task_id, f"数据集准备失败: {message}", "WARNING")
             # 即使数据集准备失败，也继续评估，因为评估脚本会自动下载
         
+        # 预留评估所需显存（模型在本进程内加载，固定在预留的GPU上，预留保留到评估结束）
+        devices = reserve_evaluation_memory(task)
+        
         # 使用Hugging Face评估
         add_evaluation_log(task_id, f"使用Hugging Face进行{evaluation_method}评估...")
         add_evaluation_log(task_id, "评估功能已支持思考模型适配，将自动移除<think>标签内的思考内容，只评估最终答案")
@@ -1299,7 +1339,8 @@ def run_evaluation(task_id: int):
             model_path, 
             output_dir, 
             evaluation_method,
-            config=evaluation_config
+            config=evaluation_config,
+            devices=devices
         )
         
         if success:
@@ -1340,6 +1381,7 @@ def run_evaluation(task_id: int):
         # 从运行中的任务字典中移除
         if task_id in running_evaluations:
             del running_evaluations[task_id]
+        gpu_utils.gpu_ledger.release(f"evaluation:{task_id}")
 
 def start_evaluation(task_id: int):
     """
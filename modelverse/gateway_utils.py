@@ -0,0 +1,299 @@
+"""
+OpenAI兼容网关
+按请求中的model字段把 /v1/* 请求转发到对应的运行中推理任务，复用到各vLLM服务的长连接
+"""
+
+import os
+import json
+import time
+import logging
+import asyncio
+from typing import Dict, Any, Optional, List, Tuple
+
+import httpx
+
+from models import User, InferenceTask, InferenceStatus
+from database import get_all_inference_tasks, get_inference_tasks_by_name
+from routing_utils import replica_router, conversation_key, engine_task_id
+from lifecycle_utils import AVAILABLE_STATUSES, mark_request
+import cache_utils
+import metrics_utils
+import usage_utils
+import supervisor_utils
+
+logger = logging.getLogger(__name__)
+
+# 连接池配置
+GATEWAY_MAX_CONNECTIONS = int(os.environ.get("GATEWAY_MAX_CONNECTIONS", "512"))
+GATEWAY_MAX_KEEPALIVE = int(os.environ.get("GATEWAY_MAX_KEEPALIVE", "128"))
+GATEWAY_READ_TIMEOUT = float(os.environ.get("GATEWAY_READ_TIMEOUT", "600"))
+
+_client: Optional[httpx.AsyncClient] = None
+_client_lock = asyncio.Lock()
+
+class GatewayError(Exception):
+    """网关错误，携带HTTP状态码和OpenAI风格的错误类型"""
+
+    def __init__(self, status_code: int, message: str, error_type: str = "invalid_request_error",
+                 code: Optional[str] = None, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.error_type = error_type
+        self.code = code
+        self.retry_after = retry_after
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"error": {"message": self.message, "type": self.error_type, "code": self.code}}
+
+async def get_client() -> httpx.AsyncClient:
+    """获取共享的异步HTTP客户端，所有转发请求复用同一个连接池"""
+    global _client
+    if _client is None or _client.is_closed:
+        async with _client_lock:
+            if _client is None or _client.is_closed:
+                _client = httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=GATEWAY_MAX_CONNECTIONS,
+                        max_keepalive_connections=GATEWAY_MAX_KEEPALIVE,
+                        keepalive_expiry=60.0
+                    ),
+                    timeout=httpx.Timeout(GATEWAY_READ_TIMEOUT, connect=5.0)
+                )
+    return _client
+
+async def close_client() -> None:
+    """关闭连接池（应用退出时调用）"""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+def can_access_task(task: InferenceTask, user: Optional[User]) -> bool:
+    """与网页端一致的访问规则：任务所有者、管理员，或已开启共享的任务"""
+    if task.share_enabled:
+        return True
+    return user is not None and (user.is_admin or user.id == task.user_id)
+
+def list_accessible_models(user: Optional[User]) -> List[Dict[str, Any]]:
+    """列出当前用户可访问的可用模型（OpenAI /v1/models 格式），包括空闲休眠的模型"""
+    models = []
+    seen = set()
+    for task in get_all_inference_tasks():
+        if task.status not in AVAILABLE_STATUSES or not can_access_task(task, user):
+            continue
+        for name in (task.name, task.display_name):
+            if not name or name in seen:
+                continue
+            seen.add(name)
+            models.append({
+                "id": name,
+                "object": "model",
+                "created": int(task.started_at.timestamp()) if task.started_at else int(time.time()),
+                "owned_by": "modelverse",
+                "task_id": task.id
+            })
+    return models
+
+def resolve_task(model_name: Optional[str], user: Optional[User]) -> InferenceTask:
+    """根据model字段（任务名或显示名称）找到用户可访问的可用任务
+
+    同名时优先选择用户自己的任务，其次是共享任务；任务名匹配优先于显示名称匹配。
+    返回的任务可能处于IDLE状态，调用方需要先冷启动。
+    """
+    if not model_name:
+        raise GatewayError(400, "缺少model参数")
+
+    candidates: List[Tuple[int, InferenceTask]] = []
+    for task in get_inference_tasks_by_name(model_name):
+        if task.status not in AVAILABLE_STATUSES:
+            continue
+        if task.name == model_name:
+            rank = 0
+        elif task.display_name == model_name:
+            rank = 2
+        else:
+            continue
+        if not can_access_task(task, user):
+            continue
+        if user is None or task.user_id != user.id:
+            rank += 1
+        candidates.append((rank, task))
+
+    if not candidates:
+        raise GatewayError(404, f"模型 {model_name} 不存在、未运行或无权访问", code="model_not_found")
+
+    candidates.sort(key=lambda item: (item[0], item[1].id))
+    task = candidates[0][1]
+    if task.status == InferenceStatus.IDLE:
+        return task
+    if not task.port:
+        raise GatewayError(503, f"模型 {model_name} 的推理服务地址未就绪", error_type="server_error")
+    return task
+
+def check_quota(user: Optional[User]) -> None:
+    """用户超出每日用量配额时返回429"""
+    exceeded = usage_utils.usage_meter.check_quota(user.id if user else None)
+    if exceeded:
+        raise GatewayError(429, exceeded["message"], error_type="rate_limit_error",
+                           code="quota_exceeded", retry_after=exceeded["retry_after"])
+
+def _check_engine(engine_id: int) -> None:
+    """引擎正在重启或已熔断时立即返回503，不等待连接超时"""
+    unavailable = supervisor_utils.engine_supervisor.unavailable(engine_id)
+    if unavailable:
+        raise GatewayError(503, unavailable["message"], error_type="server_error",
+                           code="engine_restarting", retry_after=unavailable["retry_after"])
+
+def _upstream_url(port: int, path: str) -> str:
+    return f"http://localhost:{port}/v1/{path}"
+
+def _session_key(payload: Dict[str, Any], session_id: Optional[str]) -> Optional[str]:
+    """会话粘滞标识：优先使用客户端提供的会话ID，其次按对话开头的消息生成"""
+    if session_id:
+        return f"client:{session_id}"
+    if isinstance(payload.get("messages"), list):
+        return conversation_key(payload["messages"])
+    return None
+
+def session_headers(session_key: Optional[str]) -> Dict[str, str]:
+    """把会话标识传给引擎：CPU引擎按会话保留KV缓存，vLLM忽略该请求头"""
+    return {"X-Session-ID": session_key} if session_key else {}
+
+async def forward_json(task: InferenceTask, path: str, payload: Dict[str, Any],
+                       session_id: Optional[str] = None, user_id: Optional[int] = None) -> Tuple[int, Any]:
+    """转发非流式请求到选中的副本，返回上游的状态码和JSON响应"""
+    client = await get_client()
+    # vLLM以任务名作为served-model-name（适配器任务以任务名作为lora_name），按显示名称请求时需要改写
+    payload = dict(payload, model=task.name)
+    
+    # 确定性请求先查响应缓存
+    cache_key = cache_utils.cache_key_for(task, path, payload)
+    if cache_key:
+        cached = cache_utils.response_cache.get(task.id, cache_key)
+        if cached is not None:
+            return 200, cached
+    
+    engine_id = engine_task_id(task)
+    mark_request(task.id)
+    mark_request(engine_id)
+    _check_engine(engine_id)
+    session_key = _session_key(payload, session_id)
+    handle = replica_router.acquire(engine_id, session_key)
+    port = handle["port"] if handle else task.port
+    timer = metrics_utils.metrics_registry.start(task.id, task.name, user_id, usage_utils.task_engine(task))
+    try:
+        response = await client.post(_upstream_url(port, path), json=payload, headers=session_headers(session_key))
+    except httpx.HTTPError as e:
+        replica_router.release(handle, success=False)
+        timer.finish(False)
+        logger.error(f"网关转发失败: 任务={task.id}, 路径={path}, 错误={str(e)}")
+        raise GatewayError(502, f"推理服务不可用: {str(e)}", error_type="server_error")
+    replica_router.release(handle, success=response.status_code < 500)
+    try:
+        body = response.json()
+    except ValueError:
+        timer.finish(False)
+        body = {"error": {"message": response.text[:500], "type": "server_error", "code": None}}
+        return response.status_code, body
+    usage = body.get("usage") if isinstance(body, dict) else None
+    usage = usage or {}
+    elapsed = timer.finish(response.status_code == 200, usage.get("prompt_tokens", 0),
+                           usage.get("completion_tokens", 0))
+    if cache_key and response.status_code == 200:
+        cache_utils.response_cache.put(task.id, cache_key, body, elapsed)
+    return response.status_code, body
+
+async def open_stream(task: InferenceTask, path: str, payload: Dict[str, Any],
+                      session_id: Optional[str] = None, user_id: Optional[int] = None
+                      ) -> Tuple[httpx.Response, Optional[Dict[str, Any]], metrics_utils.RequestTimer]:
+    """打开到上游副本的流式请求
+
+    返回响应、副本占用凭据和请求计时器，调用方通过iter_stream读取，读取结束后关闭响应、
+    归还副本名额并记录指标。
+    """
+    client = await get_client()
+    payload = dict(payload, model=task.name)
+    engine_id = engine_task_id(task)
+    mark_request(task.id)
+    mark_request(engine_id)
+    _check_engine(engine_id)
+    session_key = _session_key(payload, session_id)
+    handle = replica_router.acquire(engine_id, session_key)
+    port = handle["port"] if handle else task.port
+    request = client.build_request("POST", _upstream_url(port, path), json=payload,
+                                   headers=session_headers(session_key))
+    timer = metrics_utils.metrics_registry.start(task.id, task.name, user_id, usage_utils.task_engine(task))
+    try:
+        response = await client.send(request, stream=True)
+    except httpx.HTTPError as e:
+        replica_router.release(handle, success=False)
+        timer.finish(False)
+        logger.error(f"网关流式转发失败: 任务={task.id}, 路径={path}, 错误={str(e)}")
+        raise GatewayError(502, f"推理服务不可用: {str(e)}", error_type="server_error")
+
+    if response.status_code != 200:
+        replica_router.release(handle, success=response.status_code < 500)
+        timer.finish(False)
+        body = await response.aread()
+        await response.aclose()
+        try:
+            detail = json.loads(body)
+            message = detail.get("message") or json.dumps(detail, ensure_ascii=False)
+        except ValueError:
+            message = body.decode("utf-8", errors="replace")[:500]
+        raise GatewayError(response.status_code, message, error_type="upstream_error")
+    return response, handle, timer
+
+class _StreamUsage:
+    """从转发的SSE数据中提取token用量
+
+    客户端请求了include_usage时使用最后一个数据块的usage，否则按含内容的数据块数估算输出token数。
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self.usage: Dict[str, Any] = {}
+        self.content_chunks = 0
+
+    def feed(self, chunk: bytes) -> None:
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b"\n")
+        for line in lines:
+            if not line.startswith(b"data:"):
+                continue
+            compact = line.replace(b" ", b"")
+            if b'"usage":{' in compact:
+                try:
+                    self.usage = json.loads(line[5:]).get("usage") or self.usage
+                except ValueError:
+                    pass
+            if b'"content":"' in compact or b'"text":"' in compact:
+                self.content_chunks += 1
+
+    def tokens(self) -> Tuple[int, int]:
+        if self.usage:
+            return self.usage.get("prompt_tokens", 0), self.usage.get("completion_tokens", 0)
+        return 0, self.content_chunks
+
+async def iter_stream(response: httpx.Response, handle: Optional[Dict[str, Any]] = None,
+                      timer: Optional[metrics_utils.RequestTimer] = None):
+    """逐块转发上游的SSE数据，结束或客户端断开时关闭上游连接、归还副本名额并记录指标"""
+    success = True
+    usage = _StreamUsage()
+    try:
+        async for chunk in response.aiter_raw():
+            if timer is not None:
+                timer.mark_first_token()
+                usage.feed(chunk)
+            yield chunk
+    except httpx.HTTPError as e:
+        success = False
+        logger.error(f"读取上游流式响应失败: {str(e)}")
+        error = GatewayError(502, f"推理服务连接中断: {str(e)}", error_type="server_error")
+        yield f"data: {json.dumps(error.to_dict(), ensure_ascii=False)}\n\n".encode("utf-8")
+    finally:
+        replica_router.release(handle, success=success)
+        if timer is not None:
+            timer.finish(success, *usage.tokens())
+        await response.aclose()
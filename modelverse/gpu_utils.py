@@ -0,0 +1,525 @@
+"""
+GPU监控、放置与显存预留相关的工具函数
+"""
+
+import os
+import time
+import logging
+import threading
+import subprocess
+from collections import deque
+from typing import Dict, Any, Optional, List
+
+logger = logging.getLogger(__name__)
+
+# 采样配置
+GPU_SAMPLE_INTERVAL = float(os.environ.get("GPU_SAMPLE_INTERVAL", "2.0"))  # 采样间隔（秒）
+GPU_HISTORY_SIZE = int(os.environ.get("GPU_HISTORY_SIZE", "900"))          # 环形缓冲区保留的样本数
+
+class NvmlDeviceSource:
+    """通过NVML读取GPU状态"""
+    name = "nvml"
+
+    def __init__(self):
+        import pynvml
+        self._nvml = pynvml
+        pynvml.nvmlInit()
+
+    def read(self) -> List[Dict[str, Any]]:
+        nvml = self._nvml
+        devices = []
+        for i in range(nvml.nvmlDeviceGetCount()):
+            handle = nvml.nvmlDeviceGetHandleByIndex(i)
+            name = nvml.nvmlDeviceGetName(handle)
+            if isinstance(name, bytes):
+                name = name.decode("utf-8", errors="replace")
+            memory = nvml.nvmlDeviceGetMemoryInfo(handle)
+            utilization = nvml.nvmlDeviceGetUtilizationRates(handle)
+            temperature = nvml.nvmlDeviceGetTemperature(handle, nvml.NVML_TEMPERATURE_GPU)
+            try:
+                processes = [
+                    {"pid": p.pid, "memory_used": (p.usedGpuMemory or 0) / (1024 ** 3)}
+                    for p in nvml.nvmlDeviceGetComputeRunningProcesses(handle)
+                ]
+            except nvml.NVMLError:
+                processes = []
+            devices.append({
+                "id": i,
+                "name": name,
+                "memory_total": memory.total / (1024 ** 3),
+                "memory_used": memory.used / (1024 ** 3),
+                "memory_free": memory.free / (1024 ** 3),
+                "utilization": utilization.gpu,
+                "temperature": temperature,
+                "processes": processes
+            })
+        return devices
+
+class NvidiaSmiDeviceSource:
+    """通过nvidia-smi命令读取GPU状态"""
+    name = "nvidia-smi"
+
+    def __init__(self, timeout: float = 5.0):
+        self.timeout = timeout
+
+    def read(self) -> List[Dict[str, Any]]:
+        cmd = [
+            'nvidia-smi',
+            '--query-gpu=gpu_name,memory.total,memory.used,memory.free,utilization.gpu,temperature.gpu,uuid',
+            '--format=csv,noheader,nounits'
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=self.timeout)
+        if result.returncode != 0:
+            raise RuntimeError(f"nvidia-smi执行失败: {result.stderr.strip()}")
+
+        devices = []
+        devices_by_uuid = {}
+        for i, line in enumerate(result.stdout.strip().split('\n')):
+            parts = [p.strip() for p in line.split(',')]
+            if len(parts) < 6:
+                continue
+            device = {
+                "id": i,
+                "name": parts[0],
+                "memory_total": float(parts[1]) / 1024,  # 转换为GB
+                "memory_used": float(parts[2]) / 1024,
+                "memory_free": float(parts[3]) / 1024,
+                "utilization": int(float(parts[4])) if parts[4].replace('.', '', 1).isdigit() else 0,
+                "temperature": int(float(parts[5])) if parts[5].replace('.', '', 1).isdigit() else 0,
+                "processes": []
+            }
+            devices.append(device)
+            if len(parts) >= 7:
+                devices_by_uuid[parts[6]] = device
+
+        # 查询各GPU上的计算进程显存占用
+        apps = subprocess.run(
+            ['nvidia-smi', '--query-compute-apps=pid,gpu_uuid,used_memory', '--format=csv,noheader,nounits'],
+            capture_output=True, text=True, timeout=self.timeout
+        )
+        if apps.returncode == 0:
+            for line in apps.stdout.strip().split('\n'):
+                parts = [p.strip() for p in line.split(',')]
+                if len(parts) >= 3 and parts[0].isdigit() and parts[1] in devices_by_uuid:
+                    devices_by_uuid[parts[1]]["processes"].append({
+                        "pid": int(parts[0]),
+                        "memory_used": float(parts[2]) / 1024 if parts[2].replace('.', '', 1).isdigit() else 0.0
+                    })
+        return devices
+
+class StaticDeviceSource:
+    """返回固定设备列表的数据源，用于无GPU的机器和测试"""
+    name = "static"
+
+    def __init__(self, devices: Optional[List[Dict[str, Any]]] = None, nvlink_pairs: Optional[set] = None):
+        self._devices = [dict(d) for d in (devices or [])]
+        # NVLink直连的GPU对，如 {(0, 1), (2, 3)}
+        self.nvlink_pairs = set(nvlink_pairs or [])
+
+    def set_devices(self, devices: List[Dict[str, Any]]) -> None:
+        """替换当前返回的设备列表"""
+        self._devices = [dict(d) for d in devices]
+
+    def read(self) -> List[Dict[str, Any]]:
+        return [dict(d) for d in self._devices]
+
+def create_default_source():
+    """优先使用NVML，不可用时退回nvidia-smi"""
+    try:
+        return NvmlDeviceSource()
+    except ImportError:
+        logger.info("pynvml未安装，GPU采样使用nvidia-smi")
+    except Exception as e:
+        logger.info(f"NVML初始化失败，GPU采样使用nvidia-smi: {str(e)}")
+    return NvidiaSmiDeviceSource()
+
+def _build_snapshot(devices: List[Dict[str, Any]], source_name: str) -> Dict[str, Any]:
+    """根据设备列表构建汇总快照"""
+    total_memory = sum(d["memory_total"] for d in devices)
+    used_memory = sum(d["memory_used"] for d in devices)
+    return {
+        "available": bool(devices),
+        "source": source_name,
+        "timestamp": time.time(),
+        "gpus": devices,
+        "total_memory": total_memory,
+        "used_memory": used_memory,
+        "free_memory": total_memory - used_memory
+    }
+
+class GPUTelemetrySampler:
+    """后台GPU采样器
+
+    后台线程按固定间隔采样，每次采样生成一个新的快照对象并整体替换引用，
+    读取方直接拿到最近一次的完整快照，无需加锁，也不会阻塞在nvidia-smi上。
+    最近的样本保存在环形缓冲区中，用于历史曲线。
+    """
+
+    def __init__(self, source=None, interval: float = GPU_SAMPLE_INTERVAL, history_size: int = GPU_HISTORY_SIZE):
+        self._source = source
+        self.interval = interval
+        self._history: deque = deque(maxlen=history_size)
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._listeners: List = []
+
+    def add_listener(self, callback) -> None:
+        """注册采样回调，每次成功采样后以快照为参数调用"""
+        self._listeners.append(callback)
+
+    @property
+    def source(self):
+        if self._source is None:
+            self._source = create_default_source()
+        return self._source
+
+    def set_source(self, source) -> None:
+        """替换设备数据源并立即重新采样"""
+        self._source = source
+        self._history.clear()
+        self.sample_once()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def sample_once(self) -> Dict[str, Any]:
+        """执行一次采样并发布快照"""
+        source = self.source
+        try:
+            snapshot = _build_snapshot(source.read(), source.name)
+        except FileNotFoundError:
+            snapshot = {"available": False, "error": "nvidia-smi未找到", "gpus": [], "timestamp": time.time()}
+        except subprocess.TimeoutExpired:
+            snapshot = {"available": False, "error": "nvidia-smi查询超时", "gpus": [], "timestamp": time.time()}
+        except Exception as e:
+            snapshot = {"available": False, "error": str(e), "gpus": [], "timestamp": time.time()}
+
+        self._snapshot = snapshot
+        if snapshot["available"]:
+            self._history.append({
+                "timestamp": snapshot["timestamp"],
+                "gpus": [
+                    {
+                        "id": d["id"],
+                        "memory_used": round(d["memory_used"], 3),
+                        "memory_free": round(d["memory_free"], 3),
+                        "utilization": d.get("utilization", 0),
+                        "temperature": d.get("temperature", 0)
+                    }
+                    for d in snapshot["gpus"]
+                ]
+            })
+            for callback in self._listeners:
+                try:
+                    callback(snapshot)
+                except Exception as e:
+                    logger.error(f"GPU采样回调执行失败: {str(e)}")
+        return snapshot
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            self.sample_once()
+            elapsed = time.monotonic() - started
+            self._stop_event.wait(max(0.0, self.interval - elapsed))
+
+    def start(self) -> None:
+        """启动后台采样线程（重复调用无副作用）"""
+        with self._start_lock:
+            if self.running:
+                return
+            self._stop_event.clear()
+            self.sample_once()
+            self._thread = threading.Thread(target=self._run, name="gpu-telemetry-sampler", daemon=True)
+            self._thread.start()
+            logger.info(f"GPU采样器已启动: 数据源={self.source.name}, 间隔={self.interval}秒")
+
+    def stop(self) -> None:
+        """停止后台采样线程"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        """获取最近一次采样的快照（首次调用时会同步采样一次并启动后台线程）"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            self.start()
+            snapshot = self._snapshot
+        return snapshot
+
+    def history(self, seconds: Optional[float] = None) -> List[Dict[str, Any]]:
+        """获取最近的采样历史，可按时间窗口过滤"""
+        samples = list(self._history)
+        if seconds is not None:
+            cutoff = time.time() - seconds
+            samples = [s for s in samples if s["timestamp"] >= cutoff]
+        return samples
+
+# 全局采样器
+gpu_sampler = GPUTelemetrySampler()
+
+def get_gpu_snapshot() -> Dict[str, Any]:
+    """获取最近一次的GPU快照"""
+    return gpu_sampler.snapshot()
+
+# ========== GPU拓扑与放置 ==========
+
+def read_nvlink_pairs() -> set:
+    """通过nvidia-smi topo -m读取通过NVLink直连的GPU对"""
+    pairs = set()
+    try:
+        result = subprocess.run(['nvidia-smi', 'topo', '-m'], capture_output=True, text=True, timeout=5)
+        if result.returncode != 0:
+            return pairs
+        for line in result.stdout.splitlines():
+            cells = line.split()
+            if not cells or not cells[0].startswith("GPU") or not cells[0][3:].isdigit():
+                continue
+            src = int(cells[0][3:])
+            # 矩阵列按GPU0、GPU1...顺序排列，NV#表示NVLink
+            for dst, cell in enumerate(cells[1:]):
+                if cell.startswith("NV"):
+                    pairs.add((min(src, dst), max(src, dst)))
+    except Exception as e:
+        logger.info(f"读取GPU拓扑失败，按无NVLink处理: {str(e)}")
+    return pairs
+
+_nvlink_pairs: Optional[set] = None
+
+def get_nvlink_pairs() -> set:
+    """获取NVLink直连的GPU对（数据源提供拓扑时优先使用数据源，结果缓存）"""
+    global _nvlink_pairs
+    source_pairs = getattr(gpu_sampler.source, "nvlink_pairs", None)
+    if source_pairs is not None:
+        return set(source_pairs)
+    if _nvlink_pairs is None:
+        _nvlink_pairs = read_nvlink_pairs()
+    return _nvlink_pairs
+
+def _candidate_groups(device_ids: List[int], group_size: int) -> List[List[int]]:
+    """生成连续编号的候选GPU组"""
+    ids = sorted(device_ids)
+    groups = []
+    for start in range(len(ids) - group_size + 1):
+        group = ids[start:start + group_size]
+        if group[-1] - group[0] == group_size - 1:
+            groups.append(group)
+    return groups
+
+def device_requirements(per_device_memory: float, gpus: List[Dict[str, Any]],
+                        memory_fraction: float = 0.0) -> Dict[int, float]:
+    """各GPU上需要的显存（GB）
+
+    memory_fraction用于启动时按总显存比例占用的引擎（vLLM的gpu_memory_utilization），
+    此时每张卡的需求取估算值和 比例 × 该卡总显存 中较大的一个。
+    """
+    return {
+        g["id"]: max(per_device_memory, memory_fraction * g.get("memory_total", 0.0))
+        for g in gpus
+    }
+
+def plan_placement(per_device_memory: float, group_size: int, gpus: List[Dict[str, Any]],
+                   nvlink_pairs: Optional[set] = None, memory_fraction: float = 0.0) -> Optional[List[int]]:
+    """为需要group_size张卡、每张卡per_device_memory GB显存的任务选择GPU组
+
+    候选组为编号连续的GPU；全部两两NVLink直连的组优先。
+    同一优先级内使用最佳适配（best-fit）：选择放下任务后剩余空闲显存最少的组，
+    把大块空闲显存留给后续的大模型。找不到合适的组时返回None。
+    memory_fraction见device_requirements。
+    """
+    if group_size < 1 or group_size > len(gpus):
+        return None
+    if nvlink_pairs is None:
+        nvlink_pairs = get_nvlink_pairs() if group_size > 1 else set()
+
+    free_by_id = {g["id"]: g["memory_free"] for g in gpus}
+    need_by_id = device_requirements(per_device_memory, gpus, memory_fraction)
+    best = None
+    best_key = None
+    for group in _candidate_groups(list(free_by_id.keys()), group_size):
+        if any(free_by_id[i] < need_by_id[i] for i in group):
+            continue
+        fully_linked = all(
+            (a, b) in nvlink_pairs
+            for idx, a in enumerate(group) for b in group[idx + 1:]
+        )
+        leftover = sum(free_by_id[i] - need_by_id[i] for i in group)
+        key = (0 if fully_linked or group_size == 1 else 1, leftover)
+        if best_key is None or key < best_key:
+            best, best_key = group, key
+    return best
+
+# ========== 显存预留账本 ==========
+
+class GPUReservationLedger:
+    """GPU显存预留账本
+
+    推理、训练、评估任务在启动前按估算值预留各GPU上的显存，
+    进程真正分配显存需要几十秒，在此期间其他任务的准入检查会扣除这部分预留，
+    避免同时启动的任务都通过检查后一起OOM。
+    每次采样后按进程的实测显存进行对账：未兑现的预留 = 预留值 - 实测占用。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._reservations: Dict[str, Dict[str, Any]] = {}
+
+    def reserve(self, key: str, kind: str, devices: Dict[int, float], pid: Optional[int] = None,
+                include_children: bool = True) -> Dict[str, Any]:
+        """为指定设备预留显存（同一key重复预留会覆盖旧记录）
+
+        include_children为False时对账只统计关联进程本身（例如在服务进程内运行的评估，
+        服务进程的子进程是各推理引擎，不能算在评估名下）。
+        """
+        with self._lock:
+            reservation = {
+                "key": key,
+                "kind": kind,
+                "devices": {int(d): float(m) for d, m in devices.items()},
+                "measured": {int(d): 0.0 for d in devices},
+                "pids": {pid} if pid else set(),
+                "include_children": include_children,
+                "created_at": time.time()
+            }
+            self._reservations[key] = reservation
+        logger.info(f"显存预留已登记: {key}, 设备={reservation['devices']}")
+        return reservation
+
+    def reserve_placement(self, key: str, kind: str, per_device_memory: float, group_size: int,
+                          gpus: List[Dict[str, Any]], force: bool = False,
+                          memory_fraction: float = 0.0, pid: Optional[int] = None,
+                          include_children: bool = True) -> Optional[List[int]]:
+        """在锁内完成"扣除预留后选择GPU组 + 登记预留"，保证并发准入的原子性
+
+        force为True时，即使放不下也会在空闲显存最多的组上登记预留。
+        memory_fraction见device_requirements，预留值按各卡的实际需求登记。
+        """
+        with self._lock:
+            self._reservations.pop(key, None)
+            available = self.apply_to(gpus)
+            devices = plan_placement(per_device_memory, group_size, available, memory_fraction=memory_fraction)
+            if devices is None and force and len(available) >= group_size:
+                ranked = sorted(available, key=lambda g: g["memory_free"], reverse=True)
+                devices = sorted(g["id"] for g in ranked[:group_size])
+            if devices is None:
+                return None
+            need_by_id = device_requirements(per_device_memory, available, memory_fraction)
+            self.reserve(key, kind, {d: need_by_id[d] for d in devices}, pid=pid, include_children=include_children)
+            return devices
+
+    def attach_pid(self, key: str, pid: int) -> None:
+        """关联预留与实际进程，用于对账"""
+        with self._lock:
+            reservation = self._reservations.get(key)
+            if reservation:
+                reservation["pids"].add(pid)
+
+    def release(self, key: str) -> bool:
+        """释放预留"""
+        with self._lock:
+            reservation = self._reservations.pop(key, None)
+        if reservation:
+            logger.info(f"显存预留已释放: {key}")
+        return reservation is not None
+
+    def release_prefix(self, prefix: str) -> List[str]:
+        """释放key等于prefix或以"prefix:"开头的全部预留（如一个推理任务的所有副本）"""
+        with self._lock:
+            keys = [k for k in self._reservations if k == prefix or k.startswith(prefix + ":")]
+            for key in keys:
+                self._reservations.pop(key, None)
+        if keys:
+            logger.info(f"显存预留已释放: {keys}")
+        return keys
+
+    def outstanding(self) -> Dict[int, float]:
+        """各GPU上尚未被实际占用兑现的预留显存（GB）"""
+        totals: Dict[int, float] = {}
+        with self._lock:
+            for reservation in self._reservations.values():
+                for device, reserved in reservation["devices"].items():
+                    pending = max(0.0, reserved - reservation["measured"].get(device, 0.0))
+                    totals[device] = totals.get(device, 0.0) + pending
+        return totals
+
+    def apply_to(self, gpus: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """返回扣除未兑现预留后的GPU列表副本"""
+        pending = self.outstanding()
+        adjusted = []
+        for gpu in gpus:
+            item = dict(gpu)
+            item["reserved_memory"] = pending.get(gpu["id"], 0.0)
+            item["memory_free"] = max(0.0, gpu["memory_free"] - item["reserved_memory"])
+            adjusted.append(item)
+        return adjusted
+
+    def reconcile(self, snapshot: Dict[str, Any]) -> None:
+        """根据采样快照中各进程的实测显存更新预留的兑现情况，并清理进程已退出的预留"""
+        if not snapshot.get("available"):
+            return
+        usage: Dict[int, Dict[int, float]] = {}
+        for gpu in snapshot["gpus"]:
+            for proc in gpu.get("processes", []):
+                usage.setdefault(proc["pid"], {})[gpu["id"]] = proc["memory_used"]
+
+        with self._lock:
+            reservations = list(self._reservations.values())
+        for reservation in reservations:
+            if not reservation["pids"]:
+                continue
+            pids = _expand_process_tree(reservation["pids"], reservation["include_children"])
+            if not pids:
+                # 关联的进程都已退出，预留不再有效
+                self.release(reservation["key"])
+                continue
+            measured = {device: 0.0 for device in reservation["devices"]}
+            for pid in pids:
+                for device, used in usage.get(pid, {}).items():
+                    measured[device] = measured.get(device, 0.0) + used
+            with self._lock:
+                reservation["measured"] = measured
+            for device, used in measured.items():
+                reserved = reservation["devices"].get(device, 0.0)
+                if reserved and used > reserved * 1.2:
+                    logger.warning(f"显存实测超出预留: {reservation['key']}, GPU{device} 预留 {reserved:.1f}GB, 实测 {used:.1f}GB")
+
+    def list(self) -> List[Dict[str, Any]]:
+        """列出当前所有预留"""
+        with self._lock:
+            return [
+                {
+                    "key": r["key"],
+                    "kind": r["kind"],
+                    "devices": dict(r["devices"]),
+                    "measured": dict(r["measured"]),
+                    "pids": sorted(r["pids"]),
+                    "created_at": r["created_at"]
+                }
+                for r in self._reservations.values()
+            ]
+
+def _expand_process_tree(pids: set, include_children: bool = True) -> set:
+    """获取进程及其全部子进程中仍存活的PID（张量并行时显存由子进程占用）"""
+    import psutil
+
+    alive = set()
+    for pid in pids:
+        try:
+            proc = psutil.Process(pid)
+            if not proc.is_running() or proc.status() == psutil.STATUS_ZOMBIE:
+                continue
+            alive.add(pid)
+            if include_children:
+                alive.update(child.pid for child in proc.children(recursive=True))
+        except psutil.Error:
+            continue
+    return alive
+
+# 全局显存预留账本，随每次采样对账
+gpu_ledger = GPUReservationLedger()
+gpu_sampler.add_listener(gpu_ledger.reconcile)
@@ -0,0 +1,189 @@
+"""
+聊天历史管理
+按模型的tokenizer统计对话token数，超出上下文预算时裁剪或摘要最早的轮次。
+tokenizer按模型路径缓存，每个会话维护累计token数，每轮只需要计算新消息
+"""
+
+import os
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Dict, Any, Optional, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 每条消息在聊天模板中的额外开销（角色标记、分隔符）的估计值
+MESSAGE_OVERHEAD_TOKENS = 4
+# 预留给聊天模板开头和生成提示的token
+TEMPLATE_RESERVE_TOKENS = 32
+# 摘要消息最多占用预算的比例
+SUMMARY_BUDGET_RATIO = 0.1
+# 裁剪方式：trim 直接丢弃最早的轮次；summarize 用一轮摘要对话替代被丢弃的轮次
+HISTORY_OVERFLOW_MODE = os.environ.get("CHAT_HISTORY_OVERFLOW_MODE", "summarize")
+
+# 模型目录 -> tokenizer（加载失败时为None，使用字符估算）
+_tokenizer_cache: Dict[str, Any] = {}
+_tokenizer_lock = threading.Lock()
+
+def _load_tokenizer(model_path: str) -> Any:
+    """加载模型目录中的tokenizer，失败时返回None"""
+    from inference_utils import _find_model_dir
+
+    model_dir = _find_model_dir(model_path)
+    if not model_dir:
+        logger.warning(f"找不到模型目录，使用字符数估算token: {model_path}")
+        return None
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(str(model_dir), trust_remote_code=True)
+        logger.info(f"已加载tokenizer: {model_dir}")
+        return tokenizer
+    except Exception as e:
+        logger.warning(f"加载tokenizer失败，使用字符数估算token: {model_dir}, 错误: {str(e)}")
+        return None
+
+def get_tokenizer(model_path: str) -> Any:
+    """获取模型的tokenizer，每个模型路径只加载一次"""
+    with _tokenizer_lock:
+        if model_path in _tokenizer_cache:
+            return _tokenizer_cache[model_path]
+    tokenizer = _load_tokenizer(model_path)
+    with _tokenizer_lock:
+        return _tokenizer_cache.setdefault(model_path, tokenizer)
+
+async def get_tokenizer_async(model_path: str) -> Any:
+    """在线程中加载tokenizer，避免阻塞事件循环"""
+    with _tokenizer_lock:
+        if model_path in _tokenizer_cache:
+            return _tokenizer_cache[model_path]
+    return await asyncio.to_thread(get_tokenizer, model_path)
+
+def count_tokens(tokenizer: Any, text: str) -> int:
+    """统计文本的token数；没有tokenizer时按中文每字一个、其他每4个字符一个估算"""
+    if not text:
+        return 0
+    if tokenizer is not None:
+        try:
+            return len(tokenizer.encode(text, add_special_tokens=False))
+        except Exception:
+            pass
+    cjk = sum(1 for ch in text if '一' <= ch <= '鿿')
+    return cjk + (len(text) - cjk + 3) // 4
+
+class ChatHistory:
+    """带token预算的会话历史
+
+    系统消息始终保留；其余消息按轮次（用户消息及其后的助手回复）组织，
+    追加消息时只统计新消息的token数，超出预算时从最早的轮次开始裁剪。
+    """
+
+    def __init__(self, tokenizer: Any, max_model_len: int, max_tokens: int, overflow_mode: str = HISTORY_OVERFLOW_MODE):
+        self.tokenizer = tokenizer
+        self.budget = max(1, max_model_len - max_tokens - TEMPLATE_RESERVE_TOKENS)
+        self.overflow_mode = overflow_mode
+        self.system: List[Tuple[Dict[str, Any], int]] = []
+        self.turns: deque = deque()  # 每项为 [(消息, token数), ...]
+        self.summary: Optional[Tuple[List[Dict[str, Any]], int]] = None
+        self.summary_points: List[str] = []
+        self.total_tokens = 0
+        self.dropped_turns = 0
+
+    def _measure(self, message: Dict[str, Any]) -> int:
+        return count_tokens(self.tokenizer, message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+    def append(self, message: Dict[str, Any]) -> int:
+        """追加一条消息并返回它的token数"""
+        tokens = self._measure(message)
+        entry = (message, tokens)
+        if message.get("role") == "system":
+            self.system.append(entry)
+        elif message.get("role") == "user" or not self.turns:
+            self.turns.append([entry])
+        else:
+            self.turns[-1].append(entry)
+        self.total_tokens += tokens
+        return tokens
+
+    def can_fit(self, message: Dict[str, Any]) -> bool:
+        """判断这条消息加上系统消息是否放得进预算（裁剪历史也无法容纳时返回False）"""
+        system_tokens = sum(tokens for _, tokens in self.system)
+        return system_tokens + self._measure(message) <= self.budget
+
+    def pop_last(self) -> Optional[Dict[str, Any]]:
+        """撤销最后一条消息（例如推理失败时撤回用户消息）"""
+        if not self.turns:
+            return None
+        turn = self.turns[-1]
+        message, tokens = turn.pop()
+        if not turn:
+            self.turns.pop()
+        self.total_tokens -= tokens
+        return message
+
+    def clear(self) -> None:
+        """清空非系统消息"""
+        self.turns.clear()
+        self.summary = None
+        self.summary_points = []
+        self.dropped_turns = 0
+        self.total_tokens = sum(tokens for _, tokens in self.system)
+
+    def _update_summary(self, dropped: List[Tuple[Dict[str, Any], int]]) -> None:
+        """把被丢弃轮次的用户问题压缩为一轮摘要对话
+
+        摘要作为系统消息之后单独的一问一答，系统消息保持不变，推理引擎可以跨轮复用前缀缓存；
+        使用一问一答而不是第二条系统消息，兼容要求用户/助手交替的聊天模板。
+        """
+        question = next((m.get("content") or "" for m, _ in dropped if m.get("role") == "user"), "")
+        if question:
+            self.summary_points.append(question.strip().replace("\n", " ")[:60])
+        limit = int(self.budget * SUMMARY_BUDGET_RATIO)
+        while True:
+            content = f"（较早的 {self.dropped_turns} 轮对话已省略，用户曾问过：" + "；".join(self.summary_points) + "）"
+            messages = [{"role": "user", "content": content}, {"role": "assistant", "content": "好的。"}]
+            tokens = sum(self._measure(message) for message in messages)
+            if tokens <= limit or not self.summary_points:
+                break
+            self.summary_points.pop(0)
+        if self.summary:
+            self.total_tokens -= self.summary[1]
+        self.summary = (messages, tokens) if tokens <= limit else None
+        if self.summary:
+            self.total_tokens += tokens
+
+    def fit(self) -> bool:
+        """裁剪最早的轮次直到总token数不超过预算，最后一轮无法裁剪时返回False"""
+        while self.total_tokens > self.budget and len(self.turns) > 1:
+            dropped = self.turns.popleft()
+            self.total_tokens -= sum(tokens for _, tokens in dropped)
+            self.dropped_turns += 1
+            if self.overflow_mode == "summarize":
+                self._update_summary(dropped)
+        if self.dropped_turns and self.total_tokens > self.budget and self.summary:
+            # 摘要本身也放不下时放弃摘要
+            self.total_tokens -= self.summary[1]
+            self.summary = None
+        return self.total_tokens <= self.budget
+
+    def messages(self) -> List[Dict[str, Any]]:
+        """按顺序返回发送给模型的消息"""
+        result = [message for message, _ in self.system]
+        if self.summary:
+            result.extend(self.summary[0])
+        for turn in self.turns:
+            result.extend(message for message, _ in turn)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "total_tokens": self.total_tokens,
+            "budget": self.budget,
+            "turns": len(self.turns),
+            "dropped_turns": self.dropped_turns
+        }
+
+async def create_chat_history(task: Any, model_path: Optional[str]) -> ChatHistory:
+    """为推理任务创建会话历史，预算为 max_model_len - max_tokens"""
+    tokenizer = await get_tokenizer_async(model_path) if model_path else None
+    return ChatHistory(tokenizer, task.max_model_len, task.max_tokens)
@@ -5,19 +5,31 @@
 import os
 import json
 import asyncio
-import subprocess
 import socket
 import psutil
 import logging
 import requests
-import time
 import shutil
+import threading
 from typing import Dict, Any, Optional, List, Set, Tuple
 from datetime import datetime
 from pathlib import Path
 import torch
 from models import InferenceTask, InferenceStatus
-from database import update_inference_task, get_resource, get_inference_task
+from database import (
+    update_inference_task, get_resource, get_inference_task, get_all_inference_tasks,
+    register_inference_process, remove_inference_process, get_inference_processes
+)
+import gpu_utils
+import routing_utils
+import lifecycle_utils
+import cache_utils
+import gateway_utils
+import metrics_utils
+import usage_utils
+import supervisor_utils
+import log_utils
+import startup_utils
 
 logger = logging.getLogger(__name__)
 
@@ -30,16 +42,95 @@ LOGS_DIR.mkdir(parents=True, exist_ok=True)
 # 存储活跃的推理进程
 active_processes: List[Dict[str, Any]] = []
 
+# 端口租约登记表：端口 -> 推理任务ID
+PORT_RANGE_START = int(os.environ.get("INFERENCE_PORT_START", "8000"))
+PORT_RANGE_END = int(os.environ.get("INFERENCE_PORT_END", "8999"))
+port_leases: Dict[int, int] = {}
+_port_lock = threading.Lock()
+_next_port_cursor = PORT_RANGE_START
+
+def _is_port_bindable(port: int) -> bool:
+    """尝试绑定端口，判断端口当前是否真正空闲"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(("0.0.0.0", port))
+            return True
+        except OSError:
+            return False
+
 # 查找可用端口
 def find_available_port(start_port: int = 8000, max_attempts: int = 100) -> int:
-    """查找可用端口，从start_port开始尝试"""
+    """查找可用端口，从start_port开始尝试（跳过已被租用的端口）"""
     for port in range(start_port, start_port + max_attempts):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            result = s.connect_ex(('localhost', port))
-            if result != 0:  # 端口未被占用
-                return port
+        if port in port_leases:
+            continue
+        if _is_port_bindable(port):
+            return port
     raise RuntimeError(f"无法找到可用端口（尝试范围: {start_port}-{start_port + max_attempts - 1}）")
 
+def allocate_port(task_id: int) -> int:
+    """为推理任务原子地分配并租用一个端口
+    
+    在锁内完成"查找 + 登记"，并发启动的任务不会拿到同一个端口。
+    扫描从上次分配位置之后继续，已租用端口只做字典查询，不再逐个探测。
+    """
+    global _next_port_cursor
+    span = PORT_RANGE_END - PORT_RANGE_START + 1
+    with _port_lock:
+        for offset in range(span):
+            port = PORT_RANGE_START + (_next_port_cursor - PORT_RANGE_START + offset) % span
+            if port in port_leases:
+                continue
+            if not _is_port_bindable(port):
+                continue
+            port_leases[port] = task_id
+            _next_port_cursor = port + 1 if port < PORT_RANGE_END else PORT_RANGE_START
+            logger.info(f"端口租约已登记: 端口={port}, 任务={task_id}")
+            return port
+    raise RuntimeError(f"无法找到可用端口（尝试范围: {PORT_RANGE_START}-{PORT_RANGE_END}）")
+
+def release_port(port: Optional[int]) -> None:
+    """释放单个端口租约"""
+    if port is None:
+        return
+    with _port_lock:
+        task_id = port_leases.pop(port, None)
+    if task_id is not None:
+        logger.info(f"端口租约已释放: 端口={port}, 任务={task_id}")
+
+def release_task_ports(task_id: int) -> List[int]:
+    """释放推理任务持有的全部端口租约"""
+    with _port_lock:
+        ports = [port for port, owner in port_leases.items() if owner == task_id]
+        for port in ports:
+            del port_leases[port]
+    if ports:
+        logger.info(f"已释放任务 {task_id} 的端口租约: {ports}")
+    return ports
+
+def release_task_resources(task_id: int) -> None:
+    """释放推理任务（含全部副本）持有的端口租约和显存预留"""
+    release_task_ports(task_id)
+    gpu_utils.gpu_ledger.release_prefix(f"inference:{task_id}")
+
+def get_task_ports(task_id: int) -> List[int]:
+    """获取推理任务当前持有的端口"""
+    with _port_lock:
+        return sorted(port for port, owner in port_leases.items() if owner == task_id)
+
+def restore_port_leases() -> Dict[int, int]:
+    """服务重启后根据数据库中的任务记录重建端口租约"""
+    restored = {}
+    with _port_lock:
+        port_leases.clear()
+        for task in get_all_inference_tasks():
+            # 适配器任务的端口属于基础模型任务
+            if task.port and not task.base_task_id and task.status in (InferenceStatus.RUNNING, InferenceStatus.CREATING):
+                port_leases[task.port] = task.id
+                restored[task.port] = task.id
+    logger.info(f"已从数据库恢复 {len(restored)} 个端口租约")
+    return restored
+
 # 获取模型路径
 def get_model_path(model_id: int) -> Optional[str]:
     """获取模型的本地路径"""
@@ -48,13 +139,194 @@ def get_model_path(model_id: int) -> Optional[str]:
         return None
     return model.local_path
 
-# 获取模型的显存占用估计（GB）
-def estimate_model_memory(model_id: int, tensor_parallel_size: int = 1, max_model_len: int = 4096, quantization: Optional[str] = None) -> float:
-    """估计模型的显存占用（GB）- 改进版本，考虑KV cache等额外开销"""
-    model = get_resource(resource_id=model_id)
-    if not model:
-        return 0.0
+# safetensors / torch 数据类型对应的字节数
+SAFETENSORS_DTYPE_BYTES = {
+    "F64": 8, "F32": 4, "F16": 2, "BF16": 2,
+    "I64": 8, "I32": 4, "I16": 2, "I8": 1, "U8": 1, "BOOL": 1,
+    "F8_E4M3": 1, "F8_E5M2": 1,
+}
+TORCH_DTYPE_BYTES = {
+    "float32": 4, "float": 4, "float16": 2, "half": 2, "bfloat16": 2,
+    "float8": 1, "fp8": 1,
+}
+# 量化方法对应的权重位宽
+QUANTIZATION_BITS = {
+    "awq": 4, "gptq": 4, "awq_marlin": 4, "gptq_marlin": 4, "marlin": 4,
+    "squeezellm": 4, "bitsandbytes": 4, "int4": 4,
+    "fp8": 8, "int8": 8, "compressed-tensors": 8,
+}
+# 非门控MLP结构的模型类型（MLP只有两个线性层）
+NON_GATED_MLP_MODEL_TYPES = {"gpt2", "opt", "gpt_neox", "gptj", "bloom", "falcon", "phi", "starcoder2", "gpt_bigcode"}
+
+# vLLM单卡固定开销（CUDA上下文、NCCL缓冲区等，GB）
+ENGINE_BASE_OVERHEAD_GB = 1.0
+# vLLM剖析运行时使用的批处理token数
+PROFILE_BATCHED_TOKENS = 4096
+
+# 模型结构信息缓存：模型路径 -> (文件签名, 结构信息)
+_model_profile_cache: Dict[str, Tuple[Tuple, Dict[str, Any]]] = {}
+_model_profile_lock = threading.Lock()
+
+def _find_model_dir(model_path: str) -> Optional[Path]:
+    """定位包含config.json的模型目录（兼容嵌套一层的下载目录）"""
+    root = Path(model_path)
+    if (root / "config.json").is_file():
+        return root
+    if root.is_dir():
+        for child in sorted(root.iterdir()):
+            if child.is_dir() and (child / "config.json").is_file():
+                return child
+    return None
+
+def _read_safetensors_header(file_path: Path) -> Dict[str, Any]:
+    """只读取safetensors文件头部的元数据（不加载权重）"""
+    with open(file_path, "rb") as f:
+        header_len = int.from_bytes(f.read(8), "little")
+        return json.loads(f.read(header_len))
+
+def _model_files_signature(model_dir: Path) -> Tuple:
+    """根据config.json和权重文件的大小/修改时间生成缓存签名"""
+    entries = []
+    for file_path in [model_dir / "config.json", *sorted(model_dir.glob("*.safetensors"))]:
+        stat = file_path.stat()
+        entries.append((file_path.name, stat.st_size, stat.st_mtime))
+    return tuple(entries)
+
+def load_model_profile(model_path: str) -> Optional[Dict[str, Any]]:
+    """读取模型的config.json和safetensors头部，得到计算显存所需的结构信息
+    
+    结果按模型路径缓存，文件变化（大小或修改时间）时自动失效。
+    """
+    model_dir = _find_model_dir(model_path)
+    if not model_dir:
+        return None
     
+    signature = _model_files_signature(model_dir)
+    cache_key = str(model_dir.resolve())
+    with _model_profile_lock:
+        cached = _model_profile_cache.get(cache_key)
+        if cached and cached[0] == signature:
+            return cached[1]
+    
+    with open(model_dir / "config.json", "r", encoding="utf-8") as f:
+        config = json.load(f)
+    # 多模态模型的语言部分配置放在text_config中
+    text_config = {**config, **config.get("text_config", {})}
+    
+    hidden_size = text_config.get("hidden_size") or text_config.get("n_embd") or text_config.get("d_model")
+    num_layers = text_config.get("num_hidden_layers") or text_config.get("n_layer") or text_config.get("num_layers")
+    num_heads = text_config.get("num_attention_heads") or text_config.get("n_head")
+    if not (hidden_size and num_layers and num_heads):
+        logger.warning(f"config.json缺少必要的结构字段，无法精确估算: {model_dir}")
+        return None
+    
+    num_kv_heads = text_config.get("num_key_value_heads") or text_config.get("num_kv_heads") or num_heads
+    if text_config.get("multi_query"):
+        num_kv_heads = 1
+    head_dim = text_config.get("head_dim") or hidden_size // num_heads
+    vocab_size = text_config.get("vocab_size", 32000)
+    intermediate_size = text_config.get("intermediate_size") or text_config.get("n_inner") or 4 * hidden_size
+    num_experts = text_config.get("num_local_experts") or text_config.get("num_experts") or 1
+    tie_word_embeddings = bool(text_config.get("tie_word_embeddings", False))
+    model_type = text_config.get("model_type", "")
+    
+    # 根据结构计算参数量
+    attention_params = hidden_size * (num_heads * head_dim) * 2 + hidden_size * (num_kv_heads * head_dim) * 2
+    mlp_matrices = 2 if model_type in NON_GATED_MLP_MODEL_TYPES else 3
+    mlp_params = mlp_matrices * hidden_size * intermediate_size * num_experts
+    layer_params = attention_params + mlp_params + 2 * hidden_size
+    embedding_params = vocab_size * hidden_size * (1 if tie_word_embeddings else 2)
+    param_count = num_layers * layer_params + embedding_params
+    
+    # 读取safetensors头部，得到权重的真实字节数
+    weight_bytes = None
+    safetensors_files = sorted(model_dir.glob("*.safetensors"))
+    if safetensors_files:
+        weight_bytes = 0
+        tensor_params = 0
+        for file_path in safetensors_files:
+            header = _read_safetensors_header(file_path)
+            for name, meta in header.items():
+                if name == "__metadata__":
+                    continue
+                numel = 1
+                for dim in meta["shape"]:
+                    numel *= dim
+                tensor_params += numel
+                weight_bytes += numel * SAFETENSORS_DTYPE_BYTES.get(meta["dtype"], 2)
+        if tensor_params:
+            param_count = tensor_params
+    
+    quantization_config = config.get("quantization_config") or {}
+    profile = {
+        "model_dir": str(model_dir),
+        "model_type": model_type,
+        "hidden_size": hidden_size,
+        "num_layers": num_layers,
+        "num_attention_heads": num_heads,
+        "num_kv_heads": num_kv_heads,
+        "head_dim": head_dim,
+        "vocab_size": vocab_size,
+        "intermediate_size": intermediate_size,
+        "tie_word_embeddings": tie_word_embeddings,
+        "torch_dtype": text_config.get("torch_dtype") or "float16",
+        "param_count": param_count,
+        "weight_bytes": weight_bytes,
+        "checkpoint_quantization": quantization_config.get("quant_method"),
+        "max_position_embeddings": text_config.get("max_position_embeddings"),
+    }
+    
+    with _model_profile_lock:
+        _model_profile_cache[cache_key] = (signature, profile)
+    return profile
+
+def _estimate_from_profile(profile: Dict[str, Any], tensor_parallel_size: int, max_model_len: int,
+                           quantization: Optional[str], dtype: str) -> Dict[str, Any]:
+    """根据模型结构信息精确计算权重、KV cache和开销（GB）"""
+    gb = 1024 ** 3
+    tp = max(1, tensor_parallel_size)
+    compute_dtype = profile["torch_dtype"] if dtype in (None, "auto") else dtype
+    dtype_bytes = TORCH_DTYPE_BYTES.get(str(compute_dtype).lower(), 2)
+    
+    # 权重：预量化检查点直接使用safetensors记录的字节数，在线量化/改变精度时按参数量重算
+    embedding_params = profile["vocab_size"] * profile["hidden_size"] * (1 if profile["tie_word_embeddings"] else 2)
+    quant_method = (quantization or "").lower() or None
+    if quant_method and not profile["checkpoint_quantization"]:
+        bits = QUANTIZATION_BITS.get(quant_method, 16)
+        linear_params = max(0, profile["param_count"] - embedding_params)
+        weight_bytes = linear_params * bits / 8 + embedding_params * dtype_bytes
+    elif profile["weight_bytes"] and (dtype in (None, "auto") or profile["checkpoint_quantization"]):
+        weight_bytes = profile["weight_bytes"]
+    else:
+        weight_bytes = profile["param_count"] * dtype_bytes
+    
+    # KV cache：每个token在每层保存K和V，KV头在张量并行时按卡切分（至少一个）
+    kv_heads_per_gpu = max(1, -(-profile["num_kv_heads"] // tp))
+    kv_bytes_per_token_per_gpu = 2 * profile["num_layers"] * kv_heads_per_gpu * profile["head_dim"] * dtype_bytes
+    kv_cache_per_gpu = kv_bytes_per_token_per_gpu * max_model_len
+    
+    # 剖析运行时的激活峰值 + 固定开销
+    batched_tokens = max(PROFILE_BATCHED_TOKENS, max_model_len)
+    activation_bytes = batched_tokens * (4 * profile["hidden_size"] + 2 * profile["intermediate_size"] // tp) * dtype_bytes
+    overhead_per_gpu = ENGINE_BASE_OVERHEAD_GB + activation_bytes / gb
+    
+    weights_per_gpu = weight_bytes / tp / gb
+    per_gpu = weights_per_gpu + kv_cache_per_gpu / gb + overhead_per_gpu
+    return {
+        "method": "config",
+        "param_count": profile["param_count"],
+        "weights_gb": weight_bytes / gb,
+        "kv_cache_gb": kv_cache_per_gpu * tp / gb,
+        "overhead_gb": overhead_per_gpu * tp,
+        "weights_per_gpu_gb": weights_per_gpu,
+        "kv_bytes_per_token_per_gpu": kv_bytes_per_token_per_gpu,
+        "overhead_per_gpu_gb": overhead_per_gpu,
+        "per_gpu_gb": per_gpu,
+        "total_gb": per_gpu * tp,
+    }
+
+def _estimate_by_model_name(model: Any, tensor_parallel_size: int, max_model_len: int, quantization: Optional[str]) -> Dict[str, Any]:
+    """无法读取config.json时的兜底估算：根据模型名称或文件大小粗略推断"""
     # 从模型名称中提取参数规模（如果可能）
     model_name = model.name.lower()
     model_size = 0
@@ -142,92 +414,115 @@ def estimate_model_memory(model_id: int, tensor_parallel_size: int = 1, max_mode
     if tensor_parallel_size > 1:
         total_memory = (base_memory / tensor_parallel_size) + kv_cache_memory + system_overhead
     
-    logger.info(f"显存估算详情 - 模型: {model_name}, 参数规模: {model_size}B, "
-                f"基础内存: {base_memory:.1f}GB, KV Cache: {kv_cache_memory:.1f}GB, "
-                f"系统开销: {system_overhead:.1f}GB, 总计: {total_memory:.1f}GB")
+    tp = max(1, tensor_parallel_size)
+    return {
+        "method": "heuristic",
+        "param_count": int(model_size * 1e9),
+        "weights_gb": base_memory,
+        "kv_cache_gb": kv_cache_memory,
+        "overhead_gb": system_overhead,
+        "weights_per_gpu_gb": base_memory / tp,
+        "kv_bytes_per_token_per_gpu": None,
+        "overhead_per_gpu_gb": system_overhead / tp,
+        "per_gpu_gb": total_memory / tp,
+        "total_gb": total_memory,
+    }
+
+def estimate_model_memory_detail(model_id: int, tensor_parallel_size: int = 1, max_model_len: int = 4096,
+                                 quantization: Optional[str] = None, dtype: str = "auto") -> Dict[str, Any]:
+    """估计模型的显存占用明细
+    
+    优先读取模型目录下的config.json和safetensors头部进行精确计算，
+    读取失败时退回到基于模型名称的粗略估算。
+    """
+    model = get_resource(resource_id=model_id)
+    if not model:
+        return {"method": "none", "total_gb": 0.0, "per_gpu_gb": 0.0}
+    
+    profile = None
+    if model.local_path:
+        try:
+            profile = load_model_profile(model.local_path)
+        except Exception as e:
+            logger.warning(f"读取模型结构信息失败，使用名称估算: {model.local_path}, 错误: {str(e)}")
     
-    return total_memory
+    if profile:
+        detail = _estimate_from_profile(profile, tensor_parallel_size, max_model_len, quantization, dtype)
+    else:
+        detail = _estimate_by_model_name(model, tensor_parallel_size, max_model_len, quantization)
+    
+    logger.info(f"显存估算详情 - 模型: {model.name}, 方法: {detail['method']}, 参数量: {detail['param_count']/1e9:.2f}B, "
+                f"权重: {detail['weights_gb']:.1f}GB, KV Cache: {detail['kv_cache_gb']:.1f}GB, "
+                f"系统开销: {detail['overhead_gb']:.1f}GB, 总计: {detail['total_gb']:.1f}GB (TP={tensor_parallel_size})")
+    return detail
+
+# 获取模型的显存占用估计（GB）
+def estimate_model_memory(model_id: int, tensor_parallel_size: int = 1, max_model_len: int = 4096, quantization: Optional[str] = None) -> float:
+    """估计模型的显存占用（GB），包含权重、KV cache和系统开销"""
+    return estimate_model_memory_detail(
+        model_id=model_id,
+        tensor_parallel_size=tensor_parallel_size,
+        max_model_len=max_model_len,
+        quantization=quantization
+    )["total_gb"]
 
-# 使用nvidia-smi获取实时GPU信息
+# 获取实时GPU信息（读取后台采样器的缓存快照）
 def get_real_gpu_info() -> Dict[str, Any]:
-    """使用nvidia-smi获取实时GPU信息"""
-    try:
-        # 查询GPU信息：名称、总显存、已用显存、空闲显存、GPU利用率、温度
-        cmd = [
-            'nvidia-smi', 
-            '--query-gpu=gpu_name,memory.total,memory.used,memory.free,utilization.gpu,temperature.gpu',
-            '--format=csv,noheader,nounits'
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
-        
-        if result.returncode != 0:
-            logger.error(f"nvidia-smi执行失败: {result.stderr}")
-            return {"available": False, "error": "nvidia-smi执行失败", "gpus": []}
-        
-        lines = result.stdout.strip().split('\n')
-        gpus = []
-        total_memory = 0
-        total_used = 0
-        
-        for i, line in enumerate(lines):
-            if line.strip():
-                parts = [p.strip() for p in line.split(',')]
-                if len(parts) >= 6:
-                    gpu_name = parts[0]
-                    memory_total = float(parts[1]) / 1024  # 转换为GB
-                    memory_used = float(parts[2]) / 1024   # 转换为GB
-                    memory_free = float(parts[3]) / 1024   # 转换为GB
-                    gpu_util = parts[4]
-                    temperature = parts[5]
-                    
-                    total_memory += memory_total
-                    total_used += memory_used
-                    
-                    gpus.append({
-                        "id": i,
-                        "name": gpu_name,
-                        "memory_total": memory_total,
-                        "memory_used": memory_used,
-                        "memory_free": memory_free,
-                        "utilization": f"{gpu_util}%",
-                        "temperature": f"{temperature}°C"
-                    })
-        
-        return {
-            "available": True,
-            "gpus": gpus,
-            "total_memory": total_memory,
-            "used_memory": total_used,
-            "free_memory": total_memory - total_used
-        }
-        
-    except subprocess.TimeoutExpired:
-        logger.error("nvidia-smi查询超时")
-        return {"available": False, "error": "nvidia-smi查询超时", "gpus": []}
-    except FileNotFoundError:
-        logger.error("nvidia-smi命令未找到，可能未安装NVIDIA驱动")
-        return {"available": False, "error": "nvidia-smi未找到", "gpus": []}
-    except Exception as e:
-        logger.error(f"获取GPU信息失败: {str(e)}")
-        return {"available": False, "error": str(e), "gpus": []}
+    """获取实时GPU信息，数据来自后台采样器的最近一次快照，不会阻塞调用方"""
+    snapshot = gpu_utils.get_gpu_snapshot()
+    if not snapshot["available"]:
+        return {"available": False, "error": snapshot.get("error", "没有可用的GPU"), "gpus": []}
+    
+    # 复制一份，避免调用方修改共享快照
+    gpus = []
+    for device in snapshot["gpus"]:
+        gpus.append({
+            "id": device["id"],
+            "name": device["name"],
+            "memory_total": device["memory_total"],
+            "memory_used": device["memory_used"],
+            "memory_free": device["memory_free"],
+            "utilization": f"{device.get('utilization', 0)}%",
+            "temperature": f"{device.get('temperature', 0)}°C"
+        })
+    
+    return {
+        "available": True,
+        "gpus": gpus,
+        "total_memory": snapshot["total_memory"],
+        "used_memory": snapshot["used_memory"],
+        "free_memory": snapshot["free_memory"],
+        "sampled_at": snapshot["timestamp"]
+    }
+
+def _process_devices(process_info: Dict[str, Any]) -> List[int]:
+    """获取推理进程占用的GPU编号列表"""
+    if process_info.get("gpu_devices"):
+        return process_info["gpu_devices"]
+    if process_info.get("gpu_device") is not None:
+        return [process_info["gpu_device"]]
+    return []
 
 # 获取系统GPU信息（改进版本）
 def get_gpu_info() -> Dict[str, Any]:
-    """获取系统GPU信息 - 优先使用nvidia-smi实时查询"""
-    # 首先尝试使用nvidia-smi获取实时信息
+    """获取系统GPU信息 - 优先使用后台采样器的实时数据"""
+    # 首先尝试使用采样器快照
     real_gpu_info = get_real_gpu_info()
     
     if real_gpu_info["available"]:
-        # 添加任务信息到实时GPU信息中
+        # 添加任务信息和显存预留到实时GPU信息中
+        pending = gpu_utils.gpu_ledger.outstanding()
+        real_gpu_info["reserved_memory"] = sum(pending.values())
         for gpu in real_gpu_info["gpus"]:
+            gpu["reserved_memory"] = pending.get(gpu["id"], 0.0)
             # 计算该GPU上运行的任务
-            tasks_on_gpu = [p for p in active_processes if p.get("gpu_device") == gpu["id"]]
+            tasks_on_gpu = [p for p in active_processes if gpu["id"] in _process_devices(p)]
             gpu["running_tasks"] = len(tasks_on_gpu)
             gpu["task_details"] = [
                 {
                     "task_id": p["task_id"],
-                    "estimated_memory": p.get("gpu_memory", 0),
+                    "estimated_memory": p.get("gpu_memory_per_device", p.get("gpu_memory", 0)),
+                    "gpu_devices": _process_devices(p),
                     "command": p["command"][:100] + "..." if len(p["command"]) > 100 else p["command"]
                 }
                 for p in tasks_on_gpu
@@ -240,7 +535,7 @@ def get_gpu_info() -> Dict[str, Any]:
         
         return real_gpu_info
     
-    # 如果nvidia-smi不可用，回退到torch方法
+    # 如果采样器不可用，回退到torch方法
     try:
         if not torch.cuda.is_available():
             return {"available": False, "gpus": [], "total_memory": 0, "used_memory": 0, "free_memory": 0}
@@ -262,7 +557,7 @@ def get_gpu_info() -> Dict[str, Any]:
                 actual_used = max(memory_allocated, memory_reserved)
             except Exception:
                 # 如果无法获取实际使用情况，使用估算
-                actual_used = sum([p.get("gpu_memory", 0) for p in active_processes if p.get("gpu_device") == i])
+                actual_used = sum([p.get("gpu_memory_per_device", p.get("gpu_memory", 0)) for p in active_processes if i in _process_devices(p)])
             
             gpus.append({
                 "id": i,
@@ -270,7 +565,7 @@ def get_gpu_info() -> Dict[str, Any]:
                 "memory_total": gpu_memory,
                 "memory_used": actual_used,
                 "memory_free": gpu_memory - actual_used,
-                "running_tasks": len([p for p in active_processes if p.get("gpu_device") == i])
+                "running_tasks": len([p for p in active_processes if i in _process_devices(p)])
             })
             
             used_memory += actual_used
@@ -287,9 +582,90 @@ def get_gpu_info() -> Dict[str, Any]:
         logger.error(f"获取GPU信息失败: {str(e)}")
         return {"available": False, "error": str(e), "gpus": [], "total_memory": 0, "used_memory": 0, "free_memory": 0}
 
+# ========== CPU推理引擎 ==========
+
+# 推理引擎类型
+ENGINE_VLLM = "vllm"
+ENGINE_CPU = "cpu"
+ENGINES = (ENGINE_VLLM, ENGINE_CPU)
+
+# CPU引擎配置
+CPU_ENGINE_MAX_PARAMS_B = float(os.environ.get("CPU_ENGINE_MAX_PARAMS_B", "3"))
+CPU_ENGINE_MAX_BATCH_SIZE = int(os.environ.get("CPU_ENGINE_MAX_BATCH_SIZE", "8"))
+CPU_ENGINE_SESSION_CACHE = int(os.environ.get("CPU_ENGINE_SESSION_CACHE", "32"))
+CPU_ENGINE_THREADS = int(os.environ.get("CPU_ENGINE_THREADS", "0"))
+CPU_ENGINE_OVERHEAD_GB = 1.0
+
+def estimate_cpu_memory(model_id: int, max_model_len: int = 2048) -> Dict[str, Any]:
+    """估计CPU引擎的内存需求（GB）
+
+    权重以float32加载后再做int8动态量化，峰值按float32权重计算；
+    KV缓存按float32、会话缓存数加批次大小个完整上下文估算。
+    """
+    gb = 1024 ** 3
+    detail = estimate_model_memory_detail(model_id=model_id, max_model_len=max_model_len, dtype="float32")
+    param_count = detail.get("param_count") or 0
+    load_peak_gb = param_count * 4 / gb
+    kv_gb = 0.0
+    if detail.get("kv_bytes_per_token_per_gpu"):
+        sequences = CPU_ENGINE_SESSION_CACHE + CPU_ENGINE_MAX_BATCH_SIZE
+        kv_gb = detail["kv_bytes_per_token_per_gpu"] * max_model_len * sequences / gb
+    return {
+        "param_count": param_count,
+        "load_peak_gb": load_peak_gb,
+        "kv_cache_gb": kv_gb,
+        "total_gb": load_peak_gb + kv_gb + CPU_ENGINE_OVERHEAD_GB
+    }
+
+def check_cpu_resources_for_task(model_id: int, max_model_len: int = 2048) -> Dict[str, Any]:
+    """检查模型是否适合CPU引擎以及可用内存是否足够"""
+    estimate = estimate_cpu_memory(model_id, max_model_len)
+    params_b = estimate["param_count"] / 1e9
+    if params_b > CPU_ENGINE_MAX_PARAMS_B:
+        return {
+            "sufficient": False,
+            "reason": f"模型参数量约 {params_b:.1f}B，超过CPU引擎支持的上限 {CPU_ENGINE_MAX_PARAMS_B:g}B，请使用vLLM引擎"
+        }
+    available = psutil.virtual_memory().available / 1024 ** 3
+    if estimate["total_gb"] > available:
+        return {
+            "sufficient": False,
+            "reason": f"内存不足: 需要 {estimate['total_gb']:.1f}GB, 可用 {available:.1f}GB",
+            "required_memory": estimate["total_gb"],
+            "available_memory": available
+        }
+    return {
+        "sufficient": True,
+        "required_memory": estimate["total_gb"],
+        "available_memory": available
+    }
+
+def build_cpu_engine_command(task: InferenceTask, model_path: str, port: int) -> List[str]:
+    """构建CPU引擎启动命令（python -m 形式，可以使用预热进程启动）"""
+    model_dir = _find_model_dir(model_path)
+    return [
+        "python", "-m", "cpu_engine",
+        "--model", str(model_dir or model_path),
+        "--host", "0.0.0.0",
+        "--port", str(port),
+        "--served-model-name", task.name,
+        "--max-model-len", str(task.max_model_len),
+        "--max-batch-size", str(CPU_ENGINE_MAX_BATCH_SIZE),
+        "--session-cache", str(CPU_ENGINE_SESSION_CACHE),
+        "--threads", str(CPU_ENGINE_THREADS)
+    ]
+
 # 检查GPU资源是否足够启动新任务
-def check_gpu_resources_for_task(model_id: int, tensor_parallel_size: int = 1, max_model_len: int = 4096, quantization: Optional[str] = None) -> Dict[str, Any]:
-    """检查GPU资源是否足够启动新任务"""
+def check_gpu_resources_for_task(model_id: int, tensor_parallel_size: int = 1, max_model_len: int = 4096,
+                                 quantization: Optional[str] = None, engine: Optional[str] = ENGINE_VLLM,
+                                 gpu_memory_utilization: float = 0.85) -> Dict[str, Any]:
+    """检查GPU资源是否足够启动新任务（CPU引擎检查内存）
+
+    vLLM启动时在每张卡上占用 gpu_memory_utilization × 总显存，GPU组按这个值检查。
+    """
+    if engine == ENGINE_CPU:
+        return check_cpu_resources_for_task(model_id, max_model_len)
+    
     # 获取实时GPU信息
     gpu_info = get_gpu_info()
     
@@ -301,53 +677,283 @@ def check_gpu_resources_for_task(model_id: int, tensor_parallel_size: int = 1, m
         }
     
     # 估算新任务的显存需求
-    estimated_memory = estimate_model_memory(
+    estimate = estimate_model_memory_detail(
         model_id=model_id,
         tensor_parallel_size=tensor_parallel_size,
         max_model_len=max_model_len,
         quantization=quantization
     )
+    estimated_memory = estimate["total_gb"]
+    
+    # 空闲显存需扣除其他任务已预留但尚未实际分配的部分
+    reserved_memory = gpu_info.get("reserved_memory", 0.0)
+    available_memory = gpu_info["free_memory"] - reserved_memory
     
     # 检查是否有足够的空闲显存
-    if estimated_memory > gpu_info["free_memory"]:
+    if estimated_memory > available_memory:
         return {
             "sufficient": False,
-            "reason": f"显存不足: 需要 {estimated_memory:.1f}GB, 实际空闲 {gpu_info['free_memory']:.1f}GB",
+            "reason": f"显存不足: 需要 {estimated_memory:.1f}GB, 实际空闲 {gpu_info['free_memory']:.1f}GB, 已预留 {reserved_memory:.1f}GB",
             "required_memory": estimated_memory,
-            "available_memory": gpu_info["free_memory"],
+            "available_memory": available_memory,
+            "reserved_memory": reserved_memory,
             "gpu_info": gpu_info
         }
     
     # 添加安全余量检查（保留10%的显存作为缓冲）
     safety_margin = gpu_info["total_memory"] * 0.1
-    effective_available = gpu_info["free_memory"] - safety_margin
+    effective_available = available_memory - safety_margin
     
     if estimated_memory > effective_available:
         return {
             "sufficient": False,
             "reason": f"显存不足（含安全余量）: 需要 {estimated_memory:.1f}GB, 有效可用 {effective_available:.1f}GB",
             "required_memory": estimated_memory,
-            "available_memory": gpu_info["free_memory"],
+            "available_memory": available_memory,
             "effective_available": effective_available,
             "safety_margin": safety_margin,
             "gpu_info": gpu_info
         }
     
+    # 检查是否存在满足张量并行要求的GPU组
+    devices = gpu_utils.plan_placement(
+        estimate["per_gpu_gb"], tensor_parallel_size, gpu_utils.gpu_ledger.apply_to(gpu_info["gpus"]),
+        memory_fraction=gpu_memory_utilization
+    )
+    if not devices:
+        return {
+            "sufficient": False,
+            "reason": f"没有满足要求的GPU组: 需要 {tensor_parallel_size} 张连续的GPU，"
+                      f"每张空闲 {estimate['per_gpu_gb']:.1f}GB 且不少于总显存的 {gpu_memory_utilization:.0%}",
+            "required_memory": estimated_memory,
+            "available_memory": available_memory,
+            "gpu_info": gpu_info
+        }
+    
     return {
         "sufficient": True,
         "required_memory": estimated_memory,
-        "available_memory": gpu_info["free_memory"],
+        "available_memory": available_memory,
+        "placement": devices,
         "gpu_info": gpu_info
     }
 
+# 为推理任务选择GPU设备组
+def plan_task_placement(model_id: int, tensor_parallel_size: int = 1, max_model_len: int = 4096,
+                        quantization: Optional[str] = None, dtype: str = "auto",
+                        reservation_key: Optional[str] = None,
+                        extra_per_device_gb: float = 0.0,
+                        gpu_memory_utilization: float = 0.0) -> Dict[str, Any]:
+    """根据显存估算和扣除预留后的空闲显存，为推理任务选择GPU设备组
+    
+    指定reservation_key时，选择设备组和登记显存预留在账本锁内一次完成。
+    extra_per_device_gb为模型之外每张卡的额外显存（例如LoRA适配器槽位）。
+    vLLM启动后立即占用 gpu_memory_utilization × 总显存，每张卡按估算值和该值中较大的一个预留。
+    """
+    estimate = estimate_model_memory_detail(
+        model_id=model_id,
+        tensor_parallel_size=tensor_parallel_size,
+        max_model_len=max_model_len,
+        quantization=quantization,
+        dtype=dtype
+    )
+    estimate["per_gpu_gb"] += extra_per_device_gb
+    estimate["total_gb"] += extra_per_device_gb * tensor_parallel_size
+    result = {
+        "devices": None,
+        "per_device_memory": estimate["per_gpu_gb"],
+        "total_memory": estimate["total_gb"],
+        "reason": None
+    }
+    
+    gpu_info = get_real_gpu_info()
+    if not gpu_info["available"]:
+        result["reason"] = gpu_info.get("error", "没有可用的GPU")
+        return result
+    
+    if reservation_key:
+        result["devices"] = gpu_utils.gpu_ledger.reserve_placement(
+            reservation_key, "inference", estimate["per_gpu_gb"], tensor_parallel_size, gpu_info["gpus"],
+            memory_fraction=gpu_memory_utilization
+        )
+    else:
+        result["devices"] = gpu_utils.plan_placement(
+            estimate["per_gpu_gb"], tensor_parallel_size, gpu_utils.gpu_ledger.apply_to(gpu_info["gpus"]),
+            memory_fraction=gpu_memory_utilization
+        )
+    if result["devices"]:
+        needs = gpu_utils.device_requirements(estimate["per_gpu_gb"], gpu_info["gpus"], gpu_memory_utilization)
+        result["per_device_memory"] = max(needs[d] for d in result["devices"])
+        result["total_memory"] = sum(needs[d] for d in result["devices"])
+    else:
+        result["reason"] = f"需要 {tensor_parallel_size} 张连续的GPU，每张空闲 {estimate['per_gpu_gb']:.1f}GB"
+        if gpu_memory_utilization:
+            result["reason"] += f" 且不少于总显存的 {gpu_memory_utilization:.0%}"
+    return result
+
+# ========== 自动适配启动参数 ==========
+
+AUTOFIT_MEMORY_UTILIZATIONS = [0.85, 0.9, 0.95]
+AUTOFIT_MIN_MODEL_LEN = 1024
+
+def _autofit_option_score(weights_per_gpu: float, kv_per_seq_per_gpu: float, max_seqs: int) -> float:
+    """按显存带宽受限的解码模型估算相对吞吐（token/s的相对值）
+    
+    每个解码步需要读取一遍本卡权重和所有序列的KV cache（按平均半长上下文计），
+    吞吐 ≈ 并发序列数 / 单步读取量。
+    """
+    batch = max(1, min(max_seqs, 256))
+    step_bytes = weights_per_gpu + batch * kv_per_seq_per_gpu / 2
+    return batch / step_bytes if step_bytes > 0 else 0.0
+
+def plan_autofit_config(task: InferenceTask, max_options: int = 20) -> Dict[str, Any]:
+    """在任务可调的启动参数空间中搜索能放进当前空闲GPU的配置
+    
+    搜索维度：tensor_parallel_size、max_model_len、quantization、dtype、gpu_memory_utilization。
+    优先保留任务要求的上下文长度和精度，在此前提下选择估算吞吐最高的配置；
+    每个候选都给出按满长度序列计的并发容量。
+    """
+    model = get_resource(resource_id=task.model_id)
+    profile = load_model_profile(model.local_path) if model and model.local_path else None
+    if not profile:
+        return {"feasible": False, "reason": "无法读取模型的config.json，不能自动适配", "options": []}
+    
+    gpu_info = get_real_gpu_info()
+    if not gpu_info["available"]:
+        return {"feasible": False, "reason": gpu_info.get("error", "没有可用的GPU"), "options": []}
+    gpus = gpu_utils.gpu_ledger.apply_to(gpu_info["gpus"])
+    gb = 1024 ** 3
+    
+    # 张量并行度：2的幂，不超过GPU数量，且能整除注意力头数
+    tp_options = [tp for tp in (1, 2, 4, 8) if tp <= len(gpus) and profile["num_attention_heads"] % tp == 0]
+    
+    # 上下文长度：从任务设置开始逐级减半
+    len_cap = profile.get("max_position_embeddings") or task.max_model_len
+    length_options = []
+    length = min(task.max_model_len, len_cap)
+    while length >= AUTOFIT_MIN_MODEL_LEN:
+        length_options.append(length)
+        length //= 2
+    if not length_options:
+        length_options = [min(task.max_model_len, len_cap)]
+    
+    # 量化：预量化检查点只能使用自身的量化方式，否则可额外尝试在线fp8
+    if profile["checkpoint_quantization"]:
+        quant_options = [task.quantization]
+    else:
+        quant_options = [task.quantization] if task.quantization else [None, "fp8"]
+    
+    # 精度：float32检查点可以降为float16
+    dtype_options = [task.dtype]
+    if task.dtype == "auto" and str(profile["torch_dtype"]).lower() in ("float32", "float"):
+        dtype_options.append("float16")
+    
+    options = []
+    for tp in tp_options:
+        for max_model_len in length_options:
+            for quantization in quant_options:
+                for dtype in dtype_options:
+                    estimate = _estimate_from_profile(profile, tp, max_model_len, quantization, dtype)
+                    fixed_per_gpu = estimate["weights_per_gpu_gb"] + estimate["overhead_per_gpu_gb"]
+                    kv_per_seq_per_gpu = estimate["kv_bytes_per_token_per_gpu"] * max_model_len / gb
+                    
+                    # vLLM在每张卡上占用 gpu_memory_utilization * 总显存，扣除权重和开销后的部分作为KV cache
+                    min_total = min(g["memory_total"] for g in gpus)
+                    min_util = (fixed_per_gpu + kv_per_seq_per_gpu) / min_total
+                    util_options = sorted({round(-(-min_util * 20 // 1) / 20, 2), *AUTOFIT_MEMORY_UTILIZATIONS})
+                    for util in util_options:
+                        if util < min_util or util > 0.95:
+                            continue
+                        budget = util * min_total
+                        devices = gpu_utils.plan_placement(budget, tp, gpus)
+                        if not devices:
+                            continue
+                        max_seqs = int((budget - fixed_per_gpu) // kv_per_seq_per_gpu) if kv_per_seq_per_gpu > 0 else 0
+                        if max_seqs < 1:
+                            continue
+                        options.append({
+                            "tensor_parallel_size": tp,
+                            "max_model_len": max_model_len,
+                            "quantization": quantization,
+                            "dtype": dtype,
+                            "gpu_memory_utilization": util,
+                            "devices": devices,
+                            "per_device_memory": budget,
+                            "max_concurrent_seqs": max_seqs,
+                            "relative_throughput": _autofit_option_score(fixed_per_gpu, kv_per_seq_per_gpu, max_seqs),
+                            "keeps_precision": quantization == task.quantization and dtype == task.dtype
+                        })
+    
+    if not options:
+        return {"feasible": False, "reason": "当前空闲显存下没有可用的启动配置", "options": []}
+    
+    # 上下文长度越长越好，其次保持精度，最后比较吞吐
+    options.sort(key=lambda o: (o["max_model_len"], o["keeps_precision"], o["relative_throughput"]), reverse=True)
+    best_throughput = max(o["relative_throughput"] for o in options)
+    for option in options:
+        option["relative_throughput"] = round(option["relative_throughput"] / best_throughput, 3)
+    return {"feasible": True, "best": options[0], "options": options[:max_options]}
+
+# ========== vLLM引擎调优配置 ==========
+
+# 命名的引擎配置：启动时按任务的engine_profile展开为vLLM参数
+ENGINE_PROFILES: Dict[str, Dict[str, Any]] = {
+    "latency": {
+        "description": "低延迟：启用CUDA图，小批次和较小的预填充块，减少排队和单步耗时",
+        "enforce_eager": False,
+        "enable_prefix_caching": True,
+        "max_num_seqs": 32,
+        "max_num_batched_tokens": 2048
+    },
+    "throughput": {
+        "description": "高吞吐：启用CUDA图，大批次和大token预算，适合并发请求多的稳定负载",
+        "enforce_eager": False,
+        "enable_prefix_caching": True,
+        "max_num_seqs": 256,
+        "max_num_batched_tokens": 16384
+    },
+    "low_memory": {
+        "description": "低显存：禁用CUDA图省下图缓存显存，限制并发序列数，启动也更快",
+        "enforce_eager": True,
+        "enable_prefix_caching": False,
+        "max_num_seqs": 16,
+        "max_num_batched_tokens": 2048
+    }
+}
+DEFAULT_ENGINE_PROFILE = "throughput"
+
+def get_engine_profile(name: Optional[str]) -> Dict[str, Any]:
+    """获取引擎配置，未知名称回退到默认配置"""
+    if name not in ENGINE_PROFILES:
+        if name:
+            logger.warning(f"未知的引擎配置 {name}，使用默认配置 {DEFAULT_ENGINE_PROFILE}")
+        name = DEFAULT_ENGINE_PROFILE
+    return ENGINE_PROFILES[name]
+
+def build_engine_args(task: InferenceTask) -> List[str]:
+    """把任务的引擎配置展开为vLLM命令行参数"""
+    profile = get_engine_profile(task.engine_profile)
+    args = ["--max-num-seqs", str(profile["max_num_seqs"])]
+    
+    # 所有配置都分块预填充，max_num_batched_tokens即每步的token预算
+    args.append("--enable-chunked-prefill")
+    args.extend(["--max-num-batched-tokens", str(profile["max_num_batched_tokens"])])
+    
+    # 多副本时会话粘滞依赖前缀缓存，无论配置如何都开启
+    if profile["enable_prefix_caching"] or (task.replicas or 1) > 1:
+        args.append("--enable-prefix-caching")
+    if profile["enforce_eager"]:
+        args.append("--enforce-eager")
+    return args
+
 # 构建vLLM启动命令
-def build_vllm_command(task: InferenceTask, model_path: str) -> List[str]:
-    """构建vLLM启动命令"""
-    # 确保端口有效
-    port = task.port
+def build_vllm_command(task: InferenceTask, model_path: str, port: Optional[int] = None) -> List[str]:
+    """构建vLLM启动命令，port为空时使用任务记录中的端口"""
+    # 确保端口有效（端口应已由allocate_port租用）
+    port = port or task.port
     if not port:
-        # 如果端口为空，分配一个新端口
-        port = find_available_port(start_port=8000)
+        # 如果端口为空，为任务租用一个新端口
+        port = allocate_port(task.id)
         logger.info(f"任务端口为空，分配新端口: {port}")
     
     command = [
@@ -360,12 +966,22 @@ def build_vllm_command(task: InferenceTask, model_path: str) -> List[str]:
         "--served-model-name", task.name,  # 添加模型名称参数
         "--disable-log-requests",  # 禁用详细请求日志
         "--trust-remote-code",  # 信任远程代码，提高兼容性
-        "--enforce-eager",  # 禁用torch.compile以加快启动速度
-        "--gpu-memory-utilization", "0.85",  # 降低GPU内存使用率，提高稳定性
-        "--max-num-batched-tokens", "4096",  # 限制批处理token数量
+        "--gpu-memory-utilization", str(task.gpu_memory_utilization),  # 每张卡允许vLLM使用的显存比例
         "--disable-log-stats"  # 禁用统计日志
     ]
     
+    # 添加引擎调优参数（CUDA图、分块预填充、前缀缓存、批次大小）
+    command.extend(build_engine_args(task))
+    
+    # 多LoRA服务：预留max_loras个适配器槽位，其余已加载的适配器缓存在CPU内存中按需换入
+    if task.enable_lora:
+        command.extend([
+            "--enable-lora",
+            "--max-loras", str(task.max_loras),
+            "--max-lora-rank", str(task.max_lora_rank),
+            "--max-cpu-loras", str(max(task.max_loras, LORA_MAX_CPU_ADAPTERS))
+        ])
+    
     # 添加量化参数（如果启用）
     if task.quantization:
         command.extend(["--quantization", task.quantization])
@@ -376,14 +992,678 @@ def build_vllm_command(task: InferenceTask, model_path: str) -> List[str]:
     
     return command, port  # 返回命令和使用的端口
 
+# ========== LoRA适配器 ==========
+
+# 基础模型引擎在CPU内存中缓存的适配器数量上限
+LORA_MAX_CPU_ADAPTERS = int(os.environ.get("INFERENCE_MAX_CPU_LORAS", "32"))
+# vLLM为每个槽位预分配的LoRA权重覆盖的线性层：q/k/v/o 与 gate/up/down
+LORA_ATTENTION_PROJECTIONS = 4
+LORA_MLP_PROJECTIONS = 3
+
+def estimate_lora_memory(task: InferenceTask, model_path: Optional[str]) -> float:
+    """估算基础模型引擎为LoRA槽位预分配的每卡显存（GB）
+
+    每个槽位、每层、每个线性层预分配 rank × (输入维度 + 输出维度) 个16位参数，
+    7B模型rank为16时每个槽位约80MB，10个适配器不到1GB。
+    """
+    if not task.enable_lora or not model_path:
+        return 0.0
+    profile = load_model_profile(model_path)
+    if not profile:
+        return 0.0
+    hidden = profile["hidden_size"]
+    intermediate = profile["intermediate_size"] or hidden * 4
+    per_layer = (LORA_ATTENTION_PROJECTIONS * 2 * hidden + LORA_MLP_PROJECTIONS * (hidden + intermediate)) * task.max_lora_rank
+    total_bytes = per_layer * profile["num_layers"] * task.max_loras * 2
+    return total_bytes / (1024 ** 3) / max(1, task.tensor_parallel_size)
+
+def find_adapter_dir(adapter_path: str) -> Optional[Path]:
+    """定位包含adapter_config.json的适配器目录（兼容嵌套一层的输出目录）"""
+    root = Path(adapter_path)
+    if (root / "adapter_config.json").is_file():
+        return root
+    if root.is_dir():
+        for child in sorted(root.iterdir()):
+            if child.is_dir() and (child / "adapter_config.json").is_file():
+                return child
+    return None
+
+def read_adapter_config(adapter_path: str) -> Optional[Dict[str, Any]]:
+    """读取适配器的adapter_config.json，不是LoRA适配器时返回None"""
+    adapter_dir = find_adapter_dir(adapter_path)
+    if not adapter_dir:
+        return None
+    try:
+        with open(adapter_dir / "adapter_config.json", "r", encoding="utf-8") as f:
+            config = json.load(f)
+    except Exception as e:
+        logger.warning(f"读取适配器配置失败: {adapter_dir}, 错误: {str(e)}")
+        return None
+    config["adapter_dir"] = str(adapter_dir.resolve())
+    return config
+
+def _engine_ports(base_task_id: int) -> List[int]:
+    """基础模型任务所有就绪副本的端口"""
+    ports = [p["port"] for p in get_task_processes(base_task_id) if p.get("ready")]
+    if not ports:
+        base = get_inference_task(task_id=base_task_id)
+        if base and base.port:
+            ports = [base.port]
+    return ports
+
+async def _post_lora_request(port: int, action: str, payload: Dict[str, Any]) -> Tuple[bool, str]:
+    """调用vLLM运行时LoRA接口（load_lora_adapter / unload_lora_adapter）"""
+    url = f"http://localhost:{port}/v1/{action}"
+    try:
+        response = await asyncio.to_thread(requests.post, url, json=payload, timeout=120)
+    except requests.exceptions.RequestException as e:
+        return False, f"请求失败: {str(e)}"
+    if response.status_code == 200:
+        return True, response.text[:200]
+    # 重复加载或卸载未加载的适配器不算错误
+    if response.status_code in (400, 404) and ("already" in response.text or "not found" in response.text.lower()):
+        return True, response.text[:200]
+    return False, f"HTTP {response.status_code}: {response.text[:300]}"
+
+async def load_adapter_on_port(port: int, adapter_name: str, adapter_dir: str) -> Tuple[bool, str]:
+    """把适配器热加载到一个基础模型引擎副本上"""
+    ok, detail = await _post_lora_request(port, "load_lora_adapter", {"lora_name": adapter_name, "lora_path": adapter_dir})
+    if ok:
+        logger.info(f"已加载LoRA适配器: {adapter_name}, 端口={port}")
+    else:
+        logger.error(f"加载LoRA适配器失败: {adapter_name}, 端口={port}, {detail}")
+    return ok, detail
+
+async def unload_adapter_on_port(port: int, adapter_name: str) -> Tuple[bool, str]:
+    """从一个基础模型引擎副本上卸载适配器"""
+    ok, detail = await _post_lora_request(port, "unload_lora_adapter", {"lora_name": adapter_name})
+    if ok:
+        logger.info(f"已卸载LoRA适配器: {adapter_name}, 端口={port}")
+    else:
+        logger.warning(f"卸载LoRA适配器失败: {adapter_name}, 端口={port}, {detail}")
+    return ok, detail
+
+def get_adapter_tasks(base_task_id: int, statuses: Optional[Tuple[str, ...]] = None) -> List[InferenceTask]:
+    """挂载在基础模型任务上的适配器任务"""
+    return [
+        t for t in get_all_inference_tasks()
+        if t.base_task_id == base_task_id and (statuses is None or t.status in statuses)
+    ]
+
+async def _reload_adapters(base_task_id: int, port: int) -> None:
+    """新副本就绪后，把运行中的适配器加载到该副本上"""
+    for adapter in get_adapter_tasks(base_task_id, (InferenceStatus.RUNNING,)):
+        adapter_config = read_adapter_config(adapter.adapter_path or "")
+        if adapter_config:
+            await load_adapter_on_port(port, adapter.name, adapter_config["adapter_dir"])
+
+async def start_adapter_service(task: InferenceTask) -> bool:
+    """把适配器任务热加载到基础模型引擎的全部副本上，不启动新进程"""
+    def fail(error_msg: str) -> bool:
+        logger.error(f"启动LoRA适配器任务失败: {task.id}, {error_msg}")
+        update_inference_task(task_id=task.id, status=InferenceStatus.FAILED, error_message=error_msg)
+        return False
+
+    base = get_inference_task(task_id=task.base_task_id)
+    if not base:
+        return fail(f"基础模型推理任务不存在: {task.base_task_id}")
+    if not base.enable_lora:
+        return fail(f"基础模型推理任务 {base.id} 未开启LoRA服务")
+    if base.status == InferenceStatus.IDLE:
+        # 基础模型空闲休眠时先冷启动基础模型
+        try:
+            base = await lifecycle_utils.ensure_running(base.id)
+        except RuntimeError as e:
+            return fail(f"基础模型推理任务启动失败: {str(e)}")
+    if base.status != InferenceStatus.RUNNING:
+        return fail(f"基础模型推理任务未运行，当前状态: {base.status}")
+
+    adapter_config = read_adapter_config(task.adapter_path or get_model_path(task.model_id) or "")
+    if not adapter_config:
+        return fail(f"找不到LoRA适配器（adapter_config.json）: {task.adapter_path}")
+    rank = adapter_config.get("r") or 0
+    if rank > base.max_lora_rank:
+        return fail(f"适配器rank为 {rank}，超过基础模型引擎的max_lora_rank={base.max_lora_rank}")
+
+    ports = _engine_ports(base.id)
+    if not ports:
+        return fail("基础模型推理服务地址未就绪")
+    results = await asyncio.gather(*(load_adapter_on_port(port, task.name, adapter_config["adapter_dir"]) for port in ports))
+    errors = [detail for ok, detail in results if not ok]
+    if errors:
+        # 部分副本加载失败时回滚，避免请求落到没有该适配器的副本上
+        await asyncio.gather(*(unload_adapter_on_port(port, task.name) for port in ports))
+        return fail(f"加载LoRA适配器失败: {errors[0]}")
+
+    update_inference_task(
+        task_id=task.id,
+        status=InferenceStatus.RUNNING,
+        port=base.port,
+        api_base=f"http://localhost:{base.port}/v1",
+        gpu_memory=0,
+        gpu_devices=base.gpu_devices,
+        adapter_path=adapter_config["adapter_dir"],
+        started_at=datetime.now(),
+        clear=["error_message"]
+    )
+    lifecycle_utils.mark_request(task.id)
+    logger.info(f"LoRA适配器任务已启动: {task.id}, 适配器={task.name}, 基础模型任务={base.id}, 副本数={len(ports)}")
+    return True
+
+async def stop_adapter_service(task: InferenceTask) -> bool:
+    """从基础模型引擎上卸载适配器"""
+    ports = _engine_ports(task.base_task_id) if task.base_task_id else []
+    if ports:
+        await asyncio.gather(*(unload_adapter_on_port(port, task.name) for port in ports))
+    update_inference_task(task_id=task.id, status=InferenceStatus.STOPPED, stopped_at=datetime.now())
+    logger.info(f"LoRA适配器任务已停止: {task.id}, 适配器={task.name}")
+    return True
+
+def _stop_dependent_adapters(base_task_id: int) -> None:
+    """基础模型停止后，挂载在它上面的适配器任务随之停止"""
+    for adapter in get_adapter_tasks(base_task_id, lifecycle_utils.AVAILABLE_STATUSES):
+        update_inference_task(
+            task_id=adapter.id,
+            status=InferenceStatus.STOPPED,
+            stopped_at=datetime.now(),
+            error_message="基础模型推理服务已停止"
+        )
+
+# ========== 推理副本 ==========
+
+MAX_REPLICAS = int(os.environ.get("INFERENCE_MAX_REPLICAS", "8"))
+
+# 每个任务的扩缩容锁，避免并发调整副本数
+_scale_locks: Dict[int, asyncio.Lock] = {}
+
+def _replica_key(task_id: int, replica: int) -> str:
+    """副本的显存预留key，0号副本沿用任务级key"""
+    return f"inference:{task_id}" if replica == 0 else f"inference:{task_id}:{replica}"
+
+def _replica_log_file(task_id: int, replica: int) -> Path:
+    """副本的日志文件，0号副本沿用任务级日志文件"""
+    if replica == 0:
+        return LOGS_DIR / f"inference_{task_id}.log"
+    return LOGS_DIR / f"inference_{task_id}_r{replica}.log"
+
+def get_replica_log_file(task_id: int, replica: int = 0) -> Path:
+    """副本日志文件的路径"""
+    return _replica_log_file(task_id, replica)
+
+def get_task_processes(task_id: int) -> List[Dict[str, Any]]:
+    """获取推理任务的全部副本进程，按副本编号排序"""
+    return sorted(
+        (p for p in active_processes if p["task_id"] == task_id),
+        key=lambda p: p.get("replica", 0)
+    )
+
+def _release_replica(process_info: Dict[str, Any]) -> None:
+    """把副本从路由和进程列表中移除，并释放它的端口和显存预留"""
+    task_id = process_info["task_id"]
+    replica = process_info.get("replica", 0)
+    routing_utils.replica_router.unregister(task_id, replica)
+    if process_info in active_processes:
+        active_processes.remove(process_info)
+    release_port(process_info["port"])
+    gpu_utils.gpu_ledger.release(_replica_key(task_id, replica))
+    try:
+        remove_inference_process(task_id, replica)
+    except Exception as e:
+        logger.error(f"移除推理进程记录失败: {str(e)}")
+
+def _sync_task_replicas(task_id: int) -> None:
+    """把当前就绪副本的端口、进程和GPU放置写回任务记录
+
+    任务的port/api_base指向编号最小的就绪副本，gpu_devices中各副本的设备组用分号分隔。
+    """
+    processes = [p for p in get_task_processes(task_id) if p.get("ready")]
+    if not processes:
+        return
+    primary = processes[0]
+    update_inference_task(
+        task_id=task_id,
+        port=primary["port"],
+        api_base=f"http://localhost:{primary['port']}/v1",
+        process_id=primary["process"].pid,
+        gpu_memory=sum(p["gpu_memory"] for p in processes),
+        gpu_devices=";".join(",".join(str(d) for d in p["gpu_devices"]) for p in processes)
+    )
+
+def _record_process(process_info: Dict[str, Any]) -> None:
+    """把副本进程写入数据库，服务重启后据此重新接管"""
+    pid = process_info["process"].pid
+    try:
+        created_at = psutil.Process(pid).create_time()
+    except psutil.Error:
+        created_at = None
+    try:
+        register_inference_process(
+            task_id=process_info["task_id"],
+            replica=process_info.get("replica", 0),
+            pid=pid,
+            port=process_info["port"],
+            gpu_devices=process_info["gpu_devices"],
+            gpu_memory=process_info["gpu_memory"],
+            gpu_memory_per_device=process_info["gpu_memory_per_device"],
+            command=process_info["command"],
+            process_created_at=created_at
+        )
+    except Exception as e:
+        logger.error(f"记录推理进程失败: {str(e)}")
+
+def _watch_log(process_info: Dict[str, Any], log_file: Path, from_end: bool = False) -> None:
+    """在副本运行期间维护它的日志文件（轮转，以及可选的转发到服务日志）"""
+    log_utils.watch(log_file, lambda: process_info in active_processes, "vLLM输出", from_end=from_end)
+
+async def _launch_replica(task_id: int, model_path: str, replica: int) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """启动一个推理副本（vLLM或CPU引擎）并等待其就绪
+
+    副本使用独立的端口、GPU设备组（CPU引擎不占用GPU）和日志文件。成功时返回进程信息，
+    失败时清理该副本占用的资源并返回错误信息。每次启动的各阶段耗时都会被记录。
+    """
+    task = get_inference_task(task_id=task_id)
+    timeline = startup_utils.StartupTimeline(task_id, replica, task.model_id)
+    timeline.engine = {
+        "engine": task.engine or ENGINE_VLLM,
+        "engine_profile": task.engine_profile or DEFAULT_ENGINE_PROFILE,
+        "tensor_parallel_size": task.tensor_parallel_size,
+        "max_model_len": task.max_model_len,
+        "quantization": task.quantization,
+        "dtype": task.dtype,
+        "enable_lora": bool(task.enable_lora),
+        **startup_utils.weight_files_info(_find_model_dir(model_path) if model_path else None)
+    }
+    info, error = None, "启动过程异常中断"
+    try:
+        info, error = await _launch_replica_steps(task, model_path, replica, timeline)
+        return info, error
+    finally:
+        timeline.finish(info is not None, error if info is None else None)
+
+async def _launch_replica_steps(task: InferenceTask, model_path: str, replica: int,
+                                timeline: "startup_utils.StartupTimeline") -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    task_id = task.id
+    
+    # 原子地租用端口
+    try:
+        port = allocate_port(task_id)
+        logger.info(f"为推理任务 {task_id} 副本 {replica} 分配端口: {port}")
+    except Exception as e:
+        return None, f"无法找到可用端口: {str(e)}"
+    timeline.mark("port_allocated")
+    
+    if task.engine == ENGINE_CPU:
+        # CPU引擎不占用GPU
+        placement = {"devices": [], "per_device_memory": 0.0, "total_memory": 0.0}
+        gpu_devices = []
+        command, used_port = build_cpu_engine_command(task, model_path, port), port
+    else:
+        # 选择GPU设备组
+        placement = plan_task_placement(
+            model_id=task.model_id,
+            tensor_parallel_size=task.tensor_parallel_size,
+            max_model_len=task.max_model_len,
+            quantization=task.quantization,
+            dtype=task.dtype,
+            reservation_key=_replica_key(task_id, replica),
+            extra_per_device_gb=estimate_lora_memory(task, model_path),
+            gpu_memory_utilization=task.gpu_memory_utilization
+        )
+        if not placement["devices"]:
+            release_port(port)
+            return None, f"无法为推理任务分配GPU: {placement['reason']}"
+        gpu_devices = placement["devices"]
+        timeline.mark("gpu_placed")
+        logger.info(f"为推理任务 {task_id} 副本 {replica} 分配GPU: {gpu_devices}, 每卡预计显存 {placement['per_device_memory']:.1f}GB")
+        
+        # 构建命令
+        command, used_port = build_vllm_command(task, model_path, port=port)
+    command_str = " ".join(command)
+    logger.info(f"启动推理服务: {command_str}")
+    
+    # 准备日志文件
+    log_file = _replica_log_file(task_id, replica)
+    logger.info(f"推理日志文件路径: {log_file}")
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    
+    try:
+        # 将vLLM固定到分配的GPU上
+        env = os.environ.copy()
+        env["CUDA_VISIBLE_DEVICES"] = ",".join(str(d) for d in gpu_devices)  # CPU引擎为空，不使用GPU
+        # GPU编号来自nvidia-smi（PCI总线顺序），CUDA默认按算力排序，混合GPU的机器上两者不一致
+        env["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+        if task.enable_lora:
+            # 允许通过API在运行时加载和卸载适配器
+            env["VLLM_ALLOW_RUNTIME_LORA_UPDATING"] = "True"
+        # 引擎输出直接写入日志文件，并放在独立的会话中，管理服务重启后引擎不受影响、可以重新接管
+        # 优先使用预热进程，省去解释器启动和依赖导入的时间
+        with log_utils.open_for_engine(log_file) as log_fp:
+            process = await lifecycle_utils.prewarm_pool.launch(command, env, log_file=str(log_file))
+            timeline.prewarmed = process is not None
+            if process is None:
+                process = await asyncio.create_subprocess_exec(
+                    *command,
+                    stdout=log_fp,
+                    stderr=asyncio.subprocess.STDOUT,
+                    env=env,
+                    start_new_session=True
+                )
+    except FileNotFoundError as e:
+        release_port(used_port)
+        gpu_utils.gpu_ledger.release(_replica_key(task_id, replica))
+        return None, f"找不到Python或推理引擎模块: {str(e)}"
+    except PermissionError as e:
+        release_port(used_port)
+        gpu_utils.gpu_ledger.release(_replica_key(task_id, replica))
+        return None, f"权限错误，无法创建日志文件或启动进程: {str(e)}"
+    
+    logger.info(f"推理进程启动成功: 任务={task_id}, 副本={replica}, PID={process.pid}")
+    gpu_utils.gpu_ledger.attach_pid(_replica_key(task_id, replica), process.pid)
+    timeline.mark("process_spawned")
+    timeline.watch_log(log_file)
+    
+    # 记录进程信息
+    process_info = {
+        "task_id": task_id,
+        "replica": replica,
+        "process": process,
+        "command": command_str,
+        "port": used_port,
+        "gpu_memory": placement["total_memory"],
+        "gpu_memory_per_device": placement["per_device_memory"],
+        "gpu_devices": gpu_devices,
+        "gpu_device": gpu_devices[0] if gpu_devices else None,
+        "ready": False
+    }
+    active_processes.append(process_info)
+    _record_process(process_info)
+    _watch_log(process_info, log_file)
+    
+    # 等待服务启动（引擎日志显示API服务已启动时提前检查）
+    await timeline.wait(15)
+    
+    # 检查服务是否成功启动
+    tries = 0
+    max_tries = 40  # 总共约210秒超时
+    while tries < max_tries:
+        # 检查进程是否仍在运行
+        if process.returncode is not None:
+            log_excerpt = log_utils.read_excerpt(log_file, 30)
+            error_msg = f"推理服务进程已终止: 退出码={process.returncode}"
+            logger.error(f"{error_msg}\n日志摘要:\n{log_excerpt}")
+            _release_replica(process_info)
+            return None, f"{error_msg}\n\n最近的日志信息:\n{log_excerpt}" if log_excerpt else error_msg
+        
+        # 副本在启动过程中被停止
+        if process_info not in active_processes:
+            return None, "推理服务在启动过程中被停止"
+            
+        try:
+            # 检查服务健康状态
+            logger.info(f"尝试连接推理服务健康检查: http://localhost:{used_port}/v1/models (尝试 {tries+1}/{max_tries})")
+            response = await asyncio.to_thread(requests.get, f"http://localhost:{used_port}/v1/models", timeout=10)
+            if response.status_code == 200:
+                logger.info(f"推理服务准备就绪: 任务={task_id}, 副本={replica}, 端口={used_port}, 响应={response.text[:100]}")
+                timeline.mark("http_ready")
+                process_info["ready"] = True
+                if task.enable_lora:
+                    await _reload_adapters(task_id, used_port)
+                routing_utils.replica_router.register(task_id, replica, used_port)
+                return process_info, None
+            else:
+                logger.warning(f"推理服务健康检查返回非200状态码: {response.status_code}, 响应: {response.text[:100]}")
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"推理服务健康检查连接失败: {str(e)}")
+        except Exception as e:
+            logger.warning(f"推理服务健康检查出错: {str(e)}")
+        
+        # 根据尝试次数调整等待时间
+        if tries < 10:
+            wait_time = 3  # 前10次等待3秒
+        elif tries < 20:
+            wait_time = 5  # 中间10次等待5秒
+        else:
+            wait_time = 10  # 后面等待10秒
+            
+        await timeline.wait(wait_time)
+        tries += 1
+    
+    # 如果服务未能启动，终止进程
+    log_excerpt = log_utils.read_excerpt(log_file, 20)
+    logger.error(f"推理服务日志摘要:\n{log_excerpt}")
+    error_msg = f"推理服务启动超时（等待了{max_tries * 5}秒）"
+    logger.error(f"{error_msg}: 任务={task_id}, 副本={replica}")
+    try:
+        process.terminate()
+    except Exception:
+        pass
+    _release_replica(process_info)
+    return None, f"{error_msg}\n\n最近的日志信息:\n{log_excerpt}" if log_excerpt else error_msg
+
+async def _stop_replica(process_info: Dict[str, Any], drain_timeout: Optional[float] = None) -> None:
+    """停止一个副本；指定drain_timeout时先停止分配新请求并等待未完成请求结束"""
+    task_id = process_info["task_id"]
+    replica = process_info.get("replica", 0)
+    process_info["stopping"] = True
+    if drain_timeout:
+        routing_utils.replica_router.drain(task_id, replica)
+        await routing_utils.replica_router.wait_drained(task_id, replica, timeout=drain_timeout)
+    
+    process = process_info["process"]
+    try:
+        # 尝试优雅终止
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=5.0)
+        except asyncio.TimeoutError:
+            # 如果进程未能在5秒内终止，强制杀死
+            process.kill()
+    except ProcessLookupError:
+        pass
+    logger.info(f"推理副本已停止: 任务={task_id}, 副本={replica}, PID={process.pid}")
+    _release_replica(process_info)
+
+class AdoptedProcess:
+    """服务重启后重新接管的引擎进程
+
+    它不是当前进程的子进程，通过psutil提供与asyncio子进程相同的pid、returncode、
+    terminate、kill和wait接口；无法获得真实退出码，退出后returncode为-1。
+    """
+
+    def __init__(self, process: psutil.Process):
+        self._process = process
+        self.pid = process.pid
+        self._returncode: Optional[int] = None
+
+    @classmethod
+    def attach(cls, pid: int, created_at: Optional[float]) -> Optional["AdoptedProcess"]:
+        """接管仍在运行的进程；进程已退出或PID已被其他进程复用时返回None"""
+        try:
+            process = psutil.Process(pid)
+            if process.status() == psutil.STATUS_ZOMBIE:
+                return None
+            if created_at is not None:
+                if abs(process.create_time() - created_at) > 1.0:
+                    return None
+            elif not any("vllm" in part or "prewarm_worker" in part for part in process.cmdline()):
+                return None
+        except psutil.Error:
+            return None
+        return cls(process)
+
+    @property
+    def returncode(self) -> Optional[int]:
+        if self._returncode is None:
+            try:
+                alive = self._process.is_running() and self._process.status() != psutil.STATUS_ZOMBIE
+            except psutil.Error:
+                alive = False
+            if not alive:
+                self._returncode = -1
+        return self._returncode
+
+    def terminate(self) -> None:
+        try:
+            self._process.terminate()
+        except psutil.NoSuchProcess:
+            raise ProcessLookupError(self.pid)
+
+    def kill(self) -> None:
+        try:
+            self._process.kill()
+        except psutil.NoSuchProcess:
+            raise ProcessLookupError(self.pid)
+
+    async def wait(self) -> int:
+        while self.returncode is None:
+            await asyncio.sleep(0.2)
+        return self._returncode
+
+async def _probe_engine(port: int, attempts: int = 3) -> bool:
+    """确认端口上的引擎能正常响应"""
+    for attempt in range(attempts):
+        try:
+            response = await asyncio.to_thread(requests.get, f"http://localhost:{port}/v1/models", timeout=5)
+            if response.status_code == 200:
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        if attempt < attempts - 1:
+            await asyncio.sleep(2)
+    return False
+
+async def _terminate_adopted(process: AdoptedProcess) -> None:
+    try:
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=10.0)
+        except asyncio.TimeoutError:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+def _adopt_replica(record: Dict[str, Any], process: AdoptedProcess) -> Dict[str, Any]:
+    """把重新接管的副本登记到进程列表、端口租约、显存账本、路由和日志跟踪中"""
+    task_id = record["task_id"]
+    replica = record["replica"]
+    devices = [int(d) for d in (record.get("gpu_devices") or "").split(",") if d.strip()]
+    per_device = record.get("gpu_memory_per_device") or 0.0
+    gpu_utils.gpu_ledger.reserve(_replica_key(task_id, replica), "inference",
+                                 {d: per_device for d in devices}, pid=process.pid)
+    with _port_lock:
+        port_leases[record["port"]] = task_id
+    process_info = {
+        "task_id": task_id,
+        "replica": replica,
+        "process": process,
+        "command": record.get("command") or "",
+        "port": record["port"],
+        "gpu_memory": record.get("gpu_memory") or 0.0,
+        "gpu_memory_per_device": per_device,
+        "gpu_devices": devices,
+        "gpu_device": devices[0] if devices else None,
+        "ready": True,
+        "adopted": True
+    }
+    active_processes.append(process_info)
+    routing_utils.replica_router.register(task_id, replica, record["port"])
+    _watch_log(process_info, _replica_log_file(task_id, replica), from_end=True)
+    logger.info(f"已重新接管推理副本: 任务={task_id}, 副本={replica}, PID={process.pid}, 端口={record['port']}")
+    return process_info
+
+def _legacy_process_records(task: InferenceTask) -> List[Dict[str, Any]]:
+    """没有进程记录的运行中任务（由旧版本启动），按任务记录中的主进程和端口接管"""
+    if not task.process_id or not task.port:
+        return []
+    devices = (task.gpu_devices or "").split(";")[0]
+    device_count = max(1, len([d for d in devices.split(",") if d.strip()]))
+    return [{
+        "task_id": task.id,
+        "replica": 0,
+        "pid": task.process_id,
+        "port": task.port,
+        "gpu_devices": devices,
+        "gpu_memory": task.gpu_memory or 0.0,
+        "gpu_memory_per_device": (task.gpu_memory or 0.0) / device_count,
+        "command": "",
+        "process_created_at": None
+    }]
+
+async def reattach_inference_processes() -> Dict[str, List[Dict[str, Any]]]:
+    """服务重启后对账推理引擎进程
+
+    根据数据库中的进程记录查找仍在运行的引擎，确认 /v1/models 可以访问后重新接管
+    （路由、端口、显存账本、日志跟踪和进程监督照常工作）；已退出或无响应的副本清除记录，
+    任务一个副本都不剩时按是否开启空闲休眠标记为IDLE或FAILED；
+    已停止任务遗留的引擎进程会被终止，释放GPU。
+    """
+    records_by_task: Dict[int, List[Dict[str, Any]]] = {}
+    for record in get_inference_processes():
+        records_by_task.setdefault(record["task_id"], []).append(record)
+    tasks = {task.id: task for task in get_all_inference_tasks()}
+    for task in tasks.values():
+        if task.base_task_id or task.status not in (InferenceStatus.RUNNING, InferenceStatus.CREATING):
+            continue
+        if task.id not in records_by_task:
+            records_by_task[task.id] = _legacy_process_records(task)
+    
+    result = {"adopted": [], "lost": [], "orphans": []}
+    for task_id, records in records_by_task.items():
+        task = tasks.get(task_id)
+        live = task is not None and not task.base_task_id and task.status in (InferenceStatus.RUNNING, InferenceStatus.CREATING)
+        for record in records:
+            item = {"task_id": task_id, "replica": record["replica"], "pid": record["pid"], "port": record["port"]}
+            process = AdoptedProcess.attach(record["pid"], record.get("process_created_at"))
+            if live and process and await _probe_engine(record["port"]):
+                _adopt_replica(record, process)
+                result["adopted"].append(item)
+                continue
+            if process:
+                # 任务已停止时遗留的引擎，或进程存在但无法响应
+                logger.warning(f"终止{'无响应' if live else '遗留'}的推理引擎进程: 任务={task_id}, "
+                               f"副本={record['replica']}, PID={record['pid']}")
+                await _terminate_adopted(process)
+            result["lost" if live else "orphans"].append(item)
+            remove_inference_process(task_id, record["replica"])
+        
+        if not live:
+            continue
+        if get_task_processes(task_id):
+            _sync_task_replicas(task_id)
+            if task.status == InferenceStatus.CREATING:
+                update_inference_task(task_id=task_id, status=InferenceStatus.RUNNING, started_at=datetime.now())
+            continue
+        
+        # 一个副本都不剩
+        routing_utils.replica_router.remove_task(task_id)
+        release_task_resources(task_id)
+        if task.idle_timeout:
+            adapters = get_adapter_tasks(task_id, (InferenceStatus.RUNNING,))
+            update_inference_task(task_id=task_id, status=InferenceStatus.IDLE,
+                                  error_message="服务重启期间推理进程已退出，收到请求时自动启动")
+            for adapter in adapters:
+                update_inference_task(task_id=adapter.id, status=InferenceStatus.IDLE)
+        else:
+            update_inference_task(task_id=task_id, status=InferenceStatus.FAILED, stopped_at=datetime.now(),
+                                  error_message="服务重启期间推理进程已退出")
+            _stop_dependent_adapters(task_id)
+    
+    logger.info(f"推理进程对账完成: 重新接管 {len(result['adopted'])} 个副本, "
+                f"已退出 {len(result['lost'])} 个, 终止遗留进程 {len(result['orphans'])} 个")
+    return result
+
 # 启动vLLM服务
 async def start_inference_service(task_id: int) -> bool:
-    """启动推理服务"""
+    """启动推理服务，按任务的replicas设置并行启动多个副本"""
     task = get_inference_task(task_id=task_id)
     if not task:
         logger.error(f"找不到推理任务: {task_id}")
         return False
     
+    # LoRA适配器任务挂载到基础模型引擎上，不启动自己的进程
+    if task.base_task_id:
+        return await start_adapter_service(task)
+    
     # 获取模型路径
     model_path = get_model_path(task.model_id)
     if not model_path:
@@ -410,234 +1690,42 @@ async def start_inference_service(task_id: int) -> bool:
     
     logger.info(f"模型路径验证成功: {model_path}")
     
-    # 查找可用端口
-    try:
-        port = find_available_port(start_port=8000)
-        logger.info(f"为推理任务 {task_id} 分配端口: {port}")
-    except Exception as e:
-        error_msg = f"无法找到可用端口: {str(e)}"
-        logger.error(error_msg)
-        update_inference_task(
-            task_id=task_id,
-            status=InferenceStatus.FAILED,
-            error_message=error_msg
-        )
-        return False
+    # 手动启动时复位监督状态（包括已打开的熔断），释放该任务残留的旧租约和路由
+    supervisor_utils.engine_supervisor.forget(task_id)
+    release_task_resources(task_id)
+    routing_utils.replica_router.remove_task(task_id)
     
-    # 更新任务端口
-    update_inference_task(
-        task_id=task_id,
-        port=port,
-        api_base=f"http://localhost:{port}/v1"
-    )
-    task = get_inference_task(task_id=task_id)  # 重新获取更新后的任务
-    
-    # 构建命令
-    command, used_port = build_vllm_command(task, model_path)
-    command_str = " ".join(command)
-    logger.info(f"启动推理服务: {command_str}")
-    
-    # 如果build_vllm_command分配了新端口，需要更新任务记录
-    if used_port != task.port:
-        update_inference_task(
-            task_id=task_id,
-            port=used_port,
-            api_base=f"http://localhost:{used_port}/v1"
+    replica_count = max(1, min(task.replicas or 1, MAX_REPLICAS))
+    try:
+        results = await asyncio.gather(
+            *(_launch_replica(task_id, model_path, replica) for replica in range(replica_count))
         )
+        ready = [info for info, _ in results if info]
+        errors = [error for _, error in results if error]
         
-    # 准备日志文件
-    log_file = LOGS_DIR / f"inference_{task_id}.log"
-    logger.info(f"推理日志文件路径: {log_file}")
-    
-    # 确保日志目录存在
-    log_file.parent.mkdir(parents=True, exist_ok=True)
-    
-    try:
-        # 启动进程
-        try:
-            process = await asyncio.create_subprocess_exec(
-                *command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            logger.info(f"推理进程启动成功: PID={process.pid}")
-            
-            # 异步读取输出并记录
-            async def log_output():
-                log_fp = open(log_file, "w")
-                try:
-                    while True:
-                        line = await process.stdout.readline()
-                        if not line and process.stdout.at_eof():
-                            break
-                        line_str = line.decode('utf-8', errors='replace').rstrip()
-                        logger.info(f"vLLM输出: {line_str}")
-                        log_fp.write(f"{line_str}\n")
-                        log_fp.flush()
-                except Exception as e:
-                    logger.error(f"读取vLLM输出异常: {str(e)}")
-                finally:
-                    log_fp.close()
-            
-            async def log_error():
-                try:
-                    while True:
-                        line = await process.stderr.readline()
-                        if not line and process.stderr.at_eof():
-                            break
-                        line_str = line.decode('utf-8', errors='replace').rstrip()
-                        logger.error(f"vLLM错误: {line_str}")
-                        # 也写入到日志文件
-                        with open(log_file, "a") as f:
-                            f.write(f"ERROR: {line_str}\n")
-                except Exception as e:
-                    logger.error(f"读取vLLM错误输出异常: {str(e)}")
-            
-            # 启动日志记录任务，但不等待它完成
-            asyncio.create_task(log_output())
-            asyncio.create_task(log_error())
-            
-        except FileNotFoundError as e:
-            error_msg = f"找不到Python或vLLM模块: {str(e)}"
-            logger.error(error_msg)
-            update_inference_task(
-                task_id=task_id,
-                status=InferenceStatus.FAILED,
-                error_message=error_msg
-            )
-            return False
-        except PermissionError as e:
-            error_msg = f"权限错误，无法创建日志文件或启动进程: {str(e)}"
-            logger.error(error_msg)
+        if not ready:
+            error_msg = errors[0] if errors else "推理服务启动失败，原因未知"
             update_inference_task(
                 task_id=task_id,
                 status=InferenceStatus.FAILED,
                 error_message=error_msg
             )
+            release_task_resources(task_id)
             return False
         
-        # 记录进程信息
-        process_info = {
-            "task_id": task_id,
-            "process": process,
-            "command": command_str,
-            "port": used_port,
-            "gpu_memory": estimate_model_memory(
-                model_id=task.model_id, 
-                tensor_parallel_size=task.tensor_parallel_size,
-                max_model_len=task.max_model_len,
-                quantization=task.quantization
-            ),
-            "gpu_device": 0  # 默认使用第一个GPU
-        }
-        active_processes.append(process_info)
-        
         # 更新任务状态
+        _sync_task_replicas(task_id)
         update_inference_task(
             task_id=task_id,
             status=InferenceStatus.RUNNING,
-            process_id=process.pid,
             started_at=datetime.now(),
-            gpu_memory=process_info["gpu_memory"],
-            share_enabled=task.share_enabled,  # 保留共享设置
-            display_name=task.display_name     # 保留显示名称
-        )
-        
-        logger.info(f"推理服务已启动: 任务={task_id}, PID={process.pid}, 端口={used_port}")
-        
-        # 等待服务启动 - 增加初始等待时间
-        await asyncio.sleep(15)  # 增加到10秒，给模型加载更多时间
-        
-        # 检查服务是否成功启动
-        tries = 0
-        max_tries = 40  # 增加到40次，总共约210秒超时
-        while tries < max_tries:
-            # 检查进程是否仍在运行
-            if process.returncode is not None:
-                # 尝试读取日志文件获取错误信息
-                log_excerpt = ""
-                try:
-                    with open(log_file, 'r') as f:
-                        last_lines = f.readlines()[-30:]  # 获取最后30行
-                        log_excerpt = ''.join(last_lines)
-                except Exception as e:
-                    log_excerpt = f"无法读取日志文件: {str(e)}"
-                
-                error_msg = f"推理服务进程已终止: 退出码={process.returncode}"
-                if log_excerpt:
-                    full_error_msg = f"{error_msg}\n\n最近的日志信息:\n{log_excerpt}"
-                else:
-                    full_error_msg = error_msg
-                    
-                logger.error(f"{error_msg}\n日志摘要:\n{log_excerpt}")
-                update_inference_task(
-                    task_id=task_id,
-                    status=InferenceStatus.FAILED,
-                    error_message=full_error_msg
-                )
-                active_processes.remove(process_info)
-                return False
-                
-            try:
-                # 检查服务健康状态
-                logger.info(f"尝试连接推理服务健康检查: http://localhost:{used_port}/v1/models (尝试 {tries+1}/{max_tries})")
-                response = requests.get(f"http://localhost:{used_port}/v1/models", timeout=10)  # 增加单次请求超时
-                if response.status_code == 200:
-                    logger.info(f"推理服务准备就绪: 任务={task_id}, 端口={used_port}, 响应={response.text[:100]}")
-                    return True
-                else:
-                    logger.warning(f"推理服务健康检查返回非200状态码: {response.status_code}, 响应: {response.text[:100]}")
-            except requests.exceptions.RequestException as e:
-                logger.warning(f"推理服务健康检查连接失败: {str(e)}")
-            except Exception as e:
-                logger.warning(f"推理服务健康检查出错: {str(e)}")
-            
-            # 根据尝试次数调整等待时间
-            if tries < 10:
-                wait_time = 3  # 前10次等待3秒
-            elif tries < 20:
-                wait_time = 5  # 中间10次等待5秒
-            else:
-                wait_time = 10  # 后面等待10秒
-                
-            await asyncio.sleep(wait_time)
-            tries += 1
-        
-        # 尝试检查进程日志
-        log_excerpt = ""
-        try:
-            with open(log_file, 'r') as f:
-                last_lines = f.readlines()[-20:]  # 获取最后20行
-                log_excerpt = ''.join(last_lines)
-                logger.error(f"推理服务日志摘要:\n{log_excerpt}")
-        except Exception as e:
-            logger.error(f"无法读取推理服务日志: {str(e)}")
-            log_excerpt = f"无法读取日志文件: {str(e)}"
-        
-        # 如果服务未能启动，标记为失败
-        error_msg = f"推理服务启动超时（等待了{max_tries * 5}秒）"
-        if log_excerpt:
-            full_error_msg = f"{error_msg}\n\n最近的日志信息:\n{log_excerpt}"
-        else:
-            full_error_msg = error_msg
-            
-        logger.error(f"{error_msg}: 任务={task_id}")
-        update_inference_task(
-            task_id=task_id,
-            status=InferenceStatus.FAILED,
-            error_message=full_error_msg
+            error_message=f"{len(errors)} 个副本启动失败: {errors[0][:500]}" if errors else None,
+            clear=[] if errors else ["error_message"]
         )
-        
-        # 尝试终止进程
-        try:
-            process.terminate()
-        except Exception:
-            pass
-        
-        # 从活跃进程列表中移除
-        active_processes.remove(process_info)
-        
-        return False
+        # 重新开始计算空闲时间，避免手动启动的任务沿用旧的请求时间被立即回收
+        lifecycle_utils.mark_request(task_id)
+        logger.info(f"推理服务已启动: 任务={task_id}, 就绪副本 {len(ready)}/{replica_count}")
+        return True
         
     except Exception as e:
         import traceback
@@ -652,48 +1740,101 @@ async def start_inference_service(task_id: int) -> bool:
             status=InferenceStatus.FAILED,
             error_message=full_error_msg
         )
+        for process_info in get_task_processes(task_id):
+            await _stop_replica(process_info)
+        release_task_resources(task_id)
         return False
 
+# 调整副本数
+async def scale_inference_service(task_id: int, replicas: int) -> Dict[str, Any]:
+    """运行时调整推理任务的副本数
+
+    扩容时在新的设备组上启动副本，就绪后加入路由；
+    缩容时先停止向多余副本分配请求，等未完成请求结束后再停止进程。
+    """
+    replicas = max(1, min(replicas, MAX_REPLICAS))
+    lock = _scale_locks.setdefault(task_id, asyncio.Lock())
+    async with lock:
+        task = get_inference_task(task_id=task_id)
+        update_inference_task(task_id=task_id, replicas=replicas)
+        if not task or task.status != InferenceStatus.RUNNING:
+            # 任务未运行时只记录副本数，下次启动时生效
+            return {"replicas": replicas, "started": [], "stopped": [], "errors": []}
+        
+        current = get_task_processes(task_id)
+        started, stopped, errors = [], [], []
+        
+        if replicas > len(current):
+            model_path = get_model_path(task.model_id)
+            used = {p.get("replica", 0) for p in current}
+            new_indices = [i for i in range(MAX_REPLICAS) if i not in used][:replicas - len(current)]
+            results = await asyncio.gather(*(_launch_replica(task_id, model_path, i) for i in new_indices))
+            for index, (info, error) in zip(new_indices, results):
+                if info:
+                    started.append(index)
+                else:
+                    errors.append({"replica": index, "error": error})
+        elif replicas < len(current):
+            # 优先下线编号大的副本
+            surplus = current[replicas:]
+            await asyncio.gather(*(_stop_replica(p, drain_timeout=300.0) for p in surplus))
+            stopped = [p.get("replica", 0) for p in surplus]
+        
+        _sync_task_replicas(task_id)
+        logger.info(f"推理任务 {task_id} 副本数调整为 {replicas}: 新增={started}, 下线={stopped}, 失败={len(errors)}")
+        return {"replicas": replicas, "started": started, "stopped": stopped, "errors": errors}
+
 # 停止推理服务
 async def stop_inference_service(task_id: int) -> bool:
-    """停止推理服务"""
+    """停止推理服务的全部副本"""
     task = get_inference_task(task_id=task_id)
     if not task:
         logger.error(f"找不到推理任务: {task_id}")
         return False
     
+    if task.base_task_id:
+        return await stop_adapter_service(task)
+    
+    # 取消等待中的自动重启
+    supervisor_utils.engine_supervisor.forget(task_id)
+    
     # 查找对应的进程
-    for process_info in active_processes[:]:
-        if process_info["task_id"] == task_id:
-            process = process_info["process"]
+    processes = get_task_processes(task_id)
+    if processes:
+        try:
+            for process_info in processes:
+                await _stop_replica(process_info)
             
-            try:
-                # 尝试优雅终止
-                process.terminate()
-                try:
-                    await asyncio.wait_for(process.wait(), timeout=5.0)
-                except asyncio.TimeoutError:
-                    # 如果进程未能在5秒内终止，强制杀死
-                    process.kill()
-                
-                logger.info(f"推理服务已停止: 任务={task_id}, PID={process.pid}")
-                
-                # 从活跃进程列表中移除
-                active_processes.remove(process_info)
-                
-                # 更新任务状态
-                update_inference_task(
-                    task_id=task_id,
-                    status=InferenceStatus.STOPPED,
-                    stopped_at=datetime.now()
-                )
-                
-                return True
-            except Exception as e:
-                logger.error(f"停止推理服务失败: {str(e)}")
-                return False
+            logger.info(f"推理服务已停止: 任务={task_id}, 副本数={len(processes)}")
+            
+            # 释放端口租约和路由
+            routing_utils.replica_router.remove_task(task_id)
+            release_task_resources(task_id)
+            _stop_dependent_adapters(task_id)
+            
+            # 更新任务状态
+            update_inference_task(
+                task_id=task_id,
+                status=InferenceStatus.STOPPED,
+                stopped_at=datetime.now()
+            )
+            
+            return True
+        except Exception as e:
+            logger.error(f"停止推理服务失败: {str(e)}")
+            return False
     
-    # 如果未找到进程但任务状态为运行中，更新状态
+    # 如果未找到进程但任务状态为运行中或空闲休眠，更新状态
+    routing_utils.replica_router.remove_task(task_id)
+    release_task_resources(task_id)
+    _stop_dependent_adapters(task_id)
+    if task.status == InferenceStatus.IDLE:
+        update_inference_task(
+            task_id=task_id,
+            status=InferenceStatus.STOPPED,
+            stopped_at=datetime.now()
+        )
+        return True
     if task.status == InferenceStatus.RUNNING:
         update_inference_task(
             task_id=task_id,
@@ -715,23 +1856,36 @@ async def check_inference_service(task_id: int) -> Dict[str, Any]:
     if task.status != InferenceStatus.RUNNING:
         return {"status": task.status, "task": task.dict()}
     
-    # 检查进程是否在运行
-    process_running = False
-    for process_info in active_processes:
-        if process_info["task_id"] == task_id:
-            process = process_info["process"]
-            if process.returncode is None:  # 进程仍在运行
-                process_running = True
-                break
-    
-    # 如果进程不在运行但状态为运行中，更新状态
-    if not process_running and task.status == InferenceStatus.RUNNING:
+    if task.base_task_id:
+        return await _check_adapter_service(task)
+    
+    # 检查各副本进程是否在运行，已退出的副本交给监督器释放并安排重启
+    processes = get_task_processes(task_id)
+    for process_info in processes:
+        if process_info["process"].returncode is not None and process_info.get("ready") and not process_info.get("stopping"):
+            await supervisor_utils.engine_supervisor.handle_crash(
+                process_info, f"进程退出，退出码={process_info['process'].returncode}"
+            )
+    running = [p for p in get_task_processes(task_id) if p["process"].returncode is None]
+    process_running = bool(running)
+    restart_status = supervisor_utils.engine_supervisor.restart_status(task_id)
+    task = get_inference_task(task_id=task_id)
+    
+    # 如果进程不在运行但状态为运行中（且没有等待中的自动重启），更新状态
+    restarting = restart_status is not None and restart_status["state"] == supervisor_utils.STATE_RESTARTING
+    if not process_running and task.status == InferenceStatus.RUNNING and not restarting:
         update_inference_task(
             task_id=task_id,
             status=InferenceStatus.FAILED,
             stopped_at=datetime.now(),
             error_message="进程意外终止"
         )
+        routing_utils.replica_router.remove_task(task_id)
+        release_task_resources(task_id)
+        _stop_dependent_adapters(task_id)
+        task = get_inference_task(task_id=task_id)
+    elif len(running) != len(processes):
+        _sync_task_replicas(task_id)
         task = get_inference_task(task_id=task_id)
     
     # 检查API是否可用
@@ -747,7 +1901,40 @@ async def check_inference_service(task_id: int) -> Dict[str, Any]:
         "status": task.status,
         "task": task.dict(),
         "process_running": process_running,
-        "api_available": api_available
+        "api_available": api_available,
+        "replicas": routing_utils.replica_router.list(task_id),
+        "supervisor": supervisor_utils.engine_supervisor.status(task_id)
+    }
+
+async def _check_adapter_service(task: InferenceTask) -> Dict[str, Any]:
+    """检查适配器任务：基础模型是否运行，以及适配器是否出现在引擎的模型列表中"""
+    base = get_inference_task(task_id=task.base_task_id)
+    if not base or base.status != InferenceStatus.RUNNING:
+        update_inference_task(
+            task_id=task.id,
+            status=InferenceStatus.STOPPED,
+            stopped_at=datetime.now(),
+            error_message="基础模型推理服务已停止"
+        )
+        task = get_inference_task(task_id=task.id)
+        return {"status": task.status, "task": task.dict(), "process_running": False, "api_available": False}
+    
+    api_available = False
+    if base.port:
+        try:
+            response = requests.get(f"http://localhost:{base.port}/v1/models", timeout=2)
+            if response.status_code == 200:
+                api_available = any(m.get("id") == task.name for m in response.json().get("data", []))
+        except Exception:
+            api_available = False
+    
+    return {
+        "status": task.status,
+        "task": task.dict(),
+        "process_running": True,
+        "api_available": api_available,
+        "base_task_id": base.id,
+        "replicas": routing_utils.replica_router.list(base.id)
     }
 
 # 执行模型推理
@@ -757,9 +1944,15 @@ async def perform_inference(
     temperature: Optional[float] = None,
     top_p: Optional[float] = None,
     max_tokens: Optional[int] = None,
-    repetition_penalty: Optional[float] = None
+    repetition_penalty: Optional[float] = None,
+    session_id: Optional[str] = None,
+    user_id: Optional[int] = None
 ) -> Dict[str, Any]:
-    """执行模型推理"""
+    """执行模型推理
+
+    session_id用于多轮对话的副本粘滞，未提供时根据对话开头的消息生成。
+    user_id用于用量计量，匿名访问时为空。
+    """
     logger.info(f"开始执行推理: 任务ID={task_id}, 消息数量={len(messages)}")
     
     task = get_inference_task(task_id=task_id)
@@ -767,14 +1960,6 @@ async def perform_inference(
         logger.error(f"推理任务不存在: {task_id}")
         return {"error": "推理任务不存在"}
     
-    if task.status != InferenceStatus.RUNNING:
-        logger.error(f"推理任务未运行: {task_id}, 当前状态={task.status}")
-        return {"error": f"推理任务未运行，当前状态: {task.status}"}
-    
-    if not task.api_base or not task.port:
-        logger.error(f"推理任务API基础URL未设置: {task_id}")
-        return {"error": "推理任务API基础URL未设置"}
-    
     # 准备请求参数
     final_temperature = temperature if temperature is not None else task.temperature
     final_top_p = top_p if top_p is not None else task.top_p
@@ -794,56 +1979,130 @@ async def perform_inference(
                 f"top_p={final_top_p}, max_tokens={final_max_tokens}, "
                 f"repetition_penalty={final_repetition_penalty}")
     
+    # 确定性请求先查响应缓存，命中时不需要唤醒或占用引擎
+    cache_key = cache_utils.cache_key_for(task, "chat/completions", payload)
+    if cache_key and lifecycle_utils.is_available(task):
+        cached = cache_utils.response_cache.get(task_id, cache_key)
+        if cached is not None:
+            logger.info(f"推理命中响应缓存: 任务ID={task_id}")
+            return {"message": cached, "task_id": task_id, "cached": True}
+    
+    # 空闲休眠的任务先冷启动，请求等待引擎就绪
+    lifecycle_utils.mark_request(task_id)
+    if task.status != InferenceStatus.RUNNING:
+        try:
+            task = await lifecycle_utils.ensure_running(task_id)
+        except RuntimeError as e:
+            logger.error(f"推理任务未运行: {task_id}, 当前状态={task.status}, 错误={str(e)}")
+            return {"error": str(e)}
+    
+    if not task.api_base or not task.port:
+        logger.error(f"推理任务API基础URL未设置: {task_id}")
+        return {"error": "推理任务API基础URL未设置"}
+    
+    # 在任务的副本之间选择未完成请求最少的一个（适配器任务使用基础模型的副本）
+    engine_id = routing_utils.engine_task_id(task)
+    
+    # 引擎正在重启时立即返回，不等待连接超时
+    unavailable = supervisor_utils.engine_supervisor.unavailable(engine_id)
+    if unavailable:
+        logger.warning(f"推理引擎不可用: 任务ID={task_id}, 原因={unavailable['message']}")
+        return {"error": unavailable["message"], "retry_after": unavailable["retry_after"]}
+    
+    if engine_id != task_id:
+        lifecycle_utils.mark_request(engine_id)
+    replica_handle = routing_utils.replica_router.acquire(
+        engine_id, session_id or routing_utils.conversation_key(messages)
+    )
+    port = replica_handle["port"] if replica_handle else task.port
+    
     # 获取最后一个用户消息（用于日志）
     last_user_msg = next((msg["content"] for msg in reversed(messages) if msg["role"] == "user"), None)
     if last_user_msg:
         logger.debug(f"最后用户消息(前50个字符): {last_user_msg[:50]}...")
     
-    api_url = f"http://localhost:{task.port}/v1/chat/completions"
+    api_url = f"http://localhost:{port}/v1/chat/completions"
     logger.debug(f"发送请求到: {api_url}")
     
+    # 以流式方式请求，用于测量首token时间；token数取自最后一个数据块的usage
+    payload["stream"] = True
+    payload["stream_options"] = {"include_usage": True}
+    
+    request_ok = False
+    timer = metrics_utils.metrics_registry.start(task_id, task.name, user_id, usage_utils.task_engine(task))
+    usage = {}
     try:
-        start_time = time.time()
-        
-        # 发送请求到vLLM OpenAI兼容API
-        response = requests.post(
-            api_url,
-            json=payload,
-            timeout=60
-        )
+        client = await gateway_utils.get_client()
+        chunks = []
+        headers = gateway_utils.session_headers(session_id or routing_utils.conversation_key(messages))
+        async with client.stream("POST", api_url, json=payload, headers=headers) as response:
+            if response.status_code != 200:
+                details = (await response.aread()).decode("utf-8", errors="replace")
+                logger.error(f"推理请求失败: HTTP {response.status_code}, 响应: {details[:200]}")
+                return {"error": f"推理请求失败: HTTP {response.status_code}", "details": details}
+            
+            # 只有收到[DONE]或finish_reason才算完整结束；连接中途断开时aiter_lines会直接结束
+            finish_reason = None
+            completed = False
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    completed = True
+                    break
+                chunk = json.loads(data)
+                if chunk.get("error"):
+                    error = chunk["error"]
+                    error_msg = error.get("message") if isinstance(error, dict) else str(error)
+                    logger.error(f"推理服务返回错误: 任务ID={task_id}, 错误={error_msg}")
+                    return {"error": f"推理失败: {error_msg}"}
+                if chunk.get("usage"):
+                    usage = chunk["usage"]
+                for choice in chunk.get("choices") or []:
+                    delta = (choice.get("delta") or {}).get("content")
+                    if delta:
+                        timer.mark_first_token()
+                        chunks.append(delta)
+                    if choice.get("finish_reason"):
+                        finish_reason = choice["finish_reason"]
+            if not completed and not finish_reason:
+                logger.error(f"推理响应不完整: 任务ID={task_id}, 已收到 {len(chunks)} 个内容块")
+                return {"error": "推理服务连接中断，响应不完整"}
         
-        request_time = time.time() - start_time
+        request_ok = True
+        request_time = timer.finish(True, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
         logger.debug(f"请求处理时间: {request_time:.2f}秒")
         
-        if response.status_code != 200:
-            logger.error(f"推理请求失败: HTTP {response.status_code}, 响应: {response.text[:200]}")
-            return {"error": f"推理请求失败: HTTP {response.status_code}", "details": response.text}
-        
-        # 解析响应
-        result = response.json()
-        
         # 提取生成的文本
         message = {
             "role": "assistant",
-            "content": result["choices"][0]["message"]["content"]
+            "content": "".join(chunks)
         }
         
+        if cache_key:
+            cache_utils.response_cache.put(task_id, cache_key, message, request_time)
+        
         # 记录推理结果
         content_length = len(message["content"])
         logger.info(f"推理成功: 任务ID={task_id}, 响应长度={content_length}, 处理时间={request_time:.2f}秒")
         logger.debug(f"推理响应(前50个字符): {message['content'][:50]}...")
         
         # 记录token使用情况（如果API提供）
-        if "usage" in result:
-            usage = result["usage"]
+        if usage:
             logger.debug(f"Token使用情况: 输入={usage.get('prompt_tokens', 'N/A')}, "
                         f"输出={usage.get('completion_tokens', 'N/A')}, "
                         f"总计={usage.get('total_tokens', 'N/A')}")
         
         return {"message": message, "task_id": task_id}
     except Exception as e:
+        request_ok = False
         logger.exception(f"执行推理失败: {str(e)}")
         return {"error": f"执行推理失败: {str(e)}"}
+    finally:
+        # 失败时记为错误；成功时已记录，不会重复计数
+        timer.finish(False)
+        routing_utils.replica_router.release(replica_handle, success=request_ok)
 
 def cleanup_inference_files(task_id: int) -> dict:
     """清理推理任务相关的文件和目录
@@ -861,10 +2120,15 @@ def cleanup_inference_files(task_id: int) -> dict:
     }
     
     try:
-        # 清理日志文件
+        # 清理日志文件（包括各副本的日志和轮转备份）
+        engine_logs = [_replica_log_file(task_id, 0)] + sorted(LOGS_DIR.glob(f"inference_{task_id}_r*.log"))
         log_dir = Path("logs/inference")
         if log_dir.exists():
-            for log_file in log_dir.glob(f"*task_{task_id}*.log"):
+            engine_logs += list(log_dir.glob(f"*task_{task_id}*.log"))
+        for engine_log in engine_logs:
+            for log_file in log_utils.log_files(engine_log):
+                if not log_file.exists():
+                    continue
                 try:
                     log_file.unlink()
                     result["cleaned_files"].append(str(log_file))
@@ -0,0 +1,215 @@
+"""
+推理任务生命周期管理
+按最近请求时间跟踪任务空闲状态，空闲超时后自动停止并标记为IDLE（释放GPU但仍对外可用），
+收到新请求时自动冷启动，并发请求共享同一次启动；预热进程池用于缩短冷启动时间
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, Any, Optional, List
+
+from models import InferenceTask, InferenceStatus
+from database import get_inference_task, get_all_inference_tasks, update_inference_task
+
+logger = logging.getLogger(__name__)
+
+# 生命周期配置
+IDLE_CHECK_INTERVAL = float(os.environ.get("INFERENCE_IDLE_CHECK_INTERVAL", "30"))
+COLD_START_TIMEOUT = float(os.environ.get("INFERENCE_COLD_START_TIMEOUT", "600"))
+PREWARM_POOL_SIZE = int(os.environ.get("INFERENCE_PREWARM_POOL", "1"))
+PREWARM_WORKER = Path(__file__).resolve().parent / "prewarm_worker.py"
+
+# 可视为对外可用的状态：运行中，或空闲休眠（收到请求时自动启动）
+AVAILABLE_STATUSES = (InferenceStatus.RUNNING, InferenceStatus.IDLE)
+
+# 任务ID -> 最近一次请求的时间
+last_request_at: Dict[int, float] = {}
+
+# 任务ID -> 正在进行的冷启动
+_cold_starts: Dict[int, asyncio.Task] = {}
+
+def is_available(task: InferenceTask) -> bool:
+    """任务是否可以接收请求（运行中或可冷启动）"""
+    return task.status in AVAILABLE_STATUSES
+
+def mark_request(task_id: int) -> None:
+    """记录任务收到请求的时间"""
+    last_request_at[task_id] = time.time()
+
+def get_idle_seconds(task: InferenceTask) -> float:
+    """任务自最近一次请求（或启动）以来的空闲秒数"""
+    last = last_request_at.get(task.id)
+    if last is None:
+        last = task.started_at.timestamp() if task.started_at else time.time()
+        last_request_at[task.id] = last
+    return time.time() - last
+
+async def _cold_start(task_id: int) -> None:
+    import inference_utils
+
+    logger.info(f"推理任务冷启动: {task_id}")
+    start_time = time.time()
+    update_inference_task(task_id=task_id, status=InferenceStatus.CREATING)
+    started = await inference_utils.start_inference_service(task_id)
+    if not started:
+        task = get_inference_task(task_id=task_id)
+        raise RuntimeError(task.error_message if task and task.error_message else "冷启动失败")
+    mark_request(task_id)
+    logger.info(f"推理任务冷启动完成: {task_id}, 耗时 {time.time() - start_time:.1f}秒")
+
+async def ensure_running(task_id: int, timeout: float = COLD_START_TIMEOUT) -> InferenceTask:
+    """确保任务处于运行状态，IDLE任务会被冷启动
+
+    同一任务的并发请求等待同一次启动；启动失败或超时时抛出RuntimeError。
+    """
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise RuntimeError("推理任务不存在")
+    if task.status == InferenceStatus.RUNNING:
+        return task
+
+    cold_start = _cold_starts.get(task_id)
+    if cold_start is None:
+        if task.status != InferenceStatus.IDLE:
+            raise RuntimeError(f"推理任务未运行，当前状态: {task.status}")
+        cold_start = asyncio.create_task(_cold_start(task_id))
+        _cold_starts[task_id] = cold_start
+        cold_start.add_done_callback(lambda _: _cold_starts.pop(task_id, None))
+
+    try:
+        await asyncio.wait_for(asyncio.shield(cold_start), timeout=timeout)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"等待推理服务冷启动超时（{timeout:.0f}秒）")
+    return get_inference_task(task_id=task_id)
+
+async def scale_to_zero(task_id: int) -> bool:
+    """停止空闲任务的全部副本，并标记为IDLE"""
+    import inference_utils
+
+    # 基础模型休眠时，挂载在它上面的适配器一起休眠，收到请求时随基础模型冷启动
+    adapters = inference_utils.get_adapter_tasks(task_id, (InferenceStatus.RUNNING,))
+    if not await inference_utils.stop_inference_service(task_id):
+        return False
+    update_inference_task(task_id=task_id, status=InferenceStatus.IDLE, clear=["error_message"])
+    for adapter in adapters:
+        update_inference_task(task_id=adapter.id, status=InferenceStatus.IDLE)
+    logger.info(f"推理任务已空闲休眠: {task_id}" + (f", 适配器 {len(adapters)} 个" if adapters else ""))
+    return True
+
+async def reap_idle_tasks_once() -> List[int]:
+    """检查所有运行中任务，停止空闲超时的任务"""
+    from routing_utils import replica_router
+
+    reaped = []
+    for task in get_all_inference_tasks():
+        # 适配器任务没有自己的进程，随基础模型一起休眠
+        if task.status != InferenceStatus.RUNNING or not task.idle_timeout or task.base_task_id or task.id in _cold_starts:
+            continue
+        if any(r["outstanding"] for r in replica_router.list(task.id)):
+            mark_request(task.id)
+            continue
+        idle_seconds = get_idle_seconds(task)
+        if idle_seconds >= task.idle_timeout:
+            logger.info(f"推理任务 {task.id} 已空闲 {idle_seconds:.0f}秒，超过 {task.idle_timeout}秒，自动停止")
+            if await scale_to_zero(task.id):
+                reaped.append(task.id)
+    return reaped
+
+async def run_idle_reaper(interval: float = IDLE_CHECK_INTERVAL) -> None:
+    """后台空闲回收循环"""
+    while True:
+        try:
+            await reap_idle_tasks_once()
+        except Exception as e:
+            logger.error(f"空闲推理任务回收出错: {str(e)}")
+        await asyncio.sleep(interval)
+
+class PrewarmPool:
+    """预热进程池
+
+    预先启动若干个已导入重型依赖的Python进程，冷启动时把vLLM参数交给其中一个进程运行，
+    用掉一个就在后台补充一个。预热进程不占用GPU显存。
+    """
+
+    def __init__(self, size: int = PREWARM_POOL_SIZE):
+        self.size = size
+        self._ready: List[asyncio.subprocess.Process] = []
+        self._spawning = 0
+        self._closed = False
+
+    async def _spawn(self) -> None:
+        self._spawning += 1
+        try:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, str(PREWARM_WORKER),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+            line = await process.stdout.readline()
+            if line.strip() != b"PREWARM_READY" or self._closed:
+                logger.warning(f"预热进程未能就绪: PID={process.pid}")
+                process.kill()
+                return
+            self._ready.append(process)
+            logger.info(f"预热进程已就绪: PID={process.pid}, 可用 {len(self._ready)}/{self.size}")
+        except Exception as e:
+            logger.error(f"启动预热进程失败: {str(e)}")
+        finally:
+            self._spawning -= 1
+
+    def replenish(self) -> None:
+        """在后台补足预热进程"""
+        if self._closed:
+            return
+        for _ in range(self.size - len(self._ready) - self._spawning):
+            asyncio.create_task(self._spawn())
+
+    async def launch(self, command: List[str], env: Dict[str, str],
+                     log_file: Optional[str] = None) -> Optional[asyncio.subprocess.Process]:
+        """用预热进程运行 python -m <module> 形式的命令，没有可用进程时返回None
+
+        指定log_file时预热进程把自己的标准输出和错误输出重定向到该文件。
+        """
+        if len(command) < 3 or command[1] != "-m":
+            return None
+        while self._ready:
+            process = self._ready.pop(0)
+            if process.returncode is not None:
+                continue
+            overrides = {key: value for key, value in env.items() if os.environ.get(key) != value}
+            request = {"module": command[2], "argv": command[3:], "env": overrides, "log_file": log_file}
+            process.stdin.write((json.dumps(request) + "\n").encode("utf-8"))
+            await process.stdin.drain()
+            logger.info(f"使用预热进程启动推理服务: PID={process.pid}")
+            self.replenish()
+            return process
+        self.replenish()
+        return None
+
+    async def close(self) -> None:
+        """关闭所有空闲的预热进程"""
+        self._closed = True
+        for process in self._ready:
+            try:
+                process.stdin.close()
+                process.kill()
+            except ProcessLookupError:
+                pass
+        self._ready = []
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "size": self.size,
+            "ready": len(self._ready),
+            "spawning": self._spawning
+        }
+
+# 全局预热进程池
+prewarm_pool = PrewarmPool()
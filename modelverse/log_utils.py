@@ -0,0 +1,166 @@
+"""
+推理引擎日志
+引擎进程通过追加模式的文件描述符直接写日志文件，管理服务不逐行处理输出；
+后台按文件大小以复制截断方式轮转并限制保留的备份数，
+末尾读取从文件尾部按块向前查找，不读取整个文件；跟踪读取支持轮转后的文件
+"""
+
+import os
+import shutil
+import asyncio
+import logging
+from pathlib import Path
+from typing import Callable, List, Optional, AsyncIterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 日志配置
+INFERENCE_LOG_MAX_BYTES = int(os.environ.get("INFERENCE_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+INFERENCE_LOG_BACKUPS = int(os.environ.get("INFERENCE_LOG_BACKUPS", "3"))
+INFERENCE_LOG_CHECK_INTERVAL = float(os.environ.get("INFERENCE_LOG_CHECK_INTERVAL", "5"))
+# 是否把引擎输出逐行转发到服务日志（默认关闭）
+INFERENCE_LOG_MIRROR = os.environ.get("INFERENCE_LOG_MIRROR", "false").lower() in ("1", "true", "yes")
+
+TAIL_BLOCK_SIZE = 8192
+
+def backup_path(path: Path, index: int) -> Path:
+    return path.with_name(f"{path.name}.{index}")
+
+def log_files(path: Path) -> List[Path]:
+    """日志文件及其全部备份"""
+    return [path] + sorted(path.parent.glob(f"{path.name}.*"))
+
+def rotate(path: Path, in_use: bool = True, backups: int = INFERENCE_LOG_BACKUPS) -> bool:
+    """轮转日志文件，超出保留数的最旧备份被删除
+
+    in_use为True时写入方仍持有追加模式的文件描述符，采用复制后截断的方式，写入方不需要重新打开；
+    否则直接重命名。
+    """
+    try:
+        if not path.exists() or path.stat().st_size == 0:
+            return False
+        if backups <= 0:
+            if in_use:
+                os.truncate(path, 0)
+            else:
+                path.unlink()
+            return True
+        for index in range(backups, 0, -1):
+            source = backup_path(path, index)
+            if not source.exists():
+                continue
+            if index == backups:
+                source.unlink()
+            else:
+                os.replace(source, backup_path(path, index + 1))
+        if in_use:
+            shutil.copyfile(path, backup_path(path, 1))
+            os.truncate(path, 0)
+        else:
+            os.replace(path, backup_path(path, 1))
+        return True
+    except OSError as e:
+        logger.error(f"轮转日志文件失败: {path}, 错误: {str(e)}")
+        return False
+
+def open_for_engine(path: Path):
+    """为引擎进程打开日志文件（追加模式，截断轮转后写入位置自动回到文件开头）
+
+    上一次运行留下的日志先轮转为备份。
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rotate(path, in_use=False)
+    return open(path, "ab")
+
+def tail_lines(path: Path, lines: int) -> List[str]:
+    """从文件末尾向前按块读取最后若干行"""
+    if lines <= 0:
+        return []
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            data = b""
+            while position > 0 and data.count(b"\n") <= lines:
+                size = min(TAIL_BLOCK_SIZE, position)
+                position -= size
+                f.seek(position)
+                data = f.read(size) + data
+    except FileNotFoundError:
+        return []
+    text = data.decode("utf-8", errors="replace")
+    return text.splitlines()[-lines:]
+
+def read_excerpt(path: Path, lines: int) -> str:
+    """读取日志末尾若干行，用于错误信息"""
+    try:
+        return "\n".join(tail_lines(path, lines))
+    except OSError as e:
+        return f"无法读取日志文件: {str(e)}"
+
+def _read_from(path: Path, position: int) -> Tuple[bytes, int]:
+    """从指定位置读取新增内容；文件被截断轮转后从头读取"""
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        return b"", 0
+    if size < position:
+        position = 0
+    if size == position:
+        return b"", position
+    with open(path, "rb") as f:
+        f.seek(position)
+        data = f.read(size - position)
+    return data, position + len(data)
+
+def watch(path: Path, alive: Callable[[], bool], prefix: str, from_end: bool = False) -> asyncio.Task:
+    """后台维护一个引擎日志文件：超过大小上限时轮转；开启转发时把新增的行写入服务日志
+
+    alive返回False后停止。
+    """
+    async def run():
+        position = path.stat().st_size if from_end and path.exists() else 0
+        pending = b""
+        while alive():
+            try:
+                if path.exists() and path.stat().st_size > INFERENCE_LOG_MAX_BYTES:
+                    if INFERENCE_LOG_MIRROR:
+                        data, position = _read_from(path, position)
+                        pending += data
+                    if rotate(path):
+                        position = 0
+                if INFERENCE_LOG_MIRROR:
+                    data, position = _read_from(path, position)
+                    *complete, pending = (pending + data).split(b"\n")
+                    for line in complete:
+                        text = line.decode("utf-8", errors="replace").rstrip()
+                        if "ERROR" in text or "Traceback" in text:
+                            logger.error(f"{prefix}: {text}")
+                        else:
+                            logger.info(f"{prefix}: {text}")
+            except Exception as e:
+                logger.error(f"维护日志文件出错: {path}, 错误: {str(e)}")
+            await asyncio.sleep(1.0 if INFERENCE_LOG_MIRROR else INFERENCE_LOG_CHECK_INTERVAL)
+
+    return asyncio.create_task(run())
+
+async def follow(path: Path, lines: int = 100, poll_interval: float = 0.5,
+                 alive: Optional[Callable[[], bool]] = None) -> AsyncIterator[str]:
+    """先返回最后若干行，然后持续返回新增的行；alive返回False且没有新内容时结束"""
+    for line in tail_lines(path, lines):
+        yield line
+    try:
+        position = path.stat().st_size
+    except FileNotFoundError:
+        position = 0
+    pending = b""
+    while True:
+        data, position = _read_from(path, position)
+        if data:
+            *complete, pending = (pending + data).split(b"\n")
+            for line in complete:
+                yield line.decode("utf-8", errors="replace").rstrip()
+            continue
+        if alive is not None and not alive():
+            break
+        await asyncio.sleep(poll_interval)
@@ -12,7 +12,7 @@ import shutil
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 import base64
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 import json
 import logging
@@ -36,14 +36,32 @@ except Exception as e:
 os.environ.setdefault('NUMEXPR_MAX_THREADS', '32')
 os.environ.setdefault('OMP_NUM_THREADS', '32')
 os.environ.setdefault('MKL_NUM_THREADS', '32')
+# 进程内的CUDA（评估在本进程加载模型）按PCI总线编号，与nvidia-smi和显存账本一致；
+# CUDA初始化后再设置无效，因此必须在导入torch之前设置
+os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
 
-from models import User, UserCreate, Token, UserRegister, ProfileUpdate, PasswordChange, ResourceType, DownloadStatus, ResourceCreate, Resource, MirrorSource, DownloadRequest, TrainingTask, TrainingTaskCreate, TrainingStatus, InferenceTask, InferenceTaskCreate, InferenceTaskUpdate, InferenceStatus, Message, ChatRequest, ChatResponse, EvaluationTask, EvaluationTaskCreate, EvaluationStatus, EvaluationMetrics
-from database import authenticate_user, create_user, get_users, init_db, check_username_exists, update_user_profile, update_user_password, create_resource, get_all_resources, get_user_resources, get_resource, update_resource_status, delete_resource, create_training_task, get_all_training_tasks, get_user_training_tasks, get_training_task, update_training_task, get_training_logs, create_inference_task, get_all_inference_tasks, get_user_inference_tasks, get_inference_task, update_inference_task, delete_inference_task, create_evaluation_task, get_all_evaluation_tasks, get_user_evaluation_tasks, get_evaluation_task, update_evaluation_task, delete_evaluation_task, get_evaluation_logs, add_evaluation_log, start_evaluation_task, stop_evaluation_task, delete_user_by_id
-from auth import create_access_token, get_current_user, get_current_admin, ACCESS_TOKEN_EXPIRE_MINUTES
+from models import User, UserCreate, Token, UserRegister, ProfileUpdate, PasswordChange, ResourceType, DownloadStatus, ResourceCreate, Resource, MirrorSource, DownloadRequest, TrainingTask, TrainingTaskCreate, TrainingStatus, InferenceTask, InferenceTaskCreate, InferenceTaskUpdate, InferenceStatus, Message, ChatRequest, ChatResponse, ConversationCreate, CompareRequest, EvaluationTask, EvaluationTaskCreate, EvaluationStatus, EvaluationMetrics, EngineSweepRequest, BatchJob
+from database import authenticate_user, create_user, get_users, init_db, check_username_exists, update_user_profile, update_user_password, create_resource, get_all_resources, get_user_resources, get_resource, update_resource_status, delete_resource, create_training_task, get_all_training_tasks, get_user_training_tasks, get_training_task, update_training_task, get_training_logs, create_inference_task, get_all_inference_tasks, get_user_inference_tasks, get_inference_task, update_inference_task, delete_inference_task, create_evaluation_task, get_all_evaluation_tasks, get_user_evaluation_tasks, get_evaluation_task, update_evaluation_task, delete_evaluation_task, get_evaluation_logs, add_evaluation_log, start_evaluation_task, stop_evaluation_task, delete_user_by_id, create_batch_job, get_batch_job, get_all_batch_jobs, get_user_batch_jobs, delete_batch_job, get_inference_startups, get_user_conversations, get_inference_usage, get_usage_quotas, set_usage_quota
+from auth import create_access_token, get_current_user, get_current_admin, get_optional_user, ACCESS_TOKEN_EXPIRE_MINUTES
 import huggingface_utils as hf_utils
 import training_utils
 import inference_utils
 import evaluation_utils
+import gpu_utils
+import benchmark_utils
+import gateway_utils
+import routing_utils
+import lifecycle_utils
+import batch_utils
+import cache_utils
+import scheduler_utils
+import metrics_utils
+import supervisor_utils
+import log_utils
+import startup_utils
+import conversation_utils
+import compare_utils
+import usage_utils
 
 # 配置日志记录器
 logger = logging.getLogger(__name__)
@@ -121,6 +139,66 @@ app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 app.mount("/models", StaticFiles(directory="models"), name="models")
 app.mount("/datasets", StaticFiles(directory="datasets"), name="datasets")
 
+# 服务启动时恢复推理相关的运行时状态
+@app.on_event("startup")
+async def restore_inference_state():
+    """根据数据库记录恢复推理服务的运行时状态"""
+    try:
+        inference_utils.restore_port_leases()
+    except Exception as e:
+        logger.error(f"恢复端口租约失败: {str(e)}")
+    
+    # 重新接管仍在运行的推理引擎，清理已退出的副本
+    try:
+        await inference_utils.reattach_inference_processes()
+    except Exception as e:
+        logger.exception(f"重新接管推理进程失败: {str(e)}")
+    
+    # 定期清理长期未使用的匿名会话
+    app.state.conversation_cleanup_task = asyncio.create_task(conversation_utils.conversation_store.run_cleanup())
+    
+    # 恢复当日用量和用户配额，并启动用量定期写入
+    try:
+        usage_utils.usage_meter.restore()
+    except Exception as e:
+        logger.error(f"恢复用量计量失败: {str(e)}")
+    app.state.usage_flush_task = asyncio.create_task(usage_utils.usage_meter.run())
+    
+    # 启动后台GPU采样器
+    gpu_utils.gpu_sampler.start()
+    
+    # 启动推理副本健康检查
+    app.state.replica_health_task = asyncio.create_task(routing_utils.replica_router.run_health_checks())
+    
+    # 启动推理引擎监督，崩溃的副本自动重启
+    app.state.engine_supervisor_task = asyncio.create_task(supervisor_utils.engine_supervisor.run())
+    
+    # 启动空闲任务回收，并预热推理进程池
+    app.state.idle_reaper_task = asyncio.create_task(lifecycle_utils.run_idle_reaper())
+    lifecycle_utils.prewarm_pool.replenish()
+    
+    # 上次未结束的批量任务标记为已停止，等待用户恢复
+    try:
+        batch_utils.mark_interrupted_jobs()
+    except Exception as e:
+        logger.error(f"标记中断的批量任务失败: {str(e)}")
+
+@app.on_event("shutdown")
+async def shutdown_background_workers():
+    """停止后台工作线程"""
+    gpu_utils.gpu_sampler.stop()
+    for name in ("replica_health_task", "idle_reaper_task", "engine_supervisor_task", "usage_flush_task",
+                 "conversation_cleanup_task"):
+        background_task = getattr(app.state, name, None)
+        if background_task:
+            background_task.cancel()
+    for job_id in list(batch_utils.running_jobs):
+        await batch_utils.stop_job(job_id)
+    await lifecycle_utils.prewarm_pool.close()
+    await gateway_utils.close_client()
+    # 写入尚未落库的用量
+    await asyncio.to_thread(usage_utils.usage_meter.flush)
+
 # 存储验证码
 captcha_store: Dict[str, str] = {}
 
@@ -408,6 +486,56 @@ async def admin_dashboard(current_user: User = Depends(get_current_admin)):
         "user_count": len(get_users())
     }
 
+@app.get("/api/admin/usage")
+async def admin_usage(
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    user_id: Optional[int] = None,
+    task_id: Optional[int] = None,
+    group_by: str = "user_task",
+    current_user: User = Depends(get_current_admin)
+):
+    """查询用量统计（时间为Unix秒，按小时桶对齐；匿名访问记在用户0名下）
+
+    group_by: bucket（按时间桶）、user、task、user_task
+    """
+    if group_by not in ("bucket", "user", "task", "user_task"):
+        raise HTTPException(status_code=400, detail="group_by只能是bucket、user、task或user_task")
+    # 先写入内存中尚未落库的用量，保证查询结果是最新的
+    await asyncio.to_thread(usage_utils.usage_meter.flush)
+    return get_inference_usage(start=start, end=end, user_id=user_id, task_id=task_id, group_by=group_by)
+
+@app.get("/api/admin/usage/quotas")
+async def admin_usage_quotas(current_user: User = Depends(get_current_admin)):
+    """获取默认配额和单独设置的用户配额"""
+    return {
+        "default": {
+            "daily_tokens": usage_utils.USAGE_DAILY_TOKEN_QUOTA or None,
+            "daily_requests": usage_utils.USAGE_DAILY_REQUEST_QUOTA or None
+        },
+        "users": list(get_usage_quotas().values())
+    }
+
+@app.put("/api/admin/usage/quotas/{user_id}")
+async def admin_set_usage_quota(
+    user_id: int,
+    quota: Dict[str, Optional[int]],
+    current_user: User = Depends(get_current_admin)
+):
+    """设置用户每日配额（单项为空或0表示该项不限制），两项都为空时恢复默认配额"""
+    daily_tokens = quota.get("daily_tokens")
+    daily_requests = quota.get("daily_requests")
+    if any(value is not None and value < 0 for value in (daily_tokens, daily_requests)):
+        raise HTTPException(status_code=400, detail="配额不能为负数")
+    set_usage_quota(user_id, daily_tokens, daily_requests)
+    usage_utils.usage_meter.set_quota(user_id, daily_tokens, daily_requests)
+    return {"user_id": user_id, **usage_utils.usage_meter.quota(user_id)}
+
+@app.get("/api/usage/me")
+async def my_usage(current_user: User = Depends(get_current_user)):
+    """当前用户当日（UTC）的用量和配额"""
+    return usage_utils.usage_meter.today(current_user.id)
+
 @app.get("/api/items")
 async def get_items(current_user: User = Depends(get_current_user)):
     return {"items": ["Item 1", "Item 2", "Item 3"]}
@@ -1127,16 +1255,30 @@ async def create_inference_task_api(
             logger.error(f"模型未下载完成: {task_create.model_id}")
             raise HTTPException(status_code=400, detail="模型未下载完成")
         
-        # 检查GPU资源是否足够
+        # 检查引擎配置
+        if task_create.engine_profile and task_create.engine_profile not in inference_utils.ENGINE_PROFILES:
+            raise HTTPException(status_code=400, detail=f"未知的引擎配置: {task_create.engine_profile}")
+        engine = task_create.engine or inference_utils.ENGINE_VLLM
+        if engine not in inference_utils.ENGINES:
+            raise HTTPException(status_code=400, detail=f"engine必须是: {', '.join(inference_utils.ENGINES)}")
+        if engine == inference_utils.ENGINE_CPU and (task_create.enable_lora or task_create.base_task_id):
+            raise HTTPException(status_code=400, detail="CPU引擎不支持LoRA适配器")
+        
+        # LoRA适配器任务：挂载到已开启LoRA服务的基础模型任务上，不单独占用GPU
+        if task_create.base_task_id:
+            return _create_adapter_task(task_create, model, background_tasks, current_user)
+        
+        # 检查GPU资源是否足够（CPU引擎检查内存）
         resource_check = inference_utils.check_gpu_resources_for_task(
             model_id=task_create.model_id,
             tensor_parallel_size=task_create.tensor_parallel_size,
             max_model_len=task_create.max_model_len,
-            quantization=task_create.quantization
+            quantization=task_create.quantization,
+            engine=engine
         )
         
         if not resource_check["sufficient"]:
-            logger.error(f"GPU资源检查失败: {resource_check['reason']}")
+            logger.error(f"资源检查失败: {resource_check['reason']}")
             raise HTTPException(
                 status_code=400,
                 detail=resource_check["reason"]
@@ -1151,6 +1293,15 @@ async def create_inference_task_api(
             max_model_len=task_create.max_model_len,
             quantization=task_create.quantization,
             dtype=task_create.dtype,
+            engine_profile=task_create.engine_profile or inference_utils.DEFAULT_ENGINE_PROFILE,
+            engine=engine,
+            replicas=max(1, min(task_create.replicas or 1, inference_utils.MAX_REPLICAS)),
+            idle_timeout=max(0, task_create.idle_timeout or 0),
+            enable_lora=bool(task_create.enable_lora),
+            max_loras=task_create.max_loras or 10,
+            max_lora_rank=task_create.max_lora_rank or 16,
+            response_cache=bool(task_create.response_cache),
+            max_in_flight=max(0, task_create.max_in_flight or 0),
             max_tokens=task_create.max_tokens,
             temperature=task_create.temperature,
             top_p=task_create.top_p,
@@ -1175,6 +1326,67 @@ async def create_inference_task_api(
         logger.exception(f"创建推理任务失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"创建推理任务失败: {str(e)}")
 
+def _create_adapter_task(
+    task_create: InferenceTaskCreate,
+    model: Resource,
+    background_tasks: BackgroundTasks,
+    current_user: User
+) -> InferenceTask:
+    """创建挂载到基础模型任务上的LoRA适配器任务，并在后台热加载"""
+    base_task = get_inference_task(task_id=task_create.base_task_id)
+    if not base_task:
+        raise HTTPException(status_code=404, detail="基础模型推理任务不存在")
+    if base_task.base_task_id:
+        raise HTTPException(status_code=400, detail="不能把适配器挂载到另一个适配器任务上")
+    if not current_user.is_admin and base_task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权使用此基础模型推理任务")
+    if not base_task.enable_lora:
+        raise HTTPException(status_code=400, detail="基础模型推理任务未开启LoRA服务（enable_lora）")
+    
+    adapter_config = inference_utils.read_adapter_config(model.local_path or "")
+    if not adapter_config:
+        raise HTTPException(status_code=400, detail="所选模型不是LoRA适配器（缺少adapter_config.json）")
+    rank = adapter_config.get("r") or 0
+    if rank > base_task.max_lora_rank:
+        raise HTTPException(
+            status_code=400,
+            detail=f"适配器rank为 {rank}，超过基础模型引擎的max_lora_rank={base_task.max_lora_rank}"
+        )
+    
+    base_model = get_resource(resource_id=base_task.model_id)
+    expected_base = adapter_config.get("base_model_name_or_path")
+    if expected_base and base_model and expected_base not in (base_model.repo_id, base_model.local_path, base_model.name):
+        logger.warning(f"适配器的基础模型为 {expected_base}，与推理任务 {base_task.id} 的模型 {base_model.name} 可能不一致")
+    
+    # 适配器共用基础模型引擎，上下文长度等引擎参数沿用基础模型任务
+    task = create_inference_task(
+        name=task_create.name,
+        model_id=task_create.model_id,
+        user_id=current_user.id,
+        tensor_parallel_size=base_task.tensor_parallel_size,
+        max_model_len=base_task.max_model_len,
+        quantization=base_task.quantization,
+        dtype=base_task.dtype,
+        engine_profile=base_task.engine_profile,
+        base_task_id=base_task.id,
+        adapter_path=adapter_config["adapter_dir"],
+        response_cache=bool(task_create.response_cache),
+        max_in_flight=max(0, task_create.max_in_flight or 0),
+        max_tokens=task_create.max_tokens,
+        temperature=task_create.temperature,
+        top_p=task_create.top_p,
+        top_k=task_create.top_k,
+        repetition_penalty=task_create.repetition_penalty,
+        presence_penalty=task_create.presence_penalty,
+        frequency_penalty=task_create.frequency_penalty
+    )
+    if not task:
+        raise HTTPException(status_code=500, detail="创建推理任务失败")
+    
+    background_tasks.add_task(inference_utils.start_inference_service, task.id)
+    logger.info(f"LoRA适配器任务创建成功: ID={task.id}, 名称={task.name}, 基础模型任务={base_task.id}")
+    return task
+
 @app.get("/api/inference/tasks/{task_id}", response_model=InferenceTask)
 async def get_inference_task_api(
     task_id: int,
@@ -1233,6 +1445,8 @@ async def delete_inference_task_api(
         
         # 删除任务
         if delete_inference_task(task_id):
+            cache_utils.response_cache.invalidate_task(task_id)
+            metrics_utils.metrics_registry.remove_task(task_id)
             logger.info(f"推理任务删除成功: {task_id}")
             return {"message": "推理任务已删除"}
         else:
@@ -1263,8 +1477,8 @@ async def stop_inference_task(
             logger.warning(f"用户 {current_user.username} 无权停止推理任务 {task_id}")
             raise HTTPException(status_code=403, detail="无权停止此推理任务")
         
-        # 检查任务状态
-        if task.status != InferenceStatus.RUNNING:
+        # 检查任务状态（空闲休眠的任务停止后不再自动启动）
+        if not lifecycle_utils.is_available(task):
             logger.warning(f"推理任务不在运行中: {task_id}, 当前状态: {task.status}")
             raise HTTPException(status_code=400, detail=f"推理任务不在运行中，当前状态: {task.status}")
         
@@ -1285,6 +1499,7 @@ async def stop_inference_task(
 async def start_inference_task(
     task_id: int,
     background_tasks: BackgroundTasks,
+    auto_fit: bool = Query(False, description="显存不足时自动调整启动参数以适配当前空闲GPU"),
     current_user: User = Depends(get_current_active_user)
 ):
     """启动推理任务"""
@@ -1306,20 +1521,53 @@ async def start_inference_task(
             logger.warning(f"推理任务已在运行中: {task_id}")
             raise HTTPException(status_code=400, detail="推理任务已在运行中")
         
-        # 检查GPU资源是否足够
+        # 适配器任务热加载到基础模型引擎上，不需要检查GPU
+        if task.base_task_id:
+            update_inference_task(task_id=task_id, status=InferenceStatus.CREATING)
+            if await inference_utils.start_inference_service(task_id):
+                return {"message": "LoRA适配器已加载"}
+            updated_task = get_inference_task(task_id=task_id)
+            error_msg = updated_task.error_message if updated_task and updated_task.error_message else "LoRA适配器加载失败"
+            raise HTTPException(status_code=500, detail=error_msg)
+        
+        # 检查GPU资源是否足够（CPU引擎检查内存）
         resource_check = inference_utils.check_gpu_resources_for_task(
             model_id=task.model_id,
             tensor_parallel_size=task.tensor_parallel_size,
             max_model_len=task.max_model_len,
-            quantization=task.quantization
+            quantization=task.quantization,
+            engine=task.engine,
+            gpu_memory_utilization=task.gpu_memory_utilization
         )
         
+        applied_config = None
         if not resource_check["sufficient"]:
-            logger.error(f"GPU资源检查失败: {resource_check['reason']}")
-            raise HTTPException(
-                status_code=400,
-                detail=resource_check["reason"]
-            )
+            # 自动适配只针对vLLM的显存参数
+            if not auto_fit or task.engine == inference_utils.ENGINE_CPU:
+                logger.error(f"GPU资源检查失败: {resource_check['reason']}")
+                raise HTTPException(
+                    status_code=400,
+                    detail=resource_check["reason"]
+                )
+            
+            # 自动适配：选择能放进当前空闲显存的最佳启动参数
+            plan = inference_utils.plan_autofit_config(task)
+            if not plan["feasible"]:
+                logger.error(f"自动适配失败: {plan['reason']}")
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"{resource_check['reason']}；自动适配失败: {plan['reason']}"
+                )
+            best = plan["best"]
+            applied_config = {
+                "tensor_parallel_size": best["tensor_parallel_size"],
+                "max_model_len": best["max_model_len"],
+                "quantization": best["quantization"],
+                "dtype": best["dtype"],
+                "gpu_memory_utilization": best["gpu_memory_utilization"]
+            }
+            update_inference_task(task_id=task_id, **applied_config)
+            logger.info(f"推理任务 {task_id} 自动适配启动参数: {applied_config}, 预计并发序列数: {best['max_concurrent_seqs']}")
         
         # 更新任务状态
         update_inference_task(
@@ -1333,6 +1581,8 @@ async def start_inference_task(
             start_result = await inference_utils.start_inference_service(task_id)
             if start_result:
                 logger.info(f"推理任务启动成功: {task_id}")
+                if applied_config:
+                    return {"message": "推理任务启动成功（已自动适配启动参数）", "applied_config": applied_config}
                 return {"message": "推理任务启动成功"}
             else:
                 # 获取任务的错误信息
@@ -1353,6 +1603,387 @@ async def start_inference_task(
         logger.exception(f"启动推理任务失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"启动推理任务失败: {str(e)}")
 
+@app.get("/api/inference/tasks/{task_id}/autofit", response_model=dict)
+async def preview_inference_autofit(
+    task_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """预览自动适配的启动参数及各候选配置的并发容量"""
+    try:
+        task = get_inference_task(task_id=task_id)
+        if not task:
+            raise HTTPException(status_code=404, detail="推理任务不存在")
+        
+        if not current_user.is_admin and task.user_id != current_user.id:
+            raise HTTPException(status_code=403, detail="无权访问此推理任务")
+        
+        return inference_utils.plan_autofit_config(task)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"自动适配预览失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"自动适配预览失败: {str(e)}")
+
+@app.get("/api/inference/engine-profiles", response_model=dict)
+async def list_engine_profiles(current_user: User = Depends(get_current_active_user)):
+    """获取可用的vLLM引擎配置"""
+    return {
+        "default": inference_utils.DEFAULT_ENGINE_PROFILE,
+        "profiles": inference_utils.ENGINE_PROFILES
+    }
+
+@app.post("/api/inference/tasks/{task_id}/sweep", response_model=dict)
+async def start_engine_sweep(
+    task_id: int,
+    sweep_request: EngineSweepRequest,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_active_user)
+):
+    """在各个引擎配置下启动任务并回放提示集，比较吞吐和延迟"""
+    try:
+        task = get_inference_task(task_id=task_id)
+        if not task:
+            raise HTTPException(status_code=404, detail="推理任务不存在")
+        
+        if not current_user.is_admin and task.user_id != current_user.id:
+            raise HTTPException(status_code=403, detail="无权测试此推理任务")
+        
+        # 扫描会用不同配置反复重启引擎，不能在正在提供服务的任务上进行
+        if task.status in benchmark_utils.SWEEP_BLOCKED_STATUSES:
+            raise HTTPException(status_code=400, detail=f"推理任务正在提供服务（{task.status}），请先停止任务再扫描引擎配置")
+        if task.base_task_id or task.engine == inference_utils.ENGINE_CPU:
+            raise HTTPException(status_code=400, detail="引擎配置扫描只适用于独立的vLLM推理任务")
+        
+        current_sweep = benchmark_utils.get_sweep_status(task_id)
+        if current_sweep and current_sweep["status"] == "running":
+            raise HTTPException(status_code=400, detail="该任务已有正在进行的扫描")
+        
+        unknown = [p for p in (sweep_request.profiles or []) if p not in inference_utils.ENGINE_PROFILES]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"未知的引擎配置: {', '.join(unknown)}")
+        
+        # 准备提示集
+        if sweep_request.prompts:
+            prompts = [p for p in (benchmark_utils.normalize_prompt(r) for r in sweep_request.prompts) if p]
+            if sweep_request.limit:
+                prompts = prompts[:sweep_request.limit]
+        elif sweep_request.dataset_id:
+            dataset = get_resource(resource_id=sweep_request.dataset_id)
+            if not dataset or dataset.resource_type != ResourceType.DATASET or not dataset.local_path:
+                raise HTTPException(status_code=400, detail="数据集不存在或未下载")
+            prompts = benchmark_utils.load_prompt_set(dataset.local_path, limit=sweep_request.limit)
+        else:
+            raise HTTPException(status_code=400, detail="需要提供prompts或dataset_id")
+        
+        if not prompts:
+            raise HTTPException(status_code=400, detail="提示集为空")
+        
+        background_tasks.add_task(
+            benchmark_utils.run_profile_sweep,
+            task_id,
+            prompts,
+            sweep_request.profiles,
+            sweep_request.concurrency,
+            sweep_request.max_tokens
+        )
+        logger.info(f"已提交引擎配置扫描: 任务={task_id}, 提示数={len(prompts)}")
+        return {"message": "引擎配置扫描已开始", "prompt_count": len(prompts)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"启动引擎配置扫描失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"启动引擎配置扫描失败: {str(e)}")
+
+@app.post("/api/inference/tasks/{task_id}/affinity-benchmark", response_model=dict)
+async def start_affinity_benchmark(
+    task_id: int,
+    params: dict,
+    background_tasks: BackgroundTasks,
+    current_user: User = Depends(get_current_active_user)
+):
+    """对比有/无会话粘滞路由时多轮对话的首token延迟"""
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权测试此推理任务")
+    
+    if task.status != InferenceStatus.RUNNING:
+        raise HTTPException(status_code=400, detail="推理任务未运行")
+    
+    current_run = benchmark_utils.get_affinity_benchmark_status(task_id)
+    if current_run and current_run["status"] == "running":
+        raise HTTPException(status_code=400, detail="该任务已有正在进行的基准测试")
+    
+    conversations = params.get("conversations", 8)
+    turns = params.get("turns", 20)
+    max_tokens = params.get("max_tokens", 64)
+    for name, value, upper in (("conversations", conversations, 64), ("turns", turns, 100), ("max_tokens", max_tokens, 1024)):
+        if not isinstance(value, int) or value < 1 or value > upper:
+            raise HTTPException(status_code=400, detail=f"{name}必须是1-{upper}之间的整数")
+    
+    background_tasks.add_task(
+        benchmark_utils.run_affinity_benchmark,
+        task_id,
+        conversations,
+        turns,
+        max_tokens,
+        params.get("questions")
+    )
+    return {"message": "会话粘滞基准测试已开始"}
+
+@app.get("/api/inference/tasks/{task_id}/affinity-benchmark", response_model=dict)
+async def get_affinity_benchmark(
+    task_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取会话粘滞基准测试的进度和结果"""
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权访问此推理任务")
+    
+    benchmark = benchmark_utils.get_affinity_benchmark_status(task_id)
+    if not benchmark:
+        raise HTTPException(status_code=404, detail="该任务没有基准测试记录")
+    return benchmark
+
+@app.get("/api/inference/tasks/{task_id}/sweep", response_model=dict)
+async def get_engine_sweep(
+    task_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取引擎配置扫描的进度和结果"""
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权访问此推理任务")
+    
+    sweep = benchmark_utils.get_sweep_status(task_id)
+    if not sweep:
+        raise HTTPException(status_code=404, detail="该任务没有扫描记录")
+    return sweep
+
+@app.get("/api/inference/tasks/{task_id}/replicas", response_model=dict)
+async def get_inference_replicas(
+    task_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取推理任务各副本的路由和进程状态"""
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权访问此推理任务")
+    
+    processes = [
+        {
+            "replica": p.get("replica", 0),
+            "pid": p["process"].pid,
+            "port": p["port"],
+            "gpu_devices": p["gpu_devices"],
+            "ready": p.get("ready", False),
+            "running": p["process"].returncode is None
+        }
+        for p in inference_utils.get_task_processes(task_id)
+    ]
+    return {
+        "replicas": task.replicas,
+        "processes": processes,
+        "routing": routing_utils.replica_router.list(task_id)
+    }
+
+@app.get("/api/inference/tasks/{task_id}/logs")
+async def get_inference_logs(
+    task_id: int,
+    lines: int = Query(200, ge=1, le=5000),
+    replica: int = Query(0, ge=0),
+    follow: bool = False,
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取推理引擎日志的最后若干行；follow为true时以SSE持续推送新增的行"""
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权查看此推理任务的日志")
+    
+    # 适配器任务的输出在基础模型引擎的日志中
+    engine_id = routing_utils.engine_task_id(task)
+    log_file = inference_utils.get_replica_log_file(engine_id, replica)
+    if not follow:
+        return {
+            "task_id": task_id,
+            "replica": replica,
+            "file": log_file.name,
+            "lines": log_utils.tail_lines(log_file, lines)
+        }
+    
+    def engine_alive() -> bool:
+        return any(p.get("replica", 0) == replica for p in inference_utils.get_task_processes(engine_id))
+    
+    async def event_stream():
+        async for line in log_utils.follow(log_file, lines, alive=engine_alive):
+            yield f"data: {json.dumps({'line': line}, ensure_ascii=False)}\n\n"
+        yield "data: [END]\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@app.get("/api/inference/tasks/{task_id}/startups", response_model=dict)
+async def get_inference_startups_api(
+    task_id: int,
+    limit: int = Query(20, ge=1, le=200),
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取推理任务最近几次副本启动的阶段耗时"""
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权访问此推理任务")
+    return {
+        "task_id": task_id,
+        "phase_labels": startup_utils.PHASE_LABELS,
+        "startups": get_inference_startups(task_id=task_id, limit=limit)
+    }
+
+@app.get("/api/inference/startups/models", response_model=dict)
+async def get_model_startup_summary(
+    limit: int = Query(1000, ge=1, le=10000),
+    current_user: User = Depends(get_current_active_user)
+):
+    """按模型汇总启动耗时，普通用户只统计自己任务的启动记录"""
+    startups = get_inference_startups(limit=limit)
+    if not current_user.is_admin:
+        task_ids = {task.id for task in get_user_inference_tasks(current_user.id)}
+        startups = [startup for startup in startups if startup["task_id"] in task_ids]
+    models = startup_utils.aggregate_by_model(startups)
+    for item in models:
+        resource = get_resource(item["model_id"]) if item["model_id"] else None
+        item["model_name"] = resource.name if resource else None
+    return {"phase_labels": startup_utils.PHASE_LABELS, "models": models}
+
+@app.post("/api/inference/conversations", response_model=dict)
+async def create_inference_conversation(
+    conversation_data: ConversationCreate,
+    current_user: User = Depends(get_current_active_user)
+):
+    """创建服务端会话，之后的聊天请求只需携带会话ID和新消息"""
+    task = get_inference_task(task_id=conversation_data.task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权使用此推理任务")
+    conversation = conversation_utils.conversation_store.create(
+        task, current_user.id, [msg.dict() for msg in conversation_data.messages], conversation_data.title
+    )
+    return conversation_utils.conversation_store.get(conversation["id"])
+
+@app.get("/api/inference/conversations", response_model=List[dict])
+async def list_inference_conversations(
+    task_id: Optional[int] = None,
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取当前用户的会话列表（不含消息内容）"""
+    return get_user_conversations(current_user.id, task_id)
+
+@app.get("/api/inference/conversations/{conversation_id}", response_model=dict)
+async def get_inference_conversation(
+    conversation_id: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取会话及其全部消息，用于客户端恢复会话"""
+    conversation = conversation_utils.conversation_store.get(conversation_id)
+    if not conversation:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    if not conversation_utils.can_access(conversation, current_user):
+        raise HTTPException(status_code=403, detail="无权访问此会话")
+    return conversation
+
+@app.delete("/api/inference/conversations/{conversation_id}", response_model=dict)
+async def delete_inference_conversation(
+    conversation_id: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """删除会话"""
+    conversation = conversation_utils.conversation_store.get(conversation_id)
+    if not conversation:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    if not conversation_utils.can_access(conversation, current_user):
+        raise HTTPException(status_code=403, detail="无权删除此会话")
+    conversation_utils.conversation_store.delete(conversation_id)
+    return {"message": "会话已删除"}
+
+@app.get("/api/inference/tasks/{task_id}/adapters", response_model=dict)
+async def get_inference_adapters(
+    task_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取挂载在基础模型任务上的LoRA适配器任务
+
+    适配器通过各适配器任务的start/stop接口热加载和卸载。
+    """
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权访问此推理任务")
+    
+    adapters = [
+        {
+            "task_id": adapter.id,
+            "name": adapter.name,
+            "status": adapter.status,
+            "adapter_path": adapter.adapter_path,
+            "user_id": adapter.user_id
+        }
+        for adapter in inference_utils.get_adapter_tasks(task_id)
+    ]
+    return {
+        "enable_lora": task.enable_lora,
+        "max_loras": task.max_loras,
+        "max_lora_rank": task.max_lora_rank,
+        "adapters": adapters
+    }
+
+@app.put("/api/inference/tasks/{task_id}/replicas", response_model=dict)
+async def scale_inference_replicas(
+    task_id: int,
+    params: dict,
+    current_user: User = Depends(get_current_active_user)
+):
+    """运行时调整推理任务的副本数，缩容时等待进行中的请求完成"""
+    try:
+        task = get_inference_task(task_id=task_id)
+        if not task:
+            raise HTTPException(status_code=404, detail="推理任务不存在")
+        
+        if not current_user.is_admin and task.user_id != current_user.id:
+            raise HTTPException(status_code=403, detail="无权修改此推理任务")
+        
+        if task.base_task_id:
+            raise HTTPException(status_code=400, detail="LoRA适配器任务使用基础模型任务的副本，请调整基础模型任务")
+        
+        replicas = params.get("replicas")
+        if not isinstance(replicas, int) or replicas < 1 or replicas > inference_utils.MAX_REPLICAS:
+            raise HTTPException(status_code=400, detail=f"replicas必须是1-{inference_utils.MAX_REPLICAS}之间的整数")
+        
+        result = await inference_utils.scale_inference_service(task_id, replicas)
+        logger.info(f"推理任务 {task_id} 副本数已调整: {result}")
+        return result
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception(f"调整推理副本数失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"调整推理副本数失败: {str(e)}")
+
 @app.get("/api/inference/tasks/{task_id}/status", response_model=dict)
 async def get_inference_task_status(
     task_id: int,
@@ -1390,6 +2021,144 @@ async def get_gpu_status(current_user: User = Depends(get_current_active_user)):
         logger.exception(f"获取GPU状态失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"获取GPU状态失败: {str(e)}")
 
+@app.get("/api/inference/gpu/history", response_model=dict)
+async def get_gpu_history(
+    seconds: Optional[float] = Query(None, description="只返回最近若干秒内的样本"),
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取GPU采样历史（显存、利用率、温度）"""
+    try:
+        samples = gpu_utils.gpu_sampler.history(seconds=seconds)
+        return {
+            "interval": gpu_utils.gpu_sampler.interval,
+            "count": len(samples),
+            "samples": samples
+        }
+    except Exception as e:
+        logger.exception(f"获取GPU历史失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"获取GPU历史失败: {str(e)}")
+
+@app.get("/api/inference/lifecycle", response_model=dict)
+async def get_inference_lifecycle(current_user: User = Depends(get_current_active_user)):
+    """获取推理任务的空闲时间和预热进程池状态"""
+    tasks = []
+    for task in get_all_inference_tasks():
+        if not lifecycle_utils.is_available(task):
+            continue
+        if not current_user.is_admin and task.user_id != current_user.id:
+            continue
+        tasks.append({
+            "task_id": task.id,
+            "status": task.status,
+            "idle_timeout": task.idle_timeout,
+            "idle_seconds": round(lifecycle_utils.get_idle_seconds(task), 1) if task.status == InferenceStatus.RUNNING else None
+        })
+    return {"tasks": tasks, "prewarm_pool": lifecycle_utils.prewarm_pool.status()}
+
+@app.get("/api/inference/tasks/{task_id}/scheduler", response_model=dict)
+async def get_inference_scheduler(
+    task_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取推理任务的并发、排队和拒绝统计"""
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权访问此推理任务")
+    return scheduler_utils.get_scheduler(task).status()
+
+@app.get("/api/inference/tasks/{task_id}/supervisor", response_model=dict)
+async def get_inference_supervisor(
+    task_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取推理任务副本的崩溃、重启和熔断状态"""
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权访问此推理任务")
+    return {
+        "task_id": task_id,
+        "restart": supervisor_utils.engine_supervisor.restart_status(task_id),
+        "replicas": supervisor_utils.engine_supervisor.status(task_id)
+    }
+
+@app.get("/api/inference/cache", response_model=dict)
+async def get_inference_cache_stats(current_user: User = Depends(get_current_active_user)):
+    """获取响应缓存的命中率和节省的GPU时间，普通用户只能看到自己的任务"""
+    if current_user.is_admin:
+        return cache_utils.response_cache.stats()
+    task_ids = [task.id for task in get_user_inference_tasks(current_user.id)]
+    return cache_utils.response_cache.stats(task_ids)
+
+@app.delete("/api/inference/tasks/{task_id}/cache", response_model=dict)
+async def clear_inference_cache(
+    task_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """清除推理任务的响应缓存"""
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权修改此推理任务")
+    removed = cache_utils.response_cache.invalidate_task(task_id)
+    return {"message": "响应缓存已清除", "removed": removed}
+
+@app.get("/api/inference/tasks/{task_id}/metrics", response_model=dict)
+async def get_inference_task_metrics(
+    task_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取推理任务近期的请求速率、吞吐、错误率和延迟分位数"""
+    task = get_inference_task(task_id=task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="推理任务不存在")
+    if not current_user.is_admin and task.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权访问此推理任务")
+    stats = metrics_utils.metrics_registry.task_stats(task_id)
+    if stats is None:
+        stats = {"task_id": task_id, "window_seconds": metrics_utils.METRICS_WINDOW, "in_flight": 0, "totals": {}}
+    return stats
+
+@app.get("/api/inference/metrics", response_model=dict)
+async def get_inference_metrics(current_user: User = Depends(get_current_active_user)):
+    """获取各推理任务的性能统计，普通用户只能看到自己的任务"""
+    if current_user.is_admin:
+        return {"tasks": metrics_utils.metrics_registry.all_task_stats()}
+    task_ids = [task.id for task in get_user_inference_tasks(current_user.id)]
+    return {"tasks": metrics_utils.metrics_registry.all_task_stats(task_ids)}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics(request: Request):
+    """Prometheus格式的推理指标；设置了METRICS_TOKEN时需要携带Bearer令牌"""
+    metrics_token = os.environ.get("METRICS_TOKEN")
+    if metrics_token and request.headers.get("authorization") != f"Bearer {metrics_token}":
+        raise HTTPException(status_code=401, detail="无效的指标访问令牌")
+    schedulers = scheduler_utils.list_schedulers()
+    extra_gauges = {
+        "scheduler_queued": {task_id: status["queued"] for task_id, status in schedulers.items()},
+        "scheduler_in_flight": {task_id: status["in_flight"] for task_id, status in schedulers.items()}
+    }
+    return PlainTextResponse(
+        metrics_utils.metrics_registry.render_prometheus(extra_gauges),
+        media_type="text/plain; version=0.0.4"
+    )
+
+@app.get("/api/inference/gpu/reservations", response_model=dict)
+async def get_gpu_reservations(current_user: User = Depends(get_current_active_user)):
+    """获取当前的显存预留情况"""
+    try:
+        return {
+            "reservations": gpu_utils.gpu_ledger.list(),
+            "outstanding": gpu_utils.gpu_ledger.outstanding()
+        }
+    except Exception as e:
+        logger.exception(f"获取显存预留失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"获取显存预留失败: {str(e)}")
+
 @app.get("/api/inference/gpu/detailed", response_model=dict)
 async def get_detailed_gpu_status(current_user: User = Depends(get_current_active_user)):
     """获取详细的GPU状态信息，包括实时监控数据"""
@@ -1400,6 +2169,7 @@ async def get_detailed_gpu_status(current_user: User = Depends(get_current_activ
         
         return {
             "nvidia_smi_available": real_gpu_info["available"],
+            "telemetry_source": gpu_utils.get_gpu_snapshot().get("source"),
             "real_time_data": real_gpu_info,
             "system_data": gpu_info,
             "recommendations": {
@@ -1433,11 +2203,17 @@ async def inference_chat(
             logger.warning(f"用户 {current_user.username} 无权使用推理任务 {task_id}")
             raise HTTPException(status_code=403, detail="无权使用此推理任务")
         
-        # 检查任务状态
-        if task.status != InferenceStatus.RUNNING:
+        # 检查任务状态（空闲休眠的任务会在推理时自动冷启动）
+        if not lifecycle_utils.is_available(task):
             logger.error(f"推理任务不在运行中: {task_id}, 当前状态: {task.status}")
             raise HTTPException(status_code=400, detail=f"推理任务不在运行中，当前状态: {task.status}")
         
+        # 每日用量配额（只读内存中的当日用量）
+        exceeded = usage_utils.usage_meter.check_quota(current_user.id)
+        if exceeded:
+            logger.warning(f"用户超出用量配额: 用户={current_user.username}, 原因={exceeded['message']}")
+            raise HTTPException(status_code=429, detail=exceeded["message"], headers={"Retry-After": str(exceeded["retry_after"])})
+        
         # 记录请求参数
         logger.debug(f"聊天请求参数: task_id={task_id}, temperature={chat_request.temperature}, " 
                     f"top_p={chat_request.top_p}, max_tokens={chat_request.max_tokens}, "
@@ -1448,31 +2224,90 @@ async def inference_chat(
         if last_user_msg:
             logger.debug(f"最后用户消息(前50个字符): {last_user_msg[:50]}...")
         
-        # 执行推理
+        # 服务端会话：messages只是本轮新增的消息，历史从会话中读取
         messages = [msg.dict() for msg in chat_request.messages]
-        start_time = time.time()
-        result = await inference_utils.perform_inference(
-            task_id=task_id,
-            messages=messages,
-            temperature=chat_request.temperature,
-            top_p=chat_request.top_p,
-            max_tokens=chat_request.max_tokens,
-            repetition_penalty=chat_request.repetition_penalty
-        )
-        inference_time = time.time() - start_time
+        conversation_id = chat_request.conversation_id
+        conversation_locked = False
+        if conversation_id:
+            conversation = conversation_utils.conversation_store.get(conversation_id)
+            if not conversation:
+                raise HTTPException(status_code=404, detail="会话不存在")
+            if conversation["task_id"] != task_id:
+                raise HTTPException(status_code=400, detail="会话不属于此推理任务")
+            if not conversation_utils.can_access(conversation, current_user):
+                raise HTTPException(status_code=403, detail="无权访问此会话")
+            await conversation_utils.conversation_store.acquire(conversation_id)
+            conversation_locked = True
         
-        if "error" in result:
-            logger.error(f"推理失败: {result['error']}")
-            raise HTTPException(status_code=500, detail=result["error"])
+        try:
+            session_id = None
+            if conversation_id:
+                chat_history = await conversation_utils.conversation_store.history(conversation_id, task)
+                for message in messages:
+                    if not chat_history.can_fit(message):
+                        raise HTTPException(status_code=400, detail=f"消息过长，超出模型上下文限制（可用 {chat_history.budget} tokens）")
+                for message in messages:
+                    chat_history.append(message)
+                chat_history.fit()
+                session_id = conversation_utils.session_key(conversation_id)
+            
+            # 准入控制：超过并发上限时按用户公平排队，队列已满时返回429
+            scheduler = scheduler_utils.get_scheduler(task)
+            try:
+                queue_wait = await scheduler.acquire(f"user:{current_user.id}")
+            except scheduler_utils.SchedulerBusy as e:
+                logger.warning(f"推理任务繁忙，拒绝请求: 任务ID={task_id}, 用户={current_user.username}, 原因={e.message}")
+                raise HTTPException(status_code=429, detail=e.message, headers={"Retry-After": str(int(e.retry_after) + 1)})
+            
+            # 执行推理
+            start_time = time.time()
+            try:
+                result = await inference_utils.perform_inference(
+                    task_id=task_id,
+                    messages=chat_history.messages() if conversation_id else messages,
+                    temperature=chat_request.temperature,
+                    top_p=chat_request.top_p,
+                    max_tokens=chat_request.max_tokens,
+                    repetition_penalty=chat_request.repetition_penalty,
+                    session_id=session_id,
+                    user_id=current_user.id
+                )
+            finally:
+                inference_time = time.time() - start_time
+                scheduler.release(inference_time)
+            
+            if "error" in result:
+                logger.error(f"推理失败: {result['error']}")
+                if "retry_after" in result:
+                    # 引擎正在重启或已熔断
+                    headers = {"Retry-After": str(result["retry_after"])} if result["retry_after"] else None
+                    raise HTTPException(status_code=503, detail=result["error"], headers=headers)
+                raise HTTPException(status_code=500, detail=result["error"])
+            
+            # 本轮的新消息和回复写入会话
+            if conversation_id:
+                chat_history.append(result["message"])
+                conversation_utils.conversation_store.append(conversation_id, messages + [result["message"]])
+        except BaseException:
+            if conversation_id:
+                # 上下文中已加入本轮消息，丢弃缓存后下次从存储重建
+                conversation_utils.conversation_store.evict(conversation_id)
+            raise
+        finally:
+            if conversation_locked:
+                conversation_utils.conversation_store.release(conversation_id)
         
         # 记录响应结果
         response_content = result["message"]["content"]
-        logger.info(f"推理成功: 任务ID={task_id}, 耗时={inference_time:.2f}秒, 响应长度={len(response_content)}")
+        logger.info(f"推理成功: 任务ID={task_id}, 排队={queue_wait:.2f}秒, 生成={inference_time:.2f}秒, 响应长度={len(response_content)}")
         logger.debug(f"响应内容(前50个字符): {response_content[:50]}...")
         
         return ChatResponse(
             message=Message(**result["message"]),
-            task_id=task_id
+            task_id=task_id,
+            queue_wait=round(queue_wait, 3),
+            generation_time=round(inference_time, 3),
+            conversation_id=conversation_id
         )
     except HTTPException:
         raise
@@ -1480,6 +2315,69 @@ async def inference_chat(
         logger.exception(f"推理失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"推理失败: {str(e)}")
 
+@app.post("/api/inference/compare")
+async def compare_inference_tasks(
+    compare_request: CompareRequest,
+    current_user: User = Depends(get_current_active_user)
+):
+    """把同一组消息并发发送给多个推理任务进行对比
+
+    stream为True时以NDJSON逐行输出事件：各模型的增量内容按到达顺序交错输出并标记task_id，
+    每个模型结束时输出done/error/timeout事件及统计，最后输出summary。
+    每个模型有独立的截止时间，超时的模型单独结束。
+    """
+    task_ids = list(dict.fromkeys(compare_request.task_ids))
+    if len(task_ids) < 2:
+        raise HTTPException(status_code=400, detail="至少需要两个不同的推理任务")
+    if len(task_ids) > compare_utils.COMPARE_MAX_TASKS:
+        raise HTTPException(status_code=400, detail=f"一次最多对比 {compare_utils.COMPARE_MAX_TASKS} 个推理任务")
+    if not compare_request.messages:
+        raise HTTPException(status_code=400, detail="消息不能为空")
+    
+    tasks = []
+    for task_id in task_ids:
+        task = get_inference_task(task_id=task_id)
+        if not task:
+            raise HTTPException(status_code=404, detail=f"推理任务不存在: {task_id}")
+        if not gateway_utils.can_access_task(task, current_user):
+            raise HTTPException(status_code=403, detail=f"无权使用推理任务: {task_id}")
+        if not lifecycle_utils.is_available(task):
+            raise HTTPException(status_code=400, detail=f"推理任务 {task_id} 不在运行中，当前状态: {task.status}")
+        tasks.append(task)
+    
+    exceeded = usage_utils.usage_meter.check_quota(current_user.id)
+    if exceeded:
+        raise HTTPException(status_code=429, detail=exceeded["message"], headers={"Retry-After": str(exceeded["retry_after"])})
+    
+    deadline = compare_request.deadline or compare_utils.COMPARE_DEADLINE
+    deadline = max(1.0, min(deadline, compare_utils.COMPARE_MAX_DEADLINE))
+    params = {
+        "temperature": compare_request.temperature,
+        "top_p": compare_request.top_p,
+        "max_tokens": compare_request.max_tokens,
+        "repetition_penalty": compare_request.repetition_penalty
+    }
+    messages = [msg.dict() for msg in compare_request.messages]
+    logger.info(f"多模型对比: 用户={current_user.username}, 任务={task_ids}, 截止时间={deadline}秒")
+    events = compare_utils.compare(tasks, messages, params, f"user:{current_user.id}", deadline,
+                                   user_id=current_user.id)
+    
+    if compare_request.stream:
+        async def ndjson():
+            async for event in events:
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    
+    contents = {}
+    async for event in events:
+        if event["type"] in compare_utils.TERMINAL_EVENTS:
+            contents[event["task_id"]] = event["content"]
+        elif event["type"] == "summary":
+            for result in event["results"]:
+                result["content"] = contents.get(result["task_id"], "")
+            return event
+    raise HTTPException(status_code=500, detail="对比未完成")
+
 @app.put("/api/inference/tasks/{task_id}/params", response_model=InferenceTask)
 async def update_inference_params(
     task_id: int,
@@ -1513,6 +2411,45 @@ async def update_inference_params(
             raise HTTPException(status_code=400, detail="display_name必须是字符串")
         share_settings["display_name"] = display_name
     
+    # 空闲自动停止时间（秒，0表示不自动停止，不受任务状态限制）
+    if "idle_timeout" in params:
+        idle_timeout = params["idle_timeout"]
+        if not isinstance(idle_timeout, int) or idle_timeout < 0:
+            raise HTTPException(status_code=400, detail="idle_timeout必须是非负整数")
+        share_settings["idle_timeout"] = idle_timeout
+    
+    # 引擎配置（下次启动时生效，不受任务状态限制）
+    if "engine_profile" in params:
+        engine_profile = params["engine_profile"]
+        if engine_profile not in inference_utils.ENGINE_PROFILES:
+            raise HTTPException(status_code=400, detail=f"engine_profile必须是: {', '.join(inference_utils.ENGINE_PROFILES)}")
+        share_settings["engine_profile"] = engine_profile
+    
+    # 响应缓存开关（不受任务状态限制）
+    if "response_cache" in params:
+        if not isinstance(params["response_cache"], bool):
+            raise HTTPException(status_code=400, detail="response_cache必须是布尔值")
+        share_settings["response_cache"] = params["response_cache"]
+    
+    # 并发生成上限（0表示自动，立即生效，不受任务状态限制）
+    if "max_in_flight" in params:
+        max_in_flight = params["max_in_flight"]
+        if not isinstance(max_in_flight, int) or max_in_flight < 0:
+            raise HTTPException(status_code=400, detail="max_in_flight必须是非负整数")
+        share_settings["max_in_flight"] = max_in_flight
+    
+    # 多LoRA服务设置（下次启动时生效，不受任务状态限制）
+    if "enable_lora" in params:
+        if not isinstance(params["enable_lora"], bool):
+            raise HTTPException(status_code=400, detail="enable_lora必须是布尔值")
+        share_settings["enable_lora"] = params["enable_lora"]
+    for key, upper in (("max_loras", 64), ("max_lora_rank", 256)):
+        if key in params:
+            value = params[key]
+            if not isinstance(value, int) or value < 1 or value > upper:
+                raise HTTPException(status_code=400, detail=f"{key}必须是1-{upper}之间的整数")
+            share_settings[key] = value
+    
     # 如果有共享设置参数，无论任务状态如何都更新它们
     if share_settings:
         updated_task = update_inference_task(
@@ -1523,17 +2460,20 @@ async def update_inference_params(
         if not updated_task:
             raise HTTPException(status_code=500, detail="更新共享设置失败")
         
+        # 参数变化后已缓存的响应可能不再对应当前配置
+        cache_utils.response_cache.invalidate_task(task_id)
+        
         logger.info(f"已更新推理任务共享设置: task_id={task_id}, settings={share_settings}")
         
         # 如果只有共享设置参数且已更新，直接返回更新后的任务
-        if task.status != InferenceStatus.RUNNING or not set(params.keys()) - set(share_settings.keys()):
+        if not lifecycle_utils.is_available(task) or not set(params.keys()) - set(share_settings.keys()):
             return updated_task
         
         # 如果还有其他参数且任务在运行中，继续处理其他参数
         task = updated_task
     
-    # 只允许更新运行中的任务的推理参数
-    if task.status != InferenceStatus.RUNNING:
+    # 只允许更新可用任务（运行中或空闲休眠）的推理参数，采样参数按请求生效，休眠的任务也可以调整
+    if not lifecycle_utils.is_available(task):
         raise HTTPException(status_code=400, detail="只能更新运行中的任务的推理参数")
     
     # 提取并验证推理参数
@@ -1587,6 +2527,8 @@ async def update_inference_params(
     if not updated_task:
         raise HTTPException(status_code=500, detail="更新参数失败")
     
+    cache_utils.response_cache.invalidate_task(task_id)
+    
     logger.info(f"已更新推理任务参数: task_id={task_id}, params={update_data}")
     return updated_task
 
@@ -1687,13 +2629,13 @@ async def get_shared_tasks_simple():
     total_tasks = len(all_tasks)
     shared_tasks = len([t for t in all_tasks if t.share_enabled])
     running_tasks = len([t for t in all_tasks if t.status == InferenceStatus.RUNNING])
-    shared_running = len([t for t in all_tasks if t.share_enabled and t.status == InferenceStatus.RUNNING])
+    shared_running = len([t for t in all_tasks if t.share_enabled and lifecycle_utils.is_available(t)])
     
     logger.info(f"共享API - 总任务数: {total_tasks}, 共享任务: {shared_tasks}, 运行中任务: {running_tasks}, 共享且运行中: {shared_running}")
     
-    # 过滤出已共享且正在运行的任务
+    # 过滤出已共享且可用（运行中或空闲休眠）的任务
     for task in all_tasks:
-        if task.share_enabled and task.status == InferenceStatus.RUNNING:
+        if task.share_enabled and lifecycle_utils.is_available(task):
             # 验证任务是否真正可用
             try:
                 # 检查推理服务是否真正运行
@@ -1731,7 +2673,7 @@ async def get_shared_task_simple(task_id: int):
     if not task:
         raise HTTPException(status_code=404, detail="推理任务不存在")
     
-    if not task.share_enabled or task.status != InferenceStatus.RUNNING:
+    if not task.share_enabled or not lifecycle_utils.is_available(task):
         raise HTTPException(status_code=403, detail="该推理任务未共享或未运行")
     
     # 验证任务是否真正可用
@@ -1749,6 +2691,256 @@ async def get_shared_task_simple(task_id: int):
         "repetition_penalty": task.repetition_penalty
     }
 
+# ========== OpenAI兼容网关 ==========
+
+async def _gateway_completion(request: Request, path: str, current_user: Optional[User]):
+    """把OpenAI格式的请求按model字段转发到对应的推理任务"""
+    try:
+        payload = await request.json()
+    except Exception:
+        return JSONResponse(status_code=400, content=gateway_utils.GatewayError(400, "请求体不是有效的JSON").to_dict())
+    
+    # 多轮对话可通过X-Session-ID请求头固定到同一副本
+    session_id = request.headers.get("x-session-id")
+    user_id = current_user.id if current_user else None
+    try:
+        task = gateway_utils.resolve_task(payload.get("model"), current_user)
+        gateway_utils.check_quota(current_user)
+        if task.status != InferenceStatus.RUNNING:
+            # 空闲休眠的模型在第一个请求到达时冷启动，请求等待引擎就绪
+            try:
+                task = await lifecycle_utils.ensure_running(task.id)
+            except RuntimeError as e:
+                raise gateway_utils.GatewayError(503, f"模型冷启动失败: {str(e)}", error_type="server_error")
+        
+        # 准入控制：与聊天接口共用按客户端公平排队的调度器，匿名访问按来源地址区分
+        scheduler = scheduler_utils.get_scheduler(task)
+        client_key = f"user:{current_user.id}" if current_user else f"anon:{request.client.host if request.client else 'unknown'}"
+        try:
+            await scheduler.acquire(client_key)
+        except scheduler_utils.SchedulerBusy as e:
+            raise gateway_utils.GatewayError(429, e.message, error_type="rate_limit_error",
+                                             code="server_busy", retry_after=int(e.retry_after) + 1)
+        generation_start = time.monotonic()
+        handed_off = False
+        try:
+            if payload.get("stream"):
+                upstream, handle, timer = await gateway_utils.open_stream(task, path, payload, session_id, user_id)
+                
+                async def stream_body():
+                    # 流式响应结束（或客户端断开）时才归还名额
+                    stream = gateway_utils.iter_stream(upstream, handle, timer)
+                    try:
+                        async for data in stream:
+                            yield data
+                    finally:
+                        await stream.aclose()
+                        scheduler.release(time.monotonic() - generation_start)
+                
+                handed_off = True
+                return StreamingResponse(
+                    stream_body(),
+                    media_type=upstream.headers.get("content-type", "text/event-stream")
+                )
+            status_code, body = await gateway_utils.forward_json(task, path, payload, session_id, user_id)
+            return JSONResponse(status_code=status_code, content=body)
+        finally:
+            if not handed_off:
+                scheduler.release(time.monotonic() - generation_start)
+    except gateway_utils.GatewayError as e:
+        logger.warning(f"网关请求失败: path={path}, model={payload.get('model')}, 错误={e.message}")
+        headers = {"Retry-After": str(e.retry_after)} if e.retry_after else None
+        return JSONResponse(status_code=e.status_code, content=e.to_dict(), headers=headers)
+    except Exception as e:
+        logger.exception(f"网关请求异常: {str(e)}")
+        return JSONResponse(status_code=500, content=gateway_utils.GatewayError(500, str(e), error_type="server_error").to_dict())
+
+@app.get("/v1/models")
+async def gateway_list_models(current_user: Optional[User] = Depends(get_optional_user)):
+    """列出可访问的运行中模型"""
+    return {"object": "list", "data": gateway_utils.list_accessible_models(current_user)}
+
+@app.post("/v1/chat/completions")
+async def gateway_chat_completions(request: Request, current_user: Optional[User] = Depends(get_optional_user)):
+    """OpenAI兼容的对话补全接口"""
+    return await _gateway_completion(request, "chat/completions", current_user)
+
+@app.post("/v1/completions")
+async def gateway_completions(request: Request, current_user: Optional[User] = Depends(get_optional_user)):
+    """OpenAI兼容的文本补全接口"""
+    return await _gateway_completion(request, "completions", current_user)
+
+# ========== 批量推理 ==========
+
+def _get_batch_job_for_user(job_id: int, current_user: User) -> BatchJob:
+    job = get_batch_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="批量任务不存在")
+    if not current_user.is_admin and job.user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="无权访问此批量任务")
+    return job
+
+@app.post("/api/batch/jobs", response_model=BatchJob)
+async def create_batch_job_api(
+    file: UploadFile = File(..., description="JSONL文件，每行一个对话请求"),
+    task_id: int = Form(...),
+    name: Optional[str] = Form(None),
+    concurrency: Optional[int] = Form(None),
+    current_user: User = Depends(get_current_active_user)
+):
+    """上传JSONL请求文件，创建并启动批量推理任务"""
+    job_dir = None
+    try:
+        task = get_inference_task(task_id=task_id)
+        if not task:
+            raise HTTPException(status_code=404, detail="推理任务不存在")
+        if not gateway_utils.can_access_task(task, current_user):
+            raise HTTPException(status_code=403, detail="无权使用此推理任务")
+        if not lifecycle_utils.is_available(task):
+            raise HTTPException(status_code=400, detail=f"推理任务未运行，当前状态: {task.status}")
+        if concurrency is not None and not 1 <= concurrency <= batch_utils.MAX_BATCH_CONCURRENCY:
+            raise HTTPException(status_code=400, detail=f"concurrency必须是1-{batch_utils.MAX_BATCH_CONCURRENCY}之间的整数")
+        exceeded = usage_utils.usage_meter.check_quota(current_user.id)
+        if exceeded:
+            raise HTTPException(status_code=429, detail=exceeded["message"], headers={"Retry-After": str(exceeded["retry_after"])})
+        
+        # 分块保存上传文件，避免大文件一次性读入内存
+        job_dir = batch_utils.new_job_dir()
+        input_path = job_dir / "input.jsonl"
+        with open(input_path, "wb") as f:
+            while chunk := await file.read(1024 * 1024):
+                f.write(chunk)
+        
+        inspection = await asyncio.to_thread(batch_utils.inspect_input, input_path)
+        if inspection["errors"]:
+            raise HTTPException(status_code=400, detail="输入文件格式错误: " + "；".join(inspection["errors"]))
+        if not inspection["total"]:
+            raise HTTPException(status_code=400, detail="输入文件中没有请求")
+        
+        job = create_batch_job(
+            name=name or file.filename or f"batch-{task_id}",
+            task_id=task_id,
+            user_id=current_user.id,
+            input_path=str(input_path),
+            output_path=str(job_dir / "output.jsonl"),
+            total=inspection["total"],
+            concurrency=concurrency or batch_utils.default_concurrency(task)
+        )
+        batch_utils.start_job(job.id)
+        logger.info(f"批量任务创建成功: ID={job.id}, 推理任务={task_id}, 请求数={job.total}, 并发={job.concurrency}")
+        return job
+    except HTTPException:
+        if job_dir:
+            shutil.rmtree(job_dir, ignore_errors=True)
+        raise
+    except Exception as e:
+        if job_dir:
+            shutil.rmtree(job_dir, ignore_errors=True)
+        logger.exception(f"创建批量任务失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"创建批量任务失败: {str(e)}")
+
+@app.get("/api/batch/jobs", response_model=List[BatchJob])
+async def get_batch_jobs_api(current_user: User = Depends(get_current_active_user)):
+    """获取批量推理任务列表"""
+    if current_user.is_admin:
+        return get_all_batch_jobs()
+    return get_user_batch_jobs(current_user.id)
+
+@app.get("/api/batch/jobs/{job_id}", response_model=dict)
+async def get_batch_job_api(
+    job_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """获取批量推理任务详情和实时进度"""
+    job = _get_batch_job_for_user(job_id, current_user)
+    return {"job": job, "progress": batch_utils.get_job_progress(job_id)}
+
+@app.post("/api/batch/jobs/{job_id}/stop", response_model=dict)
+async def stop_batch_job_api(
+    job_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """停止批量推理任务，已完成的结果保留，之后可以恢复"""
+    _get_batch_job_for_user(job_id, current_user)
+    if not await batch_utils.stop_job(job_id):
+        raise HTTPException(status_code=400, detail="批量任务不在运行中")
+    return {"message": "批量任务已停止"}
+
+@app.post("/api/batch/jobs/{job_id}/resume", response_model=dict)
+async def resume_batch_job_api(
+    job_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """恢复批量推理任务：跳过已成功的请求，重试失败和未执行的请求"""
+    job = _get_batch_job_for_user(job_id, current_user)
+    task = get_inference_task(task_id=job.task_id)
+    if not task or not lifecycle_utils.is_available(task):
+        raise HTTPException(status_code=400, detail="目标推理任务不存在或未运行")
+    # 按任务所有者的配额检查（管理员也可能恢复他人的任务）
+    exceeded = usage_utils.usage_meter.check_quota(job.user_id)
+    if exceeded:
+        raise HTTPException(status_code=429, detail=exceeded["message"], headers={"Retry-After": str(exceeded["retry_after"])})
+    if not batch_utils.start_job(job_id):
+        raise HTTPException(status_code=400, detail="批量任务已在运行中")
+    return {"message": "批量任务已恢复"}
+
+@app.get("/api/batch/jobs/{job_id}/output")
+async def download_batch_output(
+    job_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """下载批量推理的输出JSONL（运行中也可以下载已完成的部分）"""
+    job = _get_batch_job_for_user(job_id, current_user)
+    if not Path(job.output_path).exists():
+        raise HTTPException(status_code=404, detail="输出文件尚未生成")
+    return FileResponse(job.output_path, media_type="application/x-ndjson", filename=f"batch_{job_id}_output.jsonl")
+
+@app.delete("/api/batch/jobs/{job_id}", response_model=dict)
+async def delete_batch_job_api(
+    job_id: int,
+    current_user: User = Depends(get_current_active_user)
+):
+    """删除批量推理任务及其输入输出文件"""
+    job = _get_batch_job_for_user(job_id, current_user)
+    await batch_utils.stop_job(job_id)
+    shutil.rmtree(Path(job.input_path).parent, ignore_errors=True)
+    if not delete_batch_job(job_id):
+        raise HTTPException(status_code=500, detail="删除批量任务失败")
+    return {"message": "批量任务已删除"}
+
+@app.websocket("/ws/batch/{job_id}")
+async def websocket_batch_progress(websocket: WebSocket, job_id: int):
+    """WebSocket端点，推送批量推理任务的进度和吞吐"""
+    await websocket.accept()
+    
+    job = get_batch_job(job_id)
+    if not job:
+        await websocket.close(code=1000, reason="批量任务不存在")
+        return
+    
+    batch_utils.register_websocket(job_id, websocket)
+    try:
+        progress = batch_utils.get_job_progress(job_id)
+        await websocket.send_text(json.dumps(progress or {
+            "type": "status",
+            "job_id": job_id,
+            "status": job.status,
+            "total": job.total,
+            "completed": job.completed,
+            "failed": job.failed,
+            "error_message": job.error_message
+        }, ensure_ascii=False))
+        while True:
+            data = await websocket.receive_text()
+            if data == "ping":
+                await websocket.send_text("pong")
+    except WebSocketDisconnect:
+        logger.info(f"批量任务WebSocket客户端断开连接: job_id={job_id}")
+    except Exception as e:
+        logger.error(f"批量任务WebSocket错误: job_id={job_id}, error={str(e)}")
+    finally:
+        batch_utils.remove_websocket(job_id, websocket)
+
 @app.websocket("/api/ws/chat/{task_id}")
 async def websocket_chat(
     websocket: WebSocket,
@@ -1768,8 +2960,8 @@ async def websocket_chat(
             logger.error(f"WebSocket聊天连接请求任务不存在: task_id={task_id}")
             return
         
-        # 检查任务状态
-        if task.status != InferenceStatus.RUNNING:
+        # 检查任务状态（空闲休眠的任务在第一条消息时冷启动）
+        if not lifecycle_utils.is_available(task):
             await websocket.close(code=1000, reason=f"推理任务未运行，当前状态: {task.status}")
             logger.error(f"WebSocket聊天连接请求任务未运行: task_id={task_id}, status={task.status}")
             return
@@ -1817,15 +3009,40 @@ async def websocket_chat(
         
         logger.info(f"WebSocket聊天连接已建立: task_id={task_id}, 共享任务={is_shared_task}")
         
-        # 历史消息记录
-        chat_history = []
+        # 服务端会话：提供conversation_id时恢复已有会话，否则新建；客户端每轮只发送新消息
+        conversation_store = conversation_utils.conversation_store
+        conversation_id = websocket.query_params.get("conversation_id")
+        if conversation_id:
+            conversation = conversation_store.get(conversation_id)
+            if not conversation or conversation["task_id"] != task_id:
+                await websocket.close(code=1000, reason="会话不存在")
+                logger.error(f"WebSocket聊天连接请求的会话不存在: task_id={task_id}, conversation_id={conversation_id}")
+                return
+            if not conversation_utils.can_access(conversation, authorized_user):
+                await websocket.close(code=1000, reason="无权访问此会话")
+                logger.error(f"WebSocket聊天连接无权访问会话: task_id={task_id}, conversation_id={conversation_id}")
+                return
+        else:
+            conversation = conversation_store.create(task, authorized_user.id if authorized_user else None)
+            conversation_id = conversation["id"]
+        # 会话上下文（按模型tokenizer统计token，超出上下文预算时裁剪最早的轮次）
+        chat_history = await conversation_store.history(conversation_id, task)
+        # 会话标识，用于把整段对话（包括重连后）路由到持有其前缀缓存的副本
+        session_id = conversation_utils.session_key(conversation_id)
+        # 公平排队的客户端标识：登录用户按用户ID，匿名访问共享任务按来源地址
+        if authorized_user:
+            client_key = f"user:{authorized_user.id}"
+        else:
+            client_key = f"anon:{websocket.client.host if websocket.client else session_id}"
         
         # 发送连接建立确认
         display_name = task.display_name or task.name
         await websocket.send_text(json.dumps({
             "type": "connected",
             "task_id": task_id,
-            "model_name": display_name
+            "model_name": display_name,
+            "conversation_id": conversation_id,
+            "history": conversation["messages"]
         }))
         
         # 保持连接打开，监听消息
@@ -1844,31 +3061,98 @@ async def websocket_chat(
                     log_prefix = "共享" if is_shared_task else ""
                     logger.info(f"WebSocket收到{log_prefix}聊天消息: task_id={task_id}, length={len(user_message)}")
                     
-                    # 添加到历史记录
-                    chat_history.append({"role": "user", "content": user_message})
+                    # 单条消息就超出上下文预算时直接拒绝，不必等vLLM报错
+                    new_message = {"role": "user", "content": user_message}
+                    if not chat_history.can_fit(new_message):
+                        await websocket.send_text(json.dumps({
+                            "type": "error",
+                            "error": f"消息过长，超出模型上下文限制（可用 {chat_history.budget} tokens）"
+                        }))
+                        logger.warning(f"WebSocket{log_prefix}聊天消息超出上下文预算: task_id={task_id}")
+                        continue
+                    
+                    # 每日用量配额（匿名访问不限制）
+                    exceeded = usage_utils.usage_meter.check_quota(authorized_user.id if authorized_user else None)
+                    if exceeded:
+                        await websocket.send_text(json.dumps({
+                            "type": "error",
+                            "error": exceeded["message"],
+                            "retry_after": exceeded["retry_after"]
+                        }))
+                        continue
                     
+                    # 同一会话可能有多个连接，各轮对话依次处理；
+                    # 与REST接口一致，先取会话锁再取并发名额，避免两条路径交叉等待
+                    scheduler = scheduler_utils.get_scheduler(task)
+                    await conversation_store.acquire(conversation_id)
+                    admitted = False
+                    turn_saved = False
+                    generation_time = None
                     try:
+                        # 准入控制：超过并发上限时排队，无法接纳时立即返回busy
+                        if scheduler.would_wait():
+                            await websocket.send_text(json.dumps({
+                                "type": "queued",
+                                "queued": scheduler.queued,
+                                "in_flight": scheduler.in_flight
+                            }))
+                        try:
+                            queue_wait = await scheduler.acquire(client_key)
+                        except scheduler_utils.SchedulerBusy as e:
+                            await websocket.send_text(json.dumps({
+                                "type": "busy",
+                                "error": e.message,
+                                "retry_after": e.retry_after
+                            }))
+                            logger.warning(f"WebSocket{log_prefix}聊天请求被拒绝: task_id={task_id}, client={client_key}, 原因={e.message}")
+                            continue
+                        admitted = True
+                        generation_start = time.time()
+                        
+                        # 添加到会话上下文，并裁剪到上下文预算内
+                        chat_history = await conversation_store.history(conversation_id, task)
+                        chat_history.append(new_message)
+                        chat_history.fit()
+                        
+                        # 空闲休眠的任务需要冷启动，先通知客户端
+                        current_task = get_inference_task(task_id=task_id)
+                        if current_task and current_task.status != InferenceStatus.RUNNING:
+                            await websocket.send_text(json.dumps({
+                                "type": "status",
+                                "content": "模型正在启动，请稍候..."
+                            }))
+                        
                         # 调用推理API
-                        result = await inference_utils.perform_inference(
-                            task_id=task_id,
-                            messages=chat_history,
-                            temperature=task.temperature,
-                            top_p=task.top_p,
-                            max_tokens=task.max_tokens,
-                            repetition_penalty=task.repetition_penalty
-                        )
+                        try:
+                            result = await inference_utils.perform_inference(
+                                task_id=task_id,
+                                messages=chat_history.messages(),
+                                temperature=task.temperature,
+                                top_p=task.top_p,
+                                max_tokens=task.max_tokens,
+                                repetition_penalty=task.repetition_penalty,
+                                session_id=session_id,
+                                user_id=authorized_user.id if authorized_user else None
+                            )
+                        finally:
+                            # 生成结束即归还名额，后面的分段发送不占用并发
+                            generation_time = time.time() - generation_start
+                            scheduler.release(generation_time)
                         
                         if "error" in result:
                             # 发送错误消息
                             await websocket.send_text(json.dumps({
                                 "type": "error",
-                                "error": result["error"]
+                                "error": result["error"],
+                                "retry_after": result.get("retry_after")
                             }))
                             logger.error(f"WebSocket{log_prefix}聊天推理错误: task_id={task_id}, error={result['error']}")
                         else:
-                            # 添加回复到历史记录
+                            # 本轮消息和回复写入会话
                             assistant_message = result["message"]
                             chat_history.append(assistant_message)
+                            conversation_store.append(conversation_id, [new_message, assistant_message])
+                            turn_saved = True
                             
                             # 获取回复内容
                             content = ""
@@ -1902,10 +3186,12 @@ async def websocket_chat(
                                     # 添加小延迟模拟打字效果
                                     await asyncio.sleep(0.05)
                             
-                            # 发送结束消息
+                            # 发送结束消息，排队时间和生成时间分开报告
                             await websocket.send_text(json.dumps({
                                 "type": "end",
-                                "content": content
+                                "content": content,
+                                "queue_wait": round(queue_wait, 3),
+                                "generation_time": round(generation_time, 3)
                             }))
                             logger.info(f"WebSocket{log_prefix}聊天推理完成: task_id={task_id}")
                     except Exception as e:
@@ -1914,10 +3200,20 @@ async def websocket_chat(
                             "error": f"推理处理错误: {str(e)}"
                         }))
                         logger.exception(f"WebSocket{log_prefix}聊天处理异常: task_id={task_id}")
+                    finally:
+                        if admitted:
+                            # 推理开始前出错时也要归还名额
+                            if generation_time is None:
+                                scheduler.release()
+                            if not turn_saved:
+                                # 上下文中已加入未保存的消息，丢弃缓存后下次从存储重建
+                                conversation_store.evict(conversation_id)
+                        conversation_store.release(conversation_id)
                 
                 elif message.get("type") == "clear_history":
                     # 清空聊天历史
-                    chat_history = []
+                    async with conversation_store.lock(conversation_id):
+                        conversation_store.clear(conversation_id)
                     logger.info(f"WebSocket{log_prefix}聊天历史已清空: task_id={task_id}")
                     
             except WebSocketDisconnect:
@@ -0,0 +1,269 @@
+"""
+推理性能指标
+按推理任务在内存中统计请求数、错误数、token数、首token时间（TTFT）、token间延迟、端到端延迟、
+排队时间和进行中的请求数。累计值和直方图以Prometheus文本格式导出，
+滚动时间窗口内的样本用于计算各任务近期的分位数和吞吐
+"""
+
+import os
+import time
+import math
+import threading
+from collections import deque
+from typing import Dict, Any, Optional, List, Tuple
+
+# 指标配置
+METRICS_WINDOW = float(os.environ.get("METRICS_WINDOW", "300"))
+METRICS_WINDOW_MAX_SAMPLES = int(os.environ.get("METRICS_WINDOW_MAX_SAMPLES", "10000"))
+
+# 直方图分桶（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0)
+
+HISTOGRAMS = {
+    "ttft_seconds": ("首token时间", LATENCY_BUCKETS),
+    "inter_token_latency_seconds": ("平均token间延迟", TOKEN_LATENCY_BUCKETS),
+    "e2e_latency_seconds": ("端到端延迟", LATENCY_BUCKETS),
+    "queue_wait_seconds": ("准入排队时间", LATENCY_BUCKETS),
+}
+COUNTERS = {
+    "requests_total": "请求数",
+    "errors_total": "失败的请求数",
+    "prompt_tokens_total": "输入token数",
+    "completion_tokens_total": "输出token数",
+}
+
+class Histogram:
+    """累计直方图（Prometheus语义，桶计数为小于等于上界的累计值）"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+def _percentile(values: List[float], percent: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(percent / 100 * len(ordered)) - 1))
+    return round(ordered[index], 4)
+
+class TaskMetrics:
+    """单个推理任务的指标"""
+
+    def __init__(self, task_id: int, model: str):
+        self.task_id = task_id
+        self.model = model
+        self.counters = {name: 0 for name in COUNTERS}
+        self.histograms = {name: Histogram(buckets) for name, (_, buckets) in HISTOGRAMS.items()}
+        self.in_flight = 0
+        # 滚动窗口样本：(时间, 指标名, 值)
+        self.window: deque = deque(maxlen=METRICS_WINDOW_MAX_SAMPLES)
+
+    def observe(self, name: str, value: float, now: float) -> None:
+        self.histograms[name].observe(value)
+        self.window.append((now, name, value))
+
+    def trim(self, now: float) -> None:
+        while self.window and self.window[0][0] < now - METRICS_WINDOW:
+            self.window.popleft()
+
+class RequestTimer:
+    """一次推理请求的计时器：开始时计入进行中，结束时记录延迟和token数"""
+
+    def __init__(self, registry: "MetricsRegistry", task_id: int, model: str,
+                 user_id: Optional[int] = None, engine: Optional[Tuple[int, int, int]] = None):
+        from usage_utils import usage_meter
+
+        self.registry = registry
+        self.task_id = task_id
+        self.model = model
+        self.user_id = user_id
+        # (引擎任务ID, 每个副本的GPU数, 副本数)，用于分摊GPU秒
+        self.engine = engine
+        self.engine_entered_at = usage_meter.enter(engine[0], engine[2]) if engine else 0.0
+        self.start_time = time.monotonic()
+        self.first_token_time: Optional[float] = None
+        self.finished = False
+
+    def mark_first_token(self) -> None:
+        if self.first_token_time is None:
+            self.first_token_time = time.monotonic()
+
+    def finish(self, ok: bool, prompt_tokens: int = 0, completion_tokens: int = 0) -> float:
+        """结束计时并返回端到端耗时；重复调用只记录一次"""
+        end_time = time.monotonic()
+        if self.finished:
+            return end_time - self.start_time
+        self.finished = True
+        ttft = self.first_token_time - self.start_time if self.first_token_time is not None else None
+        inter_token = None
+        if self.first_token_time is not None and completion_tokens > 1:
+            inter_token = (end_time - self.first_token_time) / (completion_tokens - 1)
+        self.registry._record(self.task_id, self.model, ok, end_time - self.start_time,
+                              ttft, inter_token, prompt_tokens, completion_tokens)
+        # 同时累加到按用户计量的用量中；GPU秒为本请求分摊到的引擎占用时间 × GPU数
+        from usage_utils import usage_meter
+        gpu_seconds = 0.0
+        if self.engine:
+            gpu_seconds = usage_meter.leave(self.engine[0], self.engine_entered_at) * self.engine[1]
+        usage_meter.record(self.user_id, self.task_id, prompt_tokens, completion_tokens, gpu_seconds, ok)
+        return end_time - self.start_time
+
+class MetricsRegistry:
+    """所有推理任务的指标"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks: Dict[int, TaskMetrics] = {}
+
+    def _get(self, task_id: int, model: str) -> TaskMetrics:
+        metrics = self._tasks.get(task_id)
+        if metrics is None:
+            metrics = self._tasks[task_id] = TaskMetrics(task_id, model)
+        metrics.model = model or metrics.model
+        return metrics
+
+    def start(self, task_id: int, model: str, user_id: Optional[int] = None,
+              engine: Optional[Tuple[int, int, int]] = None) -> RequestTimer:
+        """开始一次请求的计时；user_id和engine（见usage_utils.task_engine）用于用量计量"""
+        with self._lock:
+            self._get(task_id, model).in_flight += 1
+        return RequestTimer(self, task_id, model, user_id, engine)
+
+    def _record(self, task_id: int, model: str, ok: bool, e2e: float, ttft: Optional[float],
+                inter_token: Optional[float], prompt_tokens: int, completion_tokens: int) -> None:
+        now = time.time()
+        with self._lock:
+            metrics = self._get(task_id, model)
+            metrics.in_flight = max(0, metrics.in_flight - 1)
+            metrics.counters["requests_total"] += 1
+            if not ok:
+                metrics.counters["errors_total"] += 1
+                metrics.window.append((now, "error", 1.0))
+                return
+            metrics.counters["prompt_tokens_total"] += prompt_tokens
+            metrics.counters["completion_tokens_total"] += completion_tokens
+            metrics.window.append((now, "completion_tokens", float(completion_tokens)))
+            metrics.observe("e2e_latency_seconds", e2e, now)
+            if ttft is not None:
+                metrics.observe("ttft_seconds", ttft, now)
+            if inter_token is not None:
+                metrics.observe("inter_token_latency_seconds", inter_token, now)
+
+    def record_queue_wait(self, task_id: int, model: str, seconds: float) -> None:
+        with self._lock:
+            self._get(task_id, model).observe("queue_wait_seconds", seconds, time.time())
+
+    def remove_task(self, task_id: int) -> None:
+        with self._lock:
+            self._tasks.pop(task_id, None)
+
+    def task_stats(self, task_id: int) -> Optional[Dict[str, Any]]:
+        """任务在滚动窗口内的请求速率、吞吐、错误率和延迟分位数，以及累计计数"""
+        now = time.time()
+        with self._lock:
+            metrics = self._tasks.get(task_id)
+            if metrics is None:
+                return None
+            metrics.trim(now)
+            samples: Dict[str, List[float]] = {}
+            for _, name, value in metrics.window:
+                samples.setdefault(name, []).append(value)
+            counters = dict(metrics.counters)
+            in_flight = metrics.in_flight
+            window_start = metrics.window[0][0] if metrics.window else now
+
+        span = max(min(METRICS_WINDOW, now - window_start), 1.0)
+        completed = len(samples.get("e2e_latency_seconds", []))
+        errors = len(samples.get("error", []))
+        latency = {}
+        for name in HISTOGRAMS:
+            values = samples.get(name, [])
+            latency[name] = {
+                "count": len(values),
+                "mean": round(sum(values) / len(values), 4) if values else None,
+                "p50": _percentile(values, 50),
+                "p90": _percentile(values, 90),
+                "p99": _percentile(values, 99)
+            }
+        return {
+            "task_id": task_id,
+            "window_seconds": METRICS_WINDOW,
+            "in_flight": in_flight,
+            "requests_per_second": round((completed + errors) / span, 3),
+            "completion_tokens_per_second": round(sum(samples.get("completion_tokens", [])) / span, 2),
+            "error_rate": round(errors / (completed + errors), 4) if completed + errors else 0.0,
+            "latency": latency,
+            "totals": counters
+        }
+
+    def all_task_stats(self, task_ids: Optional[List[int]] = None) -> Dict[int, Dict[str, Any]]:
+        with self._lock:
+            known = list(self._tasks)
+        return {
+            task_id: self.task_stats(task_id)
+            for task_id in known
+            if task_ids is None or task_id in task_ids
+        }
+
+    def render_prometheus(self, extra_gauges: Optional[Dict[str, Dict[int, float]]] = None) -> str:
+        """以Prometheus文本格式导出所有任务的累计指标
+
+        extra_gauges为外部提供的按任务的瞬时值，例如调度器的排队数。
+        """
+        lines: List[str] = []
+        with self._lock:
+            tasks = [(m.task_id, m.model, dict(m.counters), m.in_flight,
+                      {name: (h.buckets, list(h.counts), h.sum, h.count) for name, h in m.histograms.items()})
+                     for m in self._tasks.values()]
+
+        def labels(task_id: int, model: str, extra: str = "") -> str:
+            model = (model or "").replace("\\", "\\\\").replace('"', '\\"')
+            return f'{{task_id="{task_id}",model="{model}"{extra}}}'
+
+        models = {task_id: model for task_id, model, *_ in tasks}
+        for name, help_text in COUNTERS.items():
+            metric = f"modelverse_inference_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for task_id, model, counters, _, _ in tasks:
+                lines.append(f"{metric}{labels(task_id, model)} {counters[name]}")
+
+        metric = "modelverse_inference_in_flight"
+        lines.append(f"# HELP {metric} 进行中的请求数")
+        lines.append(f"# TYPE {metric} gauge")
+        for task_id, model, _, in_flight, _ in tasks:
+            lines.append(f"{metric}{labels(task_id, model)} {in_flight}")
+
+        for gauge_name, values in (extra_gauges or {}).items():
+            metric = f"modelverse_inference_{gauge_name}"
+            lines.append(f"# TYPE {metric} gauge")
+            for task_id, value in values.items():
+                lines.append(f"{metric}{labels(task_id, models.get(task_id, ''))} {value}")
+
+        for name, (help_text, _) in HISTOGRAMS.items():
+            metric = f"modelverse_inference_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for task_id, model, _, _, histograms in tasks:
+                buckets, counts, total, count = histograms[name]
+                for bound, bucket_count in zip(buckets, counts):
+                    bucket_labels = labels(task_id, model, ',le="%s"' % bound)
+                    lines.append(f"{metric}_bucket{bucket_labels} {bucket_count}")
+                inf_labels = labels(task_id, model, ',le="+Inf"')
+                lines.append(f"{metric}_bucket{inf_labels} {count}")
+                lines.append(f"{metric}_sum{labels(task_id, model)} {total}")
+                lines.append(f"{metric}_count{labels(task_id, model)} {count}")
+        return "\n".join(lines) + "\n"
+
+# 全局指标
+metrics_registry = MetricsRegistry()
@@ -185,6 +185,7 @@ class InferenceStatus(str, Enum):
     RUNNING = "RUNNING"    # 运行中
     STOPPED = "STOPPED"    # 已停止
     FAILED = "FAILED"      # 失败
+    IDLE = "IDLE"          # 空闲休眠（已释放GPU，收到请求时自动启动）
 
 class InferenceTask(BaseModel):
     """推理任务模型"""
@@ -197,6 +198,7 @@ class InferenceTask(BaseModel):
     api_base: Optional[str] = None
     process_id: Optional[int] = None
     gpu_memory: Optional[float] = None  # 显存占用（GB）
+    gpu_devices: Optional[str] = None  # 分配的GPU编号，逗号分隔，多副本时用分号分隔，如 "0,1;2,3"
     created_at: Optional[datetime] = None
     started_at: Optional[datetime] = None
     stopped_at: Optional[datetime] = None
@@ -211,6 +213,24 @@ class InferenceTask(BaseModel):
     max_model_len: int = 4096
     quantization: Optional[str] = None  # awq, gptq, None
     dtype: str = "auto"
+    gpu_memory_utilization: float = 0.85
+    engine_profile: str = "throughput"  # latency, throughput, low_memory
+    engine: str = "vllm"  # vllm：GPU上的vLLM；cpu：transformers CPU引擎（小模型）
+    replicas: int = 1  # vLLM副本数，每个副本占用独立的GPU设备组
+    idle_timeout: int = 0  # 空闲多少秒后自动停止并进入IDLE状态，0表示不自动停止
+    
+    # LoRA参数
+    enable_lora: bool = False  # 基础模型引擎是否开启多LoRA服务
+    max_loras: int = 10  # 同时驻留在GPU上的适配器数量
+    max_lora_rank: int = 16
+    base_task_id: Optional[int] = None  # 适配器任务挂载的基础模型推理任务
+    adapter_path: Optional[str] = None  # 适配器目录（包含adapter_config.json）
+    
+    # 确定性请求（温度接近0）的响应缓存，默认关闭
+    response_cache: bool = False
+    
+    # 同时进行的生成数上限，超出后按客户端公平排队；0表示按引擎批次大小自动设置
+    max_in_flight: int = 0
     
     # 推理参数
     max_tokens: int = 2048
@@ -236,6 +256,16 @@ class InferenceTaskCreate(BaseModel):
     max_model_len: Optional[int] = 4096
     quantization: Optional[str] = None
     dtype: Optional[str] = "auto"
+    engine_profile: Optional[str] = "throughput"
+    engine: Optional[str] = "vllm"
+    replicas: Optional[int] = 1
+    idle_timeout: Optional[int] = 0
+    enable_lora: Optional[bool] = False
+    max_loras: Optional[int] = 10
+    max_lora_rank: Optional[int] = 16
+    base_task_id: Optional[int] = None  # 指定时创建挂载到该基础模型引擎上的LoRA适配器任务
+    response_cache: Optional[bool] = False
+    max_in_flight: Optional[int] = 0
     max_tokens: Optional[int] = 2048
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
@@ -246,6 +276,15 @@ class InferenceTaskCreate(BaseModel):
     
     model_config = {'protected_namespaces': ()}
 
+class EngineSweepRequest(BaseModel):
+    """引擎配置扫描请求"""
+    prompts: Optional[List[Any]] = None  # 直接提供的提示列表
+    dataset_id: Optional[int] = None  # 或者使用已下载的数据集资源中的JSONL文件
+    profiles: Optional[List[str]] = None
+    concurrency: int = 8
+    max_tokens: int = 256
+    limit: Optional[int] = 200
+
 class InferenceTaskUpdate(BaseModel):
     """更新推理任务请求"""
     status: Optional[InferenceStatus] = None
@@ -253,12 +292,30 @@ class InferenceTaskUpdate(BaseModel):
     api_base: Optional[str] = None
     process_id: Optional[int] = None
     gpu_memory: Optional[float] = None
+    gpu_devices: Optional[str] = None
     started_at: Optional[datetime] = None
     stopped_at: Optional[datetime] = None
     error_message: Optional[str] = None
     share_enabled: Optional[bool] = None
     display_name: Optional[str] = None
     
+    # vLLM参数
+    tensor_parallel_size: Optional[int] = None
+    max_model_len: Optional[int] = None
+    quantization: Optional[str] = None
+    dtype: Optional[str] = None
+    gpu_memory_utilization: Optional[float] = None
+    engine_profile: Optional[str] = None
+    replicas: Optional[int] = None
+    idle_timeout: Optional[int] = None
+    enable_lora: Optional[bool] = None
+    max_loras: Optional[int] = None
+    max_lora_rank: Optional[int] = None
+    base_task_id: Optional[int] = None
+    adapter_path: Optional[str] = None
+    response_cache: Optional[bool] = None
+    max_in_flight: Optional[int] = None
+    
     # 推理参数
     max_tokens: Optional[int] = None
     temperature: Optional[float] = None
@@ -274,9 +331,13 @@ class Message(BaseModel):
     content: str
     
 class ChatRequest(BaseModel):
-    """聊天请求"""
+    """聊天请求
+
+    提供conversation_id时，messages只包含本轮的新消息，历史由服务端会话提供。
+    """
     messages: List[Message]
     task_id: int
+    conversation_id: Optional[str] = None
     temperature: Optional[float] = None
     top_p: Optional[float] = None
     max_tokens: Optional[int] = None
@@ -286,6 +347,26 @@ class ChatResponse(BaseModel):
     """聊天响应"""
     message: Message
     task_id: int
+    queue_wait: Optional[float] = None  # 排队等待秒数
+    generation_time: Optional[float] = None  # 生成耗时秒数
+    conversation_id: Optional[str] = None
+    
+class CompareRequest(BaseModel):
+    """多模型对比请求：同一组消息并发发送给多个推理任务"""
+    task_ids: List[int]
+    messages: List[Message]
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    max_tokens: Optional[int] = None
+    repetition_penalty: Optional[float] = None
+    deadline: Optional[float] = None  # 每个模型的截止秒数
+    stream: bool = True  # 以NDJSON逐行输出事件；False时等全部结束后返回汇总
+    
+class ConversationCreate(BaseModel):
+    """创建服务端会话"""
+    task_id: int
+    title: Optional[str] = None
+    messages: List[Message] = []  # 初始消息，例如系统提示
     
 class GPUInfo(BaseModel):
     """GPU信息"""
@@ -295,6 +376,37 @@ class GPUInfo(BaseModel):
     memory_used: float   # GB
     memory_free: float   # GB
 
+# 批量推理相关的数据模型
+class BatchJobStatus(str, Enum):
+    """批量推理任务状态"""
+    PENDING = "PENDING"      # 等待中
+    RUNNING = "RUNNING"      # 运行中
+    COMPLETED = "COMPLETED"  # 已完成
+    FAILED = "FAILED"        # 失败
+    STOPPED = "STOPPED"      # 已停止（可恢复）
+
+class BatchJob(BaseModel):
+    """批量推理任务：把JSONL中的对话请求逐条发送到推理任务，结果追加写入输出JSONL"""
+    id: int
+    name: str
+    task_id: int  # 目标推理任务
+    user_id: int
+    status: BatchJobStatus = BatchJobStatus.PENDING
+    concurrency: int = 32
+    input_path: str
+    output_path: str
+    total: int = 0
+    completed: int = 0  # 成功的请求数
+    failed: int = 0     # 失败的请求数（恢复时重试）
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+    error_message: Optional[str] = None
+    
+    model_config = {'from_attributes': True}
+
 # 评估相关的数据模型
 class EvaluationStatus(str, Enum):
     """评估任务状态"""
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+预热推理进程
+提前启动Python解释器并导入推理服务依赖的重型模块，然后在标准输入上等待启动参数。
+收到参数后设置环境变量和命令行参数，在本进程内运行vLLM的OpenAI API服务，省去冷启动时的解释器启动和模块导入时间。
+
+协议：
+    预热完成后向标准输出打印一行 PREWARM_READY
+    标准输入的第一行为JSON：{"module": "vllm.entrypoints.openai.api_server", "argv": [...], "env": {...}, "log_file": "..."}
+    提供log_file时先把标准输出和错误输出重定向到该文件，管理服务退出后引擎的输出不受影响
+"""
+
+import os
+import sys
+import json
+import runpy
+import importlib
+
+# 预先导入的模块；不初始化CUDA，分配GPU后再设置CUDA_VISIBLE_DEVICES仍然有效
+DEFAULT_PRELOAD_MODULES = "torch,transformers,fastapi,uvicorn"
+
+def preload_modules() -> None:
+    modules = os.environ.get("PREWARM_MODULES", DEFAULT_PRELOAD_MODULES)
+    for name in filter(None, (m.strip() for m in modules.split(","))):
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"预热导入模块失败: {name}, 错误: {str(e)}", file=sys.stderr, flush=True)
+
+def main() -> None:
+    preload_modules()
+    print("PREWARM_READY", flush=True)
+
+    line = sys.stdin.readline()
+    if not line:
+        # 进程池关闭时标准输入被关闭，直接退出
+        return
+    request = json.loads(line)
+
+    log_file = request.get("log_file")
+    if log_file:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        log_fd = os.open(log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.dup2(log_fd, 1)
+        os.dup2(log_fd, 2)
+        os.close(log_fd)
+
+    os.environ.update({key: str(value) for key, value in request.get("env", {}).items()})
+    module = request.get("module", "vllm.entrypoints.openai.api_server")
+    sys.argv = [module] + list(request.get("argv", []))
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+推理副本路由
+在同一推理任务的多个vLLM副本之间做最少未完成请求（least-outstanding-requests）负载均衡，
+连续失败或健康检查失败的副本会被暂时摘除，冷却后放回一个试探请求。
+多轮对话按会话粘滞到同一副本，使该副本上已缓存的对话前缀（prefix cache）能被复用
+"""
+
+import os
+import time
+import json
+import hashlib
+import asyncio
+import logging
+import threading
+import requests
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 路由配置
+REPLICA_FAILURE_THRESHOLD = int(os.environ.get("REPLICA_FAILURE_THRESHOLD", "3"))
+REPLICA_EJECT_SECONDS = float(os.environ.get("REPLICA_EJECT_SECONDS", "30"))
+REPLICA_HEALTH_INTERVAL = float(os.environ.get("REPLICA_HEALTH_INTERVAL", "10"))
+
+# 会话粘滞配置
+AFFINITY_TTL = float(os.environ.get("AFFINITY_TTL", "1800"))
+AFFINITY_MAX_SESSIONS = int(os.environ.get("AFFINITY_MAX_SESSIONS", "10000"))
+# 粘滞副本的未完成请求数比最空闲副本多出这么多时，放弃粘滞以免热点
+AFFINITY_MAX_IMBALANCE = int(os.environ.get("AFFINITY_MAX_IMBALANCE", "8"))
+
+def conversation_key(messages: List[Dict[str, Any]]) -> Optional[str]:
+    """根据对话开头的消息生成会话标识
+
+    客户端每轮都会重发完整历史，开头的系统提示和首条用户消息在整个对话中不变，
+    用它们的哈希作为会话标识，未显式提供会话ID的请求也能粘滞到同一副本。
+    """
+    head = []
+    for message in messages:
+        head.append({"role": message.get("role"), "content": message.get("content")})
+        if message.get("role") == "user":
+            break
+    if not head:
+        return None
+    digest = hashlib.sha1(json.dumps(head, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"auto:{digest[:16]}"
+
+def engine_task_id(task: Any) -> int:
+    """请求实际发往的引擎任务：LoRA适配器任务没有自己的进程，使用其基础模型任务的副本"""
+    return getattr(task, "base_task_id", None) or task.id
+
+class ReplicaRouter:
+    """推理副本路由表
+
+    每个副本记录端口、未完成请求数、连续失败次数和摘除截止时间。
+    draining状态的副本不再接收新请求，等未完成请求全部结束后再下线，保证缩容不中断请求。
+    """
+
+    def __init__(self, failure_threshold: int = REPLICA_FAILURE_THRESHOLD, eject_seconds: float = REPLICA_EJECT_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+        self._replicas: Dict[int, Dict[int, Dict[str, Any]]] = {}
+        # (任务ID, 会话标识) -> (副本编号, 最近使用时间)，按最近使用排序
+        self._affinity: "OrderedDict[Tuple[int, str], Tuple[int, float]]" = OrderedDict()
+
+    def register(self, task_id: int, replica: int, port: int) -> None:
+        """登记一个已就绪的副本"""
+        with self._lock:
+            self._replicas.setdefault(task_id, {})[replica] = {
+                "task_id": task_id,
+                "replica": replica,
+                "port": port,
+                "outstanding": 0,
+                "total_requests": 0,
+                "failed_requests": 0,
+                "consecutive_failures": 0,
+                "ejected_until": 0.0,
+                "probing": False,
+                "draining": False,
+                "affinity_hits": 0,
+                "affinity_misses": 0,
+                "registered_at": time.time()
+            }
+        logger.info(f"推理副本已加入路由: 任务={task_id}, 副本={replica}, 端口={port}")
+
+    def unregister(self, task_id: int, replica: int) -> None:
+        """从路由表中移除副本"""
+        with self._lock:
+            replicas = self._replicas.get(task_id, {})
+            removed = replicas.pop(replica, None)
+            if not replicas:
+                self._replicas.pop(task_id, None)
+            self._drop_affinity(lambda key, value: key[0] == task_id and value[0] == replica)
+        if removed:
+            logger.info(f"推理副本已移出路由: 任务={task_id}, 副本={replica}")
+
+    def remove_task(self, task_id: int) -> None:
+        """移除任务的全部副本"""
+        with self._lock:
+            self._replicas.pop(task_id, None)
+            self._drop_affinity(lambda key, value: key[0] == task_id)
+
+    def _drop_affinity(self, predicate) -> None:
+        """删除满足条件的会话粘滞记录（调用方持有锁）"""
+        for key in [k for k, v in self._affinity.items() if predicate(k, v)]:
+            del self._affinity[key]
+
+    def drain(self, task_id: int, replica: int) -> None:
+        """停止向副本分配新请求"""
+        with self._lock:
+            state = self._replicas.get(task_id, {}).get(replica)
+            if state:
+                state["draining"] = True
+
+    def has_replicas(self, task_id: int) -> bool:
+        with self._lock:
+            return bool(self._replicas.get(task_id))
+
+    def acquire(self, task_id: int, session_key: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """选择未完成请求最少的可用副本并占用一个请求名额
+
+        提供session_key时优先使用该会话上次所在的副本（只要它健康且负载没有明显偏高），
+        否则按最少未完成请求选择并记录新的粘滞关系。
+        没有登记副本时返回None，调用方回退到任务记录中的端口。
+        全部副本都被摘除时，仍选择摘除最早到期的副本，避免请求全部失败。
+        """
+        now = time.time()
+        with self._lock:
+            replicas = [s for s in self._replicas.get(task_id, {}).values() if not s["draining"]]
+            if not replicas:
+                return None
+
+            healthy = [s for s in replicas if s["ejected_until"] == 0]
+            # 冷却到期但仍处于摘除状态的副本只放行一个试探请求
+            half_open = [s for s in replicas if 0 < s["ejected_until"] <= now and not s["probing"]]
+            if healthy:
+                chosen = min(healthy, key=lambda s: (s["outstanding"], s["total_requests"]))
+                if session_key:
+                    chosen = self._apply_affinity(task_id, session_key, healthy, chosen, now)
+            elif half_open:
+                chosen = half_open[0]
+                chosen["probing"] = True
+            else:
+                chosen = min(replicas, key=lambda s: s["ejected_until"])
+
+            chosen["outstanding"] += 1
+            chosen["total_requests"] += 1
+            return {"task_id": task_id, "replica": chosen["replica"], "port": chosen["port"]}
+
+    def _apply_affinity(self, task_id: int, session_key: str, healthy: List[Dict[str, Any]],
+                        least_loaded: Dict[str, Any], now: float) -> Dict[str, Any]:
+        """按会话粘滞关系选择副本并刷新记录（调用方持有锁）"""
+        key = (task_id, session_key)
+        entry = self._affinity.get(key)
+        chosen = least_loaded
+        if entry and now - entry[1] <= AFFINITY_TTL:
+            sticky = next((s for s in healthy if s["replica"] == entry[0]), None)
+            if sticky and sticky["outstanding"] <= least_loaded["outstanding"] + AFFINITY_MAX_IMBALANCE:
+                chosen = sticky
+                chosen["affinity_hits"] += 1
+            else:
+                chosen["affinity_misses"] += 1
+        else:
+            chosen["affinity_misses"] += 1
+
+        self._affinity[key] = (chosen["replica"], now)
+        self._affinity.move_to_end(key)
+        while len(self._affinity) > AFFINITY_MAX_SESSIONS:
+            self._affinity.popitem(last=False)
+        return chosen
+
+    def release(self, handle: Optional[Dict[str, Any]], success: bool = True) -> None:
+        """请求结束后归还名额，并根据结果更新副本健康状态"""
+        if not handle:
+            return
+        with self._lock:
+            state = self._replicas.get(handle["task_id"], {}).get(handle["replica"])
+            if not state:
+                return
+            state["outstanding"] = max(0, state["outstanding"] - 1)
+            state["probing"] = False
+            if success:
+                if state["ejected_until"]:
+                    logger.info(f"推理副本恢复: 任务={handle['task_id']}, 副本={handle['replica']}")
+                state["consecutive_failures"] = 0
+                state["ejected_until"] = 0.0
+                return
+            state["failed_requests"] += 1
+            state["consecutive_failures"] += 1
+            if state["consecutive_failures"] >= self.failure_threshold:
+                state["ejected_until"] = time.time() + self.eject_seconds
+                logger.warning(f"推理副本连续失败 {state['consecutive_failures']} 次，暂时摘除: "
+                               f"任务={handle['task_id']}, 副本={handle['replica']}")
+
+    def set_health(self, task_id: int, replica: int, healthy: bool) -> None:
+        """根据主动健康检查的结果摘除或恢复副本"""
+        with self._lock:
+            state = self._replicas.get(task_id, {}).get(replica)
+            if not state:
+                return
+            if healthy:
+                # 冷却期结束且探测正常时恢复
+                if state["ejected_until"] and state["ejected_until"] <= time.time():
+                    state["ejected_until"] = 0.0
+                    state["consecutive_failures"] = 0
+                    logger.info(f"推理副本健康检查恢复: 任务={task_id}, 副本={replica}")
+            else:
+                if not state["ejected_until"]:
+                    logger.warning(f"推理副本健康检查失败，暂时摘除: 任务={task_id}, 副本={replica}")
+                state["ejected_until"] = time.time() + self.eject_seconds
+
+    def outstanding(self, task_id: int, replica: int) -> int:
+        with self._lock:
+            state = self._replicas.get(task_id, {}).get(replica)
+            return state["outstanding"] if state else 0
+
+    async def wait_drained(self, task_id: int, replica: int, timeout: float = 300.0) -> bool:
+        """等待副本上的未完成请求全部结束"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.outstanding(task_id, replica) == 0:
+                return True
+            await asyncio.sleep(0.5)
+        logger.warning(f"等待推理副本排空超时: 任务={task_id}, 副本={replica}, "
+                       f"未完成请求={self.outstanding(task_id, replica)}")
+        return False
+
+    def list(self, task_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """列出副本路由状态"""
+        now = time.time()
+        with self._lock:
+            task_ids = [task_id] if task_id is not None else list(self._replicas.keys())
+            result = []
+            for tid in task_ids:
+                for state in sorted(self._replicas.get(tid, {}).values(), key=lambda s: s["replica"]):
+                    item = dict(state)
+                    item["ejected"] = state["ejected_until"] > now
+                    result.append(item)
+            return result
+
+    async def health_check_once(self) -> None:
+        """探测所有副本的 /v1/models 接口"""
+        for state in self.list():
+            url = f"http://localhost:{state['port']}/v1/models"
+            try:
+                response = await asyncio.to_thread(requests.get, url, timeout=5)
+                healthy = response.status_code == 200
+            except Exception:
+                healthy = False
+            self.set_health(state["task_id"], state["replica"], healthy)
+
+    async def run_health_checks(self, interval: float = REPLICA_HEALTH_INTERVAL) -> None:
+        """后台健康检查循环"""
+        while True:
+            try:
+                await self.health_check_once()
+            except Exception as e:
+                logger.error(f"推理副本健康检查出错: {str(e)}")
+            await asyncio.sleep(interval)
+
+# 全局路由表
+replica_router = ReplicaRouter()
@@ -0,0 +1,191 @@
+"""
+推理请求准入控制
+每个推理引擎一个调度器（LoRA适配器与基础模型共用）：限制同时进行的生成数，超出时进入有界等待队列；
+队列按客户端（登录用户或匿名访问者）轮转出队，一个客户端的大量请求不会饿死其他客户端；
+队列已满、单个客户端排队过多或排队超时时立即拒绝，由调用方返回busy
+"""
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Dict, Any, Optional
+
+from models import InferenceTask
+import metrics_utils
+
+logger = logging.getLogger(__name__)
+
+# 调度配置
+SCHEDULER_MAX_QUEUE = int(os.environ.get("SCHEDULER_MAX_QUEUE", "64"))
+SCHEDULER_MAX_QUEUED_PER_CLIENT = int(os.environ.get("SCHEDULER_MAX_QUEUED_PER_CLIENT", "4"))
+SCHEDULER_QUEUE_TIMEOUT = float(os.environ.get("SCHEDULER_QUEUE_TIMEOUT", "120"))
+# 生成耗时的滑动平均系数，用于估算建议的重试时间
+GENERATION_EMA_ALPHA = 0.2
+
+class SchedulerBusy(Exception):
+    """请求未被接纳，携带建议的重试等待秒数"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = retry_after
+
+class TaskScheduler:
+    """单个推理任务的准入控制和按客户端轮转的公平排队"""
+
+    def __init__(self, task_id: int, max_in_flight: int,
+                 max_queue: int = SCHEDULER_MAX_QUEUE,
+                 max_queued_per_client: int = SCHEDULER_MAX_QUEUED_PER_CLIENT):
+        self.task_id = task_id
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max_queue
+        self.max_queued_per_client = max_queued_per_client
+        self.in_flight = 0
+        self.queued = 0
+        # 客户端 -> 等待中的请求；_order为有等待请求的客户端轮转顺序
+        self._queues: Dict[str, deque] = {}
+        self._order: deque = deque()
+        self.avg_generation_seconds = 0.0
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "timeouts": 0, "total_wait_seconds": 0.0}
+
+    def would_wait(self) -> bool:
+        """新请求是否需要排队"""
+        return self.in_flight >= self.max_in_flight or self.queued > 0
+
+    def _retry_after(self) -> float:
+        """按排队长度和平均生成耗时估算建议的重试时间"""
+        per_round = self.avg_generation_seconds or 5.0
+        return round(per_round * (self.queued / self.max_in_flight + 1), 1)
+
+    def _reject(self, message: str) -> SchedulerBusy:
+        self.stats["rejected"] += 1
+        return SchedulerBusy(message, self._retry_after())
+
+    def _discard(self, client_key: str, future: asyncio.Future) -> None:
+        """移除放弃等待的请求"""
+        queue = self._queues.get(client_key)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        self.queued -= 1
+        if not queue:
+            del self._queues[client_key]
+            self._order.remove(client_key)
+
+    def _dispatch(self) -> None:
+        """有空闲名额时按客户端轮转唤醒等待的请求"""
+        while self.in_flight < self.max_in_flight and self._order:
+            client_key = self._order.popleft()
+            queue = self._queues[client_key]
+            future = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self._order.append(client_key)
+            else:
+                del self._queues[client_key]
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(True)
+
+    async def acquire(self, client_key: str, timeout: float = SCHEDULER_QUEUE_TIMEOUT) -> float:
+        """获取一个生成名额，返回排队等待的秒数；不能接纳时抛出SchedulerBusy"""
+        if not self.would_wait():
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            metrics_utils.metrics_registry.record_queue_wait(self.task_id, "", 0.0)
+            return 0.0
+
+        if self.queued >= self.max_queue:
+            raise self._reject("当前请求过多，请稍后再试")
+        queue = self._queues.get(client_key)
+        if queue is not None and len(queue) >= self.max_queued_per_client:
+            raise self._reject("您已有多个请求在排队，请等待之前的请求完成")
+
+        future = asyncio.get_running_loop().create_future()
+        if queue is None:
+            queue = self._queues[client_key] = deque()
+            self._order.append(client_key)
+        queue.append(future)
+        self.queued += 1
+        self.stats["queued"] += 1
+
+        start_time = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            self._discard(client_key, future)
+            self.stats["timeouts"] += 1
+            raise self._reject(f"排队超过 {timeout:.0f} 秒，请稍后再试")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分配到名额但调用方放弃了，归还名额
+                self.release()
+            else:
+                self._discard(client_key, future)
+            raise
+        wait_seconds = time.monotonic() - start_time
+        self.stats["admitted"] += 1
+        self.stats["total_wait_seconds"] += wait_seconds
+        metrics_utils.metrics_registry.record_queue_wait(self.task_id, "", wait_seconds)
+        return wait_seconds
+
+    def release(self, generation_seconds: Optional[float] = None) -> None:
+        """归还名额并记录生成耗时"""
+        self.in_flight = max(0, self.in_flight - 1)
+        if generation_seconds is not None:
+            if self.avg_generation_seconds:
+                self.avg_generation_seconds += GENERATION_EMA_ALPHA * (generation_seconds - self.avg_generation_seconds)
+            else:
+                self.avg_generation_seconds = generation_seconds
+        self._dispatch()
+
+    def status(self) -> Dict[str, Any]:
+        admitted = self.stats["admitted"]
+        return {
+            "task_id": self.task_id,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "max_queued_per_client": self.max_queued_per_client,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "queued_clients": len(self._queues),
+            "avg_generation_seconds": round(self.avg_generation_seconds, 3),
+            "avg_queue_wait_seconds": round(self.stats["total_wait_seconds"] / admitted, 3) if admitted else 0.0,
+            **{key: round(value, 3) if isinstance(value, float) else value for key, value in self.stats.items()}
+        }
+
+# 任务ID -> 调度器
+_schedulers: Dict[int, TaskScheduler] = {}
+
+def default_max_in_flight(task: InferenceTask) -> int:
+    """默认并发上限：引擎一个批次能容纳的序列数（引擎配置的max_num_seqs × 副本数）"""
+    import inference_utils
+
+    profile = inference_utils.get_engine_profile(task.engine_profile)
+    return profile["max_num_seqs"] * max(1, task.replicas or 1)
+
+def get_scheduler(task: InferenceTask) -> TaskScheduler:
+    """获取任务的调度器，任务的并发上限设置变化时立即生效
+
+    LoRA适配器任务和基础模型共用同一个引擎，因此共用基础模型任务的调度器和并发上限，
+    否则N个适配器会得到N倍的引擎并发。
+    """
+    if task.base_task_id:
+        from database import get_inference_task
+
+        task = get_inference_task(task_id=task.base_task_id) or task
+    max_in_flight = task.max_in_flight or default_max_in_flight(task)
+    scheduler = _schedulers.get(task.id)
+    if scheduler is None:
+        scheduler = _schedulers[task.id] = TaskScheduler(task.id, max_in_flight)
+    elif scheduler.max_in_flight != max_in_flight:
+        logger.info(f"推理任务 {task.id} 并发上限调整: {scheduler.max_in_flight} -> {max_in_flight}")
+        scheduler.max_in_flight = max(1, max_in_flight)
+        scheduler._dispatch()
+    return scheduler
+
+def list_schedulers() -> Dict[int, Dict[str, Any]]:
+    return {task_id: scheduler.status() for task_id, scheduler in _schedulers.items()}
@@ -0,0 +1,216 @@
+"""
+推理服务启动耗时分析
+每次启动副本时记录各阶段的时间点：端口分配、GPU放置、进程启动、引擎初始化、权重加载、
+KV缓存分析、CUDA图捕获、API服务启动和健康检查就绪。引擎内部的阶段通过跟踪引擎日志中的标志行识别。
+启动记录按任务保存，并可按模型汇总，用于判断模型是否需要转换权重格式、开启预热或调整引擎参数
+"""
+
+import os
+import time
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, Any, Optional, List
+
+logger = logging.getLogger(__name__)
+
+# 启动阶段的时间点，按发生顺序排列：(时间点, 以该时间点结束的阶段名, 阶段说明)
+MILESTONES = [
+    ("port_allocated", "port_allocation", "端口分配"),
+    ("gpu_placed", "gpu_placement", "GPU放置"),
+    ("process_spawned", "process_spawn", "进程启动"),
+    ("weights_loading", "engine_init", "引擎初始化"),
+    ("weights_loaded", "weight_loading", "权重加载"),
+    ("kv_cache_profiled", "kv_cache_profiling", "KV缓存分析"),
+    ("cuda_graph_captured", "cuda_graph_capture", "CUDA图捕获"),
+    ("server_started", "api_server_start", "API服务启动"),
+    ("http_ready", "http_ready", "健康检查就绪"),
+]
+PHASE_LABELS = {phase: label for _, phase, label in MILESTONES}
+
+# 引擎日志中标志各时间点的文本（兼容不同版本的vLLM和CPU引擎）
+LOG_MARKERS = {
+    "weights_loading": ("Starting to load model", "Loading model weights", "checkpoint shards", "开始加载模型权重"),
+    "weights_loaded": ("Loading weights took", "Model loading took", "model weights took", "模型权重加载完成"),
+    "kv_cache_profiled": ("# GPU blocks", "# cuda blocks", "Available KV cache memory",
+                          "Memory profiling takes", "GPU KV cache size"),
+    "cuda_graph_captured": ("Graph capturing finished",),
+    "server_started": ("Uvicorn running on", "Application startup complete"),
+}
+
+# 汇总建议的阈值（秒）
+SLOW_WEIGHT_LOADING_GBPS = float(os.environ.get("STARTUP_SLOW_LOADING_GBPS", "1.0"))
+SLOW_ENGINE_INIT_SECONDS = float(os.environ.get("STARTUP_SLOW_ENGINE_INIT", "20"))
+SLOW_CUDA_GRAPH_SECONDS = float(os.environ.get("STARTUP_SLOW_CUDA_GRAPH", "30"))
+
+def weight_files_info(model_dir: Optional[Path]) -> Dict[str, Any]:
+    """统计模型目录中的权重文件格式和大小"""
+    info = {"weight_format": None, "weight_gb": 0.0}
+    if model_dir is None or not model_dir.is_dir():
+        return info
+    formats = {}
+    for pattern, name in (("*.safetensors", "safetensors"), ("*.bin", "bin"), ("*.pt", "pt"), ("*.gguf", "gguf")):
+        files = list(model_dir.glob(pattern))
+        if files:
+            formats[name] = sum(f.stat().st_size for f in files)
+    if formats:
+        # vLLM优先加载safetensors
+        info["weight_format"] = "safetensors" if "safetensors" in formats else max(formats, key=formats.get)
+        info["weight_gb"] = round(formats[info["weight_format"]] / 1024 ** 3, 2)
+    return info
+
+class StartupTimeline:
+    """一次副本启动的时间线"""
+
+    def __init__(self, task_id: int, replica: int, model_id: Optional[int] = None):
+        self.task_id = task_id
+        self.replica = replica
+        self.model_id = model_id
+        self.started_at = time.time()
+        self.marks: Dict[str, float] = {}
+        self.prewarmed = False
+        self.engine: Dict[str, Any] = {}
+        self._server_up = asyncio.Event()
+        self._server_notified = False
+        self._watcher: Optional[asyncio.Task] = None
+
+    def mark(self, milestone: str, at: Optional[float] = None) -> None:
+        """记录时间点（只记录第一次）"""
+        if milestone not in self.marks:
+            self.marks[milestone] = at or time.time()
+            if milestone == "server_started":
+                self._server_up.set()
+
+    def feed_line(self, line: str) -> None:
+        for milestone, markers in LOG_MARKERS.items():
+            if milestone not in self.marks and any(marker in line for marker in markers):
+                self.mark(milestone)
+
+    def watch_log(self, log_file: Path, poll_interval: float = 0.25) -> None:
+        """跟踪引擎日志，识别引擎内部的启动阶段"""
+        async def run():
+            position = 0
+            pending = b""
+            while "server_started" not in self.marks:
+                try:
+                    with open(log_file, "rb") as f:
+                        f.seek(position)
+                        data = f.read()
+                        position = f.tell()
+                except FileNotFoundError:
+                    data = b""
+                if data:
+                    *lines, pending = (pending + data).split(b"\n")
+                    for line in lines:
+                        self.feed_line(line.decode("utf-8", errors="replace"))
+                await asyncio.sleep(poll_interval)
+
+        self._watcher = asyncio.create_task(run())
+
+    async def wait(self, timeout: float) -> None:
+        """等待下一次健康检查：引擎日志显示API服务已启动时立即返回一次"""
+        if self._server_notified:
+            await asyncio.sleep(timeout)
+            return
+        try:
+            await asyncio.wait_for(self._server_up.wait(), timeout=timeout)
+            self._server_notified = True
+        except asyncio.TimeoutError:
+            pass
+
+    def phases(self) -> List[Dict[str, Any]]:
+        """由时间点推导各阶段耗时；日志中没有出现的时间点并入下一个阶段"""
+        result = []
+        previous = self.started_at
+        for milestone, phase, _ in MILESTONES:
+            at = self.marks.get(milestone)
+            if at is None:
+                continue
+            at = max(at, previous)
+            result.append({
+                "phase": phase,
+                "start": round(previous - self.started_at, 3),
+                "end": round(at - self.started_at, 3),
+                "seconds": round(at - previous, 3)
+            })
+            previous = at
+        return result
+
+    def finish(self, success: bool, error: Optional[str] = None) -> Dict[str, Any]:
+        """结束记录并保存到数据库"""
+        from database import create_inference_startup
+
+        if self._watcher:
+            self._watcher.cancel()
+        total = time.time() - self.started_at
+        phases = self.phases()
+        summary = ", ".join(f"{PHASE_LABELS[p['phase']]}={p['seconds']:.1f}s" for p in phases)
+        logger.info(f"推理副本启动{'完成' if success else '失败'}: 任务={self.task_id}, 副本={self.replica}, "
+                    f"总耗时={total:.1f}s, {summary}")
+        record = {
+            "task_id": self.task_id,
+            "model_id": self.model_id,
+            "replica": self.replica,
+            "success": success,
+            "prewarmed": self.prewarmed,
+            "total_seconds": round(total, 3),
+            "phases": phases,
+            "engine": self.engine,
+            "error_message": error[:1000] if error else None
+        }
+        try:
+            create_inference_startup(**record)
+        except Exception as e:
+            logger.error(f"保存启动记录失败: {str(e)}")
+        return record
+
+def _mean(values: List[float]) -> Optional[float]:
+    return round(sum(values) / len(values), 2) if values else None
+
+def aggregate_by_model(startups: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """按模型汇总启动记录：成功率、各阶段平均耗时、权重加载速度，以及调优建议"""
+    by_model: Dict[Any, List[Dict[str, Any]]] = {}
+    for startup in startups:
+        by_model.setdefault(startup.get("model_id"), []).append(startup)
+
+    result = []
+    for model_id, records in by_model.items():
+        succeeded = [r for r in records if r["success"]]
+        phase_seconds: Dict[str, List[float]] = {}
+        for record in succeeded:
+            for phase in record["phases"]:
+                phase_seconds.setdefault(phase["phase"], []).append(phase["seconds"])
+        phases = {phase: _mean(values) for phase, values in phase_seconds.items()}
+        latest_engine = records[0].get("engine") or {}
+        weight_gb = latest_engine.get("weight_gb") or 0.0
+        loading = phases.get("weight_loading")
+        loading_gbps = round(weight_gb / loading, 2) if weight_gb and loading else None
+
+        hints = []
+        if loading_gbps is not None and loading_gbps < SLOW_WEIGHT_LOADING_GBPS:
+            if latest_engine.get("weight_format") not in (None, "safetensors"):
+                hints.append(f"权重为{latest_engine['weight_format']}格式，加载速度 {loading_gbps} GB/s，建议转换为safetensors")
+            else:
+                hints.append(f"权重加载速度 {loading_gbps} GB/s，建议把模型放在更快的本地磁盘上")
+        cold_init = [p["seconds"] for r in succeeded if not r["prewarmed"]
+                     for p in r["phases"] if p["phase"] == "engine_init"]
+        if cold_init and _mean(cold_init) > SLOW_ENGINE_INIT_SECONDS:
+            hints.append(f"未使用预热进程时引擎初始化平均 {_mean(cold_init)} 秒，建议开启或增大预热进程池")
+        graph = phases.get("cuda_graph_capture")
+        if graph is not None and graph > SLOW_CUDA_GRAPH_SECONDS:
+            hints.append(f"CUDA图捕获平均 {graph} 秒，如果启动速度比单步延迟更重要，可改用low_memory引擎配置（禁用CUDA图）")
+
+        result.append({
+            "model_id": model_id,
+            "attempts": len(records),
+            "successes": len(succeeded),
+            "prewarmed": len([r for r in records if r["prewarmed"]]),
+            "avg_total_seconds": _mean([r["total_seconds"] for r in succeeded]),
+            "phases": phases,
+            "weight_format": latest_engine.get("weight_format"),
+            "weight_gb": weight_gb or None,
+            "weight_loading_gbps": loading_gbps,
+            "hints": hints
+        })
+    result.sort(key=lambda item: item["avg_total_seconds"] or 0, reverse=True)
+    return result
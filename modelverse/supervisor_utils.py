@@ -0,0 +1,256 @@
+"""
+推理引擎进程监督
+定期检查每个已就绪的vLLM副本：进程退出或连续多次健康检查失败时视为崩溃，
+按指数退避重新启动该副本；同一副本在时间窗口内崩溃次数过多时打开熔断，停止自动重启。
+引擎重启期间的请求立即返回“正在重启”，而不是等待连接超时
+"""
+
+import os
+import time
+import asyncio
+import logging
+import requests
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Tuple
+
+from models import InferenceStatus
+from database import get_inference_task, update_inference_task
+
+logger = logging.getLogger(__name__)
+
+# 监督配置
+SUPERVISOR_INTERVAL = float(os.environ.get("SUPERVISOR_INTERVAL", "5"))
+SUPERVISOR_HEALTH_FAILURES = int(os.environ.get("SUPERVISOR_HEALTH_FAILURES", "6"))
+SUPERVISOR_BACKOFF_BASE = float(os.environ.get("SUPERVISOR_BACKOFF_BASE", "5"))
+SUPERVISOR_BACKOFF_MAX = float(os.environ.get("SUPERVISOR_BACKOFF_MAX", "300"))
+SUPERVISOR_MAX_CRASHES = int(os.environ.get("SUPERVISOR_MAX_CRASHES", "5"))
+SUPERVISOR_CRASH_WINDOW = float(os.environ.get("SUPERVISOR_CRASH_WINDOW", "1800"))
+# 重启成功后稳定运行这么久，退避次数清零
+SUPERVISOR_STABLE_SECONDS = float(os.environ.get("SUPERVISOR_STABLE_SECONDS", "600"))
+
+# 副本监督状态
+STATE_RESTARTING = "restarting"
+STATE_OPEN = "open"
+
+class EngineSupervisor:
+    """推理副本的崩溃检测、退避重启和熔断"""
+
+    def __init__(self):
+        # (任务ID, 副本编号) -> 监督状态
+        self._replicas: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        # (任务ID, 副本编号) -> 连续健康检查失败次数
+        self._health_failures: Dict[Tuple[int, int], int] = {}
+        # (任务ID, 副本编号) -> 等待中的重启
+        self._restarts: Dict[Tuple[int, int], asyncio.Task] = {}
+
+    def _state(self, task_id: int, replica: int) -> Dict[str, Any]:
+        return self._replicas.setdefault((task_id, replica), {
+            "task_id": task_id,
+            "replica": replica,
+            "state": None,
+            "crashes": [],
+            "attempts": 0,
+            "restarts": 0,
+            "next_restart_at": None,
+            "last_error": None,
+            "recovered_at": None
+        })
+
+    def forget(self, task_id: int) -> None:
+        """任务被手动停止或重新启动时清除监督状态并取消等待中的重启（熔断随之复位）"""
+        for key in [k for k in self._replicas if k[0] == task_id]:
+            self._replicas.pop(key, None)
+            self._health_failures.pop(key, None)
+            restart = self._restarts.pop(key, None)
+            if restart and restart is not asyncio.current_task():
+                restart.cancel()
+
+    def restart_status(self, task_id: int) -> Optional[Dict[str, Any]]:
+        """任务当前没有可用副本且正在重启时，返回预计恢复的秒数；熔断打开时返回熔断状态"""
+        states = [s for (tid, _), s in self._replicas.items() if tid == task_id and s["state"]]
+        if not states:
+            return None
+        pending = [s["next_restart_at"] for s in states if s["state"] == STATE_RESTARTING and s["next_restart_at"]]
+        if pending:
+            return {"state": STATE_RESTARTING, "retry_after": max(1.0, min(pending) - time.time())}
+        if any(s["state"] == STATE_RESTARTING for s in states):
+            # 副本正在启动中，按最短退避时间估算
+            return {"state": STATE_RESTARTING, "retry_after": SUPERVISOR_BACKOFF_BASE}
+        return {"state": STATE_OPEN, "retry_after": None}
+
+    def unavailable(self, task_id: int) -> Optional[Dict[str, Any]]:
+        """任务的引擎没有可路由的副本且正在重启或已熔断时，返回提示信息和建议的重试秒数"""
+        import routing_utils
+
+        if routing_utils.replica_router.has_replicas(task_id):
+            return None
+        status = self.restart_status(task_id)
+        if status is None:
+            return None
+        if status["state"] == STATE_RESTARTING:
+            retry_after = int(status["retry_after"]) + 1
+            return {"message": f"推理引擎正在重启，预计 {retry_after} 秒后恢复", "retry_after": retry_after}
+        return {"message": "推理引擎反复崩溃，已停止自动重启", "retry_after": None}
+
+    def status(self, task_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        now = time.time()
+        result = []
+        for (tid, _), state in sorted(self._replicas.items()):
+            if task_id is not None and tid != task_id:
+                continue
+            item = dict(state)
+            item["recent_crashes"] = len([t for t in state["crashes"] if now - t <= SUPERVISOR_CRASH_WINDOW])
+            item["crashes"] = len(state["crashes"])
+            item["health_failures"] = self._health_failures.get((tid, state["replica"]), 0)
+            if state["next_restart_at"]:
+                item["restart_in"] = round(max(0.0, state["next_restart_at"] - now), 1)
+            result.append(item)
+        return result
+
+    def _backoff(self, attempts: int) -> float:
+        return min(SUPERVISOR_BACKOFF_MAX, SUPERVISOR_BACKOFF_BASE * (2 ** max(0, attempts - 1)))
+
+    async def handle_crash(self, process_info: Dict[str, Any], reason: str) -> None:
+        """记录副本崩溃，释放它占用的资源，然后安排重启或打开熔断"""
+        import inference_utils
+
+        if process_info.get("crashed"):
+            return
+        process_info["crashed"] = True
+        task_id = process_info["task_id"]
+        replica = process_info.get("replica", 0)
+        key = (task_id, replica)
+        logger.warning(f"推理副本崩溃: 任务={task_id}, 副本={replica}, 原因={reason}")
+        if process_info["process"].returncode is None:
+            await inference_utils._stop_replica(process_info)
+        else:
+            inference_utils._release_replica(process_info)
+        self._health_failures.pop(key, None)
+        self._schedule_restart(task_id, replica, reason)
+        self._update_task_after_crash(task_id)
+
+    def _schedule_restart(self, task_id: int, replica: int, reason: str) -> None:
+        now = time.time()
+        state = self._state(task_id, replica)
+        state["crashes"] = [t for t in state["crashes"] if now - t <= SUPERVISOR_CRASH_WINDOW] + [now]
+        state["last_error"] = reason
+        if state["recovered_at"] and now - state["recovered_at"] >= SUPERVISOR_STABLE_SECONDS:
+            state["attempts"] = 0
+        state["recovered_at"] = None
+
+        if len(state["crashes"]) >= SUPERVISOR_MAX_CRASHES:
+            state["state"] = STATE_OPEN
+            state["next_restart_at"] = None
+            logger.error(f"推理副本在 {SUPERVISOR_CRASH_WINDOW:.0f} 秒内崩溃 {len(state['crashes'])} 次，"
+                         f"打开熔断，停止自动重启: 任务={task_id}, 副本={replica}")
+            return
+
+        state["attempts"] += 1
+        delay = self._backoff(state["attempts"])
+        state["state"] = STATE_RESTARTING
+        state["next_restart_at"] = now + delay
+        logger.info(f"推理副本将在 {delay:.0f} 秒后重启: 任务={task_id}, 副本={replica}, 第 {state['attempts']} 次尝试")
+        self._restarts[(task_id, replica)] = asyncio.create_task(self._restart_later(task_id, replica, delay))
+
+    def _update_task_after_crash(self, task_id: int) -> None:
+        """副本全部不可用时更新任务记录：有副本等待重启时保持RUNNING并记录原因，熔断打开时标记FAILED"""
+        import inference_utils
+        import routing_utils
+
+        if inference_utils.get_task_processes(task_id):
+            inference_utils._sync_task_replicas(task_id)
+            return
+        status = self.restart_status(task_id)
+        if status and status["state"] == STATE_RESTARTING:
+            update_inference_task(task_id=task_id, error_message="推理引擎意外退出，正在自动重启")
+            return
+        crashes = max((s["crashes"] for s in self.status(task_id)), default=0)
+        update_inference_task(
+            task_id=task_id,
+            status=InferenceStatus.FAILED,
+            stopped_at=datetime.now(),
+            error_message=f"推理引擎反复崩溃（{crashes} 次），已停止自动重启，请检查日志后手动启动"
+        )
+        routing_utils.replica_router.remove_task(task_id)
+        inference_utils.release_task_resources(task_id)
+        inference_utils._stop_dependent_adapters(task_id)
+
+    async def _restart_later(self, task_id: int, replica: int, delay: float) -> None:
+        import inference_utils
+
+        key = (task_id, replica)
+        try:
+            await asyncio.sleep(delay)
+            task = get_inference_task(task_id=task_id)
+            if not task or task.status != InferenceStatus.RUNNING:
+                self.forget(task_id)
+                return
+            state = self._state(task_id, replica)
+            state["next_restart_at"] = None
+            lock = inference_utils._scale_locks.setdefault(task_id, asyncio.Lock())
+            async with lock:
+                if any(p.get("replica", 0) == replica for p in inference_utils.get_task_processes(task_id)):
+                    # 副本已被扩缩容重新创建
+                    state["state"] = None
+                    return
+                model_path = inference_utils.get_model_path(task.model_id)
+                logger.info(f"重启推理副本: 任务={task_id}, 副本={replica}")
+                info, error = await inference_utils._launch_replica(task_id, model_path, replica)
+            self._restarts.pop(key, None)
+            if info:
+                state["state"] = None
+                state["restarts"] += 1
+                state["recovered_at"] = time.time()
+                state["last_error"] = None
+                inference_utils._sync_task_replicas(task_id)
+                update_inference_task(task_id=task_id, clear=["error_message"])
+                logger.info(f"推理副本重启成功: 任务={task_id}, 副本={replica}")
+            else:
+                self._schedule_restart(task_id, replica, (error or "重启失败")[:500])
+                self._update_task_after_crash(task_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"重启推理副本出错: 任务={task_id}, 副本={replica}, 错误={str(e)}")
+            self._restarts.pop(key, None)
+            self._schedule_restart(task_id, replica, str(e))
+            self._update_task_after_crash(task_id)
+
+    def _probe(self, port: int) -> bool:
+        try:
+            return requests.get(f"http://localhost:{port}/v1/models", timeout=5).status_code == 200
+        except Exception:
+            return False
+
+    async def check_once(self) -> None:
+        """检查所有已就绪副本的进程退出状态和健康状态"""
+        import inference_utils
+
+        for process_info in list(inference_utils.active_processes):
+            # 启动中的副本由启动流程检查，正在停止的副本不算崩溃
+            if not process_info.get("ready") or process_info.get("stopping"):
+                continue
+            key = (process_info["task_id"], process_info.get("replica", 0))
+            returncode = process_info["process"].returncode
+            if returncode is not None:
+                await self.handle_crash(process_info, f"进程退出，退出码={returncode}")
+                continue
+            if await asyncio.to_thread(self._probe, process_info["port"]):
+                self._health_failures.pop(key, None)
+                continue
+            failures = self._health_failures.get(key, 0) + 1
+            self._health_failures[key] = failures
+            if failures >= SUPERVISOR_HEALTH_FAILURES:
+                await self.handle_crash(process_info, f"连续 {failures} 次健康检查失败")
+
+    async def run(self, interval: float = SUPERVISOR_INTERVAL) -> None:
+        """后台监督循环"""
+        while True:
+            try:
+                await self.check_once()
+            except Exception as e:
+                logger.error(f"推理引擎监督检查出错: {str(e)}")
+            await asyncio.sleep(interval)
+
+# 全局监督器
+engine_supervisor = EngineSupervisor()
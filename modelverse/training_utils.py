@@ -17,6 +17,7 @@ import logging
 from models import TrainingTask, TrainingStatus, Resource, ResourceType, DownloadStatus, ResourceCreate
 from database import update_training_task, add_training_log, get_resource, create_resource, update_resource_status, clear_training_logs, save_db, get_training_task
 from fastapi import WebSocket
+import gpu_utils
 import time
 
 logger = logging.getLogger(__name__)
@@ -298,6 +299,49 @@ def generate_training_config(task: TrainingTask) -> str:
     
     return str(config_path)
 
+def training_gpu_count(task: TrainingTask, total_gpus: int) -> int:
+    """训练使用的GPU数：config_params中的num_gpus，未指定时使用全部GPU（与不固定设备时一致）"""
+    requested = (task.config_params or {}).get("num_gpus")
+    if not requested:
+        return total_gpus
+    return max(1, min(int(requested), total_gpus))
+
+def estimate_training_memory(task: TrainingTask, config_path: str, num_gpus: int = 1) -> Optional[float]:
+    """估算训练任务单卡显存需求（GB）
+    
+    全参数训练按每参数16字节计（bf16权重和梯度 + fp32主权重和Adam状态），
+    LoRA训练只计bf16权重，另加按批大小和序列长度估算的激活。
+    开启FSDP时权重和优化器状态按num_gpus分片。
+    """
+    import inference_utils
+    
+    model_resource = get_resource(resource_id=task.base_model_id)
+    if not model_resource or not model_resource.local_path:
+        return None
+    try:
+        profile = inference_utils.load_model_profile(model_resource.local_path)
+    except Exception as e:
+        logger.warning(f"读取模型结构失败，跳过训练显存预留: {str(e)}")
+        return None
+    if not profile:
+        return None
+    
+    try:
+        with open(config_path, "r") as f:
+            config = yaml.safe_load(f) or {}
+    except Exception:
+        config = {}
+    training_config = config.get("training", {})
+    batch_size = training_config.get("per_device_train_batch_size", 4)
+    seq_len = config.get("model", {}).get("model_max_length", 2048)
+    
+    bytes_per_param = 2 if training_config.get("use_peft") else 16
+    weights = profile["param_count"] * bytes_per_param
+    if (config.get("fsdp") or {}).get("enable_fsdp"):
+        weights /= max(1, num_gpus)
+    activations = batch_size * seq_len * profile["hidden_size"] * profile["num_layers"] * 2 * 8
+    return (weights + activations) / (1024 ** 3) + 1.0
+
 async def broadcast_log(task_id: int, message: str, level: str = "INFO"):
     """向连接的WebSocket客户端广播日志消息"""
     # 记录到数据库
@@ -452,6 +496,32 @@ async def run_training(task_id: int):
         })
         await broadcast_log(task_id, f"设置环境变量: NCCL_P2P_DISABLE=1, NCCL_IB_DISABLE=1")
         
+        # 预留训练所需显存，并把训练进程固定到预留的GPU上
+        snapshot = gpu_utils.get_gpu_snapshot()
+        num_gpus = training_gpu_count(task, len(snapshot["gpus"])) if snapshot["available"] else 0
+        required_memory = estimate_training_memory(task, config_path, num_gpus) if num_gpus else None
+        reserved_devices = None
+        if required_memory:
+            reserved_devices = gpu_utils.gpu_ledger.reserve_placement(
+                f"training:{task_id}", "training", required_memory, num_gpus, snapshot["gpus"]
+            )
+            if not reserved_devices:
+                error_msg = f"GPU显存不足: 需要 {num_gpus} 张GPU，每张空闲 {required_memory:.1f}GB（已扣除其他任务的预留）"
+                logger.error(error_msg)
+                await broadcast_log(task_id, error_msg, "ERROR")
+                update_training_task(
+                    task_id=task_id,
+                    status=TrainingStatus.FAILED,
+                    completed_at=datetime.now(),
+                    error_message=error_msg
+                )
+                return
+        if reserved_devices:
+            env["CUDA_VISIBLE_DEVICES"] = ",".join(str(d) for d in reserved_devices)
+            # 与nvidia-smi的GPU编号保持一致
+            env["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+            await broadcast_log(task_id, f"已预留显存: GPU {reserved_devices}, 约 {required_memory:.1f}GB")
+        
         # 启动训练进程
         await broadcast_log(task_id, f"正在启动训练进程...")
         
@@ -463,6 +533,7 @@ async def run_training(task_id: int):
                 env=env  # 使用更新后的环境变量
             )
             await broadcast_log(task_id, f"进程已启动，PID: {process.pid}")
+            gpu_utils.gpu_ledger.attach_pid(f"training:{task_id}", process.pid)
         except Exception as e:
             error_msg = f"启动进程失败: {str(e)}"
             logger.error(error_msg)
@@ -589,6 +660,10 @@ async def run_training(task_id: int):
         )
         
         await broadcast_log(task_id, f"训练出错: {error_message}", "ERROR")
+    
+    finally:
+        # 训练结束后释放显存预留
+        gpu_utils.gpu_ledger.release(f"training:{task_id}")
 
 async def stop_training(task_id: int):
     """停止训练任务"""
@@ -673,18 +748,15 @@ def remove_websocket(task_id: Any, websocket: WebSocket):
         logger.info(f"WebSocket连接已移除: {task_id_str}")
 
 def get_gpu_info() -> Dict[str, Any]:
-    """获取GPU信息"""
+    """获取GPU信息（第一块GPU，显存单位MB），数据来自后台采样器快照"""
     try:
-        # 使用nvidia-smi命令获取GPU信息
-        result = subprocess.run(['nvidia-smi', '--query-gpu=gpu_name,memory.total,memory.free', '--format=csv,noheader,nounits'], 
-                              capture_output=True, text=True)
-        if result.returncode == 0:
-            # 解析输出
-            gpu_info = result.stdout.strip().split('\n')[0].split(',')
+        snapshot = gpu_utils.get_gpu_snapshot()
+        if snapshot["available"] and snapshot["gpus"]:
+            gpu = snapshot["gpus"][0]
             return {
-                'name': gpu_info[0].strip(),
-                'total_memory': int(gpu_info[1].strip()),
-                'free_memory': int(gpu_info[2].strip())
+                'name': gpu["name"],
+                'total_memory': int(gpu["memory_total"] * 1024),
+                'free_memory': int(gpu["memory_free"] * 1024)
             }
     except Exception as e:
         logger.error(f"获取GPU信息失败: {str(e)}")
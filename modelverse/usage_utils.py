@@ -0,0 +1,215 @@
+"""
+token用量计量
+每个推理请求结束时在内存中按（用户、任务、时间桶）累加请求数、输入/输出token数和GPU秒，
+GPU秒按引擎上同时进行的请求分摊（同一批次里的请求共享GPU时间），
+后台定期把累加的增量批量写入用量表，请求路径上不访问数据库。
+可选的每日配额按内存中的当日用量检查，当日用量在启动时从用量表恢复一次
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 计量配置
+USAGE_BUCKET_SECONDS = int(os.environ.get("USAGE_BUCKET_SECONDS", "3600"))
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", "60"))
+# 默认每日配额，0表示不限制；单个用户的配额可以通过管理接口覆盖
+USAGE_DAILY_TOKEN_QUOTA = int(os.environ.get("USAGE_DAILY_TOKEN_QUOTA", "0"))
+USAGE_DAILY_REQUEST_QUOTA = int(os.environ.get("USAGE_DAILY_REQUEST_QUOTA", "0"))
+
+DAY_SECONDS = 86400
+# 匿名访问（共享任务）记在用户0名下
+ANONYMOUS_USER_ID = 0
+
+COUNTER_FIELDS = ("requests", "errors", "prompt_tokens", "completion_tokens", "gpu_seconds")
+
+def task_engine(task: Any) -> Tuple[int, int, int]:
+    """请求实际使用的引擎：(引擎任务ID, 每个副本的GPU数, 副本数)
+
+    LoRA适配器任务使用基础模型的引擎；CPU引擎的GPU数为0。
+    """
+    from inference_utils import ENGINE_CPU
+    from database import get_inference_task
+
+    engine = task
+    if task.base_task_id:
+        engine = get_inference_task(task_id=task.base_task_id) or task
+    gpus = 0 if engine.engine == ENGINE_CPU else max(1, engine.tensor_parallel_size or 1)
+    return engine.id, gpus, max(1, engine.replicas or 1)
+
+def _empty() -> Dict[str, float]:
+    return {field: 0 for field in COUNTER_FIELDS}
+
+class UsageMeter:
+    """内存中的用量累加器"""
+
+    def __init__(self, bucket_seconds: int = USAGE_BUCKET_SECONDS):
+        self.bucket_seconds = bucket_seconds
+        self._lock = threading.Lock()
+        # (用户ID, 任务ID, 时间桶起点) -> 尚未写入数据库的增量
+        self._pending: Dict[Tuple[int, int, int], Dict[str, float]] = {}
+        # 用户ID -> 当日累计（UTC自然日），用于配额检查
+        self._today: Dict[int, Dict[str, float]] = {}
+        self._day = int(time.time() // DAY_SECONDS)
+        # 用户ID -> 覆盖默认值的配额
+        self._quotas: Dict[int, Dict[str, Any]] = {}
+        # 引擎任务ID -> GPU占用分摊时钟，见enter/leave
+        self._engines: Dict[int, Dict[str, float]] = {}
+
+    def _roll_day(self, now: float) -> None:
+        day = int(now // DAY_SECONDS)
+        if day != self._day:
+            self._day = day
+            self._today = {}
+
+    def _advance(self, clock: Dict[str, float], now: float) -> None:
+        # 每个进行中的请求在单位时间内分得 min(1, 副本数 / 进行中请求数) 个副本的GPU时间
+        if clock["active"]:
+            clock["value"] += (now - clock["updated"]) * min(1.0, clock["replicas"] / clock["active"])
+        clock["updated"] = now
+
+    def enter(self, engine_id: int, replicas: int = 1) -> float:
+        """请求开始占用引擎，返回分摊时钟的当前读数"""
+        now = time.monotonic()
+        with self._lock:
+            clock = self._engines.get(engine_id)
+            if clock is None:
+                clock = self._engines[engine_id] = {"active": 0, "value": 0.0, "updated": now, "replicas": replicas}
+            self._advance(clock, now)
+            clock["replicas"] = replicas
+            clock["active"] += 1
+            return clock["value"]
+
+    def leave(self, engine_id: int, entered_at: float) -> float:
+        """请求结束，返回它分摊到的副本占用秒数（乘以每个副本的GPU数即GPU秒）"""
+        now = time.monotonic()
+        with self._lock:
+            clock = self._engines.get(engine_id)
+            if clock is None:
+                return 0.0
+            self._advance(clock, now)
+            clock["active"] -= 1
+            share = clock["value"] - entered_at
+            if clock["active"] <= 0:
+                del self._engines[engine_id]
+            return max(0.0, share)
+
+    def record(self, user_id: Optional[int], task_id: int, prompt_tokens: int = 0,
+               completion_tokens: int = 0, gpu_seconds: float = 0.0, ok: bool = True) -> None:
+        """累加一次请求的用量"""
+        now = time.time()
+        user_id = user_id or ANONYMOUS_USER_ID
+        bucket = int(now // self.bucket_seconds) * self.bucket_seconds
+        delta = {
+            "requests": 1,
+            "errors": 0 if ok else 1,
+            "prompt_tokens": prompt_tokens or 0,
+            "completion_tokens": completion_tokens or 0,
+            "gpu_seconds": gpu_seconds or 0.0
+        }
+        with self._lock:
+            self._roll_day(now)
+            for counters in (self._pending.setdefault((user_id, task_id, bucket), _empty()),
+                             self._today.setdefault(user_id, _empty())):
+                for field, value in delta.items():
+                    counters[field] += value
+
+    def flush(self) -> int:
+        """把累加的增量批量写入数据库，返回写入的行数；写入失败时增量合并回内存，下次重试"""
+        from database import add_inference_usage
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        rows = [(user_id, task_id, bucket, *(counters[field] for field in COUNTER_FIELDS))
+                for (user_id, task_id, bucket), counters in pending.items()]
+        try:
+            add_inference_usage(rows)
+        except Exception as e:
+            logger.error(f"写入用量记录失败，稍后重试: {str(e)}")
+            with self._lock:
+                for key, counters in pending.items():
+                    merged = self._pending.setdefault(key, _empty())
+                    for field, value in counters.items():
+                        merged[field] += value
+            return 0
+        return len(rows)
+
+    async def run(self, interval: float = USAGE_FLUSH_INTERVAL) -> None:
+        """后台定期写入"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.error(f"用量写入循环出错: {str(e)}")
+
+    def restore(self) -> None:
+        """启动时从数据库恢复当日用量和用户配额"""
+        from database import get_inference_usage, get_usage_quotas
+
+        now = time.time()
+        day_start = int(now // DAY_SECONDS) * DAY_SECONDS
+        rows = get_inference_usage(start=day_start, group_by="user")
+        with self._lock:
+            self._roll_day(now)
+            for row in rows:
+                counters = self._today.setdefault(row["user_id"], _empty())
+                for field in COUNTER_FIELDS:
+                    counters[field] += row[field] or 0
+            self._quotas = get_usage_quotas()
+        logger.info(f"已恢复 {len(rows)} 个用户的当日用量和 {len(self._quotas)} 个用户配额")
+
+    def set_quota(self, user_id: int, daily_tokens: Optional[int], daily_requests: Optional[int]) -> None:
+        """更新内存中的用户配额（数据库由调用方写入）"""
+        with self._lock:
+            if daily_tokens is None and daily_requests is None:
+                self._quotas.pop(user_id, None)
+            else:
+                self._quotas[user_id] = {"user_id": user_id, "daily_tokens": daily_tokens,
+                                         "daily_requests": daily_requests}
+
+    def quota(self, user_id: int) -> Dict[str, Optional[int]]:
+        """用户生效的每日配额，None或0表示不限制"""
+        override = self._quotas.get(user_id)
+        if override:
+            return {"daily_tokens": override["daily_tokens"], "daily_requests": override["daily_requests"]}
+        return {"daily_tokens": USAGE_DAILY_TOKEN_QUOTA or None,
+                "daily_requests": USAGE_DAILY_REQUEST_QUOTA or None}
+
+    def today(self, user_id: int) -> Dict[str, Any]:
+        """用户当日的用量和配额"""
+        with self._lock:
+            self._roll_day(time.time())
+            counters = dict(self._today.get(user_id) or _empty())
+        counters["gpu_seconds"] = round(counters["gpu_seconds"], 3)
+        return {"usage": counters, "quota": self.quota(user_id)}
+
+    def check_quota(self, user_id: Optional[int]) -> Optional[Dict[str, Any]]:
+        """超出每日配额时返回提示信息和距配额重置的秒数（只读内存）"""
+        if not user_id:
+            return None
+        quota = self.quota(user_id)
+        now = time.time()
+        with self._lock:
+            self._roll_day(now)
+            counters = self._today.get(user_id)
+        if not counters:
+            return None
+        retry_after = int((self._day + 1) * DAY_SECONDS - now) + 1
+        tokens = counters["prompt_tokens"] + counters["completion_tokens"]
+        if quota["daily_tokens"] and tokens >= quota["daily_tokens"]:
+            return {"message": f"已超出每日token配额（{int(tokens)}/{quota['daily_tokens']}）", "retry_after": retry_after}
+        if quota["daily_requests"] and counters["requests"] >= quota["daily_requests"]:
+            return {"message": f"已超出每日请求配额（{int(counters['requests'])}/{quota['daily_requests']}）",
+                    "retry_after": retry_after}
+        return None
+
+# 全局用量计量器
+usage_meter = UsageMeter()